@@ -4,6 +4,7 @@ import logging
 
 from pkginstaller.internal.setup_package import SetupPackage
 from pkginstaller.internal.setup_packages import SetupPackages
+from pkginstaller.internal.setup_hosts import SetupHosts, HOSTS_MAX_PARALLEL
 
 __author__ = "Gaurav Goel"
 __license__ = "None"
@@ -94,7 +95,17 @@ def install_packages(
     remote_ssh_port = 22,
     remote_ssh_user = None,
     remote_ssh_pass = None,
-    verbose = 0
+    verbose = 0,
+    download_workers = 1,
+    download_race_mirrors = False,
+    download_segments = 1,
+    download_max_connections = None,
+    stream_extract = False,
+    source_snapshots = False,
+    build_log_dir = None,
+    output_line_callback = None,
+    build_fail_fast = False,
+    remote_agent = False
 ):
     setup_packages = SetupPackages(
         packages_configuration_list,
@@ -106,11 +117,75 @@ def install_packages(
         remote_ssh_port=remote_ssh_port,
         remote_ssh_user=remote_ssh_user,
         remote_ssh_pass=remote_ssh_pass,
-        verbose=verbose
+        verbose=verbose,
+        download_workers=download_workers,
+        download_race_mirrors=download_race_mirrors,
+        download_segments=download_segments,
+        download_max_connections=download_max_connections,
+        stream_extract=stream_extract,
+        source_snapshots=source_snapshots,
+        build_log_dir=build_log_dir,
+        output_line_callback=output_line_callback,
+        build_fail_fast=build_fail_fast,
+        remote_agent=remote_agent
     )
 
+    if setup_packages.uses_remote_agent():
+        return setup_packages.run_remote_agent()
+
     setup_packages.download()
     setup_packages.extract()
     setup_packages.install()
 
     return True
+
+def install_packages_on_hosts(
+    packages_configuration_list,
+    remote_hosts,
+    packages_cache_default_dir = PACKAGE_CACHE_DEFAULT_DIR,
+    packages_extract_default_root = PACKAGE_EXTRACT_DEFAULT_ROOT,
+    packages_build_default_root = PACKAGE_BUILD_DEFAULT_ROOT,
+    packages_install_default_root = PACKAGE_INSTALL_DEFAULT_ROOT,
+    controller_cache_dir = PACKAGE_CACHE_DEFAULT_DIR,
+    remote_ssh_port = 22,
+    remote_ssh_user = None,
+    remote_ssh_pass = None,
+    verbose = 0,
+    max_parallel_hosts = HOSTS_MAX_PARALLEL,
+    max_transfers_per_host = 1,
+    download_workers = 1,
+    download_race_mirrors = False,
+    download_segments = 1,
+    source_snapshots = False,
+    build_log_dir = None,
+    output_line_callback = None,
+    build_fail_fast = False
+):
+    # Package files are downloaded once to controller cache on this host,
+    # then hosts are installed concurrently and outcome of every host is
+    # returned, failure of one host does not stop other hosts.
+    setup_hosts = SetupHosts(
+        packages_configuration_list,
+        remote_hosts,
+        packages_cache_default_dir,
+        packages_extract_default_root,
+        packages_build_default_root,
+        packages_install_default_root,
+        controller_cache_dir,
+        remote_ssh_port=remote_ssh_port,
+        remote_ssh_user=remote_ssh_user,
+        remote_ssh_pass=remote_ssh_pass,
+        verbose=verbose,
+        max_parallel_hosts=max_parallel_hosts,
+        max_transfers_per_host=max_transfers_per_host,
+        download_workers=download_workers,
+        download_race_mirrors=download_race_mirrors,
+        download_segments=download_segments,
+        source_snapshots=source_snapshots,
+        build_log_dir=build_log_dir,
+        output_line_callback=output_line_callback,
+        build_fail_fast=build_fail_fast
+    )
+
+    setup_hosts.download()
+    return setup_hosts.install()
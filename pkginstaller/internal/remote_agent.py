@@ -0,0 +1,248 @@
+import os
+import sys
+import io
+import json
+import shlex
+import zipfile
+import hashlib
+import logging
+
+from pkginstaller.internal.setup_utils import *
+from pkginstaller.internal.setup_utils import _get_temp_file_name
+
+logger = logging.getLogger('pkginstaller.remote_agent')
+
+# Agent output lines which start with below prefix are json events, other
+# lines are plain output of agent.
+AGENT_EVENT_PREFIX = '@pkginstaller-event '
+AGENT_DIR_NAME = '.pkginstaller-agent'
+# Agent archive is named by sha256 of its content, so agents of different
+# pkginstaller versions sharing agent directory do not replace each other.
+AGENT_ARCHIVE_FILE_NAME = 'agent-{}.pyz'
+AGENT_STEPS = ('download', 'extract', 'install')
+
+_AGENT_MAIN_SOURCE = '''import sys
+from pkginstaller.internal.remote_agent import main
+sys.exit(main(sys.argv[1:]))
+'''
+
+
+def build_agent_archive():
+    """Builds executable zip archive of pkginstaller package.
+
+    Archive is run by python on remote host, it does not need pkginstaller
+    installation there.
+
+    Returns:
+        bytes: Zip archive data.
+
+    """
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    archive_data = io.BytesIO()
+    with zipfile.ZipFile(archive_data, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('__main__.py', _AGENT_MAIN_SOURCE)
+        for root, dir_names, file_names in os.walk(package_dir):
+            dir_names[:] = sorted(
+                dir_name for dir_name in dir_names
+                if dir_name != '__pycache__'
+            )
+            for file_name in sorted(file_names):
+                if not file_name.endswith('.py'):
+                    continue
+                file_path = os.path.join(root, file_name)
+                archive.write(
+                    file_path,
+                    os.path.join(
+                        'pkginstaller',
+                        os.path.relpath(file_path, package_dir)
+                    )
+                )
+    return archive_data.getvalue()
+
+def run_agent(
+    plan,
+    agent_root,
+    remote_host,
+    remote_ssh_port=22,
+    remote_ssh_user=None,
+    remote_ssh_pass=None,
+    event_callback=None,
+    log_file=None,
+    verbose=0
+):
+    """Runs install plan by agent on remote host.
+
+    Agent archive and plan are uploaded once, then agent downloads, extracts,
+    builds and verifies packages on remote host itself. Progress events are
+    streamed back on one SSH channel while agent is running. Agent needs
+    python3 on remote host.
+
+    Plan is dictionary with keys 'packages' (packages configuration list),
+    'dirs' (cache, extract, build and install default directories), 'options'
+    (SetupPackages keyword arguments which can be serialized to json) and
+    'verbose'. Paths in plan are paths on remote host.
+
+    Args:
+        plan (dict): Install plan.
+        agent_root (str): Remote directory where agent directory is created.
+        remote_host (str): Remote host address.
+        remote_ssh_port (int): Remote host SSH port.
+        remote_ssh_user (str): Remote host SSH User name.
+        remote_ssh_pass (str): Remote host SSH Password.
+        event_callback (callable): Called with each event dictionary.
+        log_file (str): File path where complete agent output is appended.
+
+    Returns:
+        list: Step events of agent, output events are only given to
+            event_callback.
+
+    """
+    archive_data = build_agent_archive()
+    agent_dir = os.path.join(agent_root, AGENT_DIR_NAME)
+    archive_path = os.path.join(
+        agent_dir, AGENT_ARCHIVE_FILE_NAME.format(
+            hashlib.sha256(archive_data).hexdigest()[:16]
+        )
+    )
+    plan_path = os.path.join(agent_dir, _get_temp_file_name('plan.json'))
+    if not mkdir_paths(
+        [agent_dir],
+        remote_host=remote_host,
+        remote_ssh_port=remote_ssh_port,
+        remote_ssh_user=remote_ssh_user,
+        remote_ssh_pass=remote_ssh_pass,
+        verbose=verbose
+    )[agent_dir]:
+        raise Exception(
+            'Creating agent directory {} failed on host {}'.format(
+            agent_dir, remote_host)
+        )
+
+    output = CommandOutput()
+    run_command(
+        ['command', '-v', 'python3'],
+        agent_dir,
+        remote_host=remote_host,
+        remote_ssh_port=remote_ssh_port,
+        remote_ssh_user=remote_ssh_user,
+        remote_ssh_pass=remote_ssh_pass,
+        output=output
+    )
+    if output.exit_status != 0:
+        raise Exception(
+            'python3 is required to run agent on host {}, it is not '
+            'found'.format(remote_host)
+        )
+
+    logger.info('Uploading agent and plan to %s:%s', remote_host, agent_dir)
+    with sftp_session(
+        remote_host, remote_ssh_port, remote_ssh_user, remote_ssh_pass
+    ) as sftp:
+        # Archive is uploaded to temporary name and renamed, so agent started
+        # at same time by other controller never runs partial archive.
+        try:
+            sftp.stat(archive_path)
+        except OSError:
+            temp_archive_path = os.path.join(
+                agent_dir, _get_temp_file_name(os.path.basename(archive_path))
+            )
+            sftp.putfo(io.BytesIO(archive_data), temp_archive_path)
+            sftp.posix_rename(temp_archive_path, archive_path)
+        with sftp.open(plan_path, 'w') as plan_file:
+            plan_file.write(json.dumps(plan))
+
+    step_events = []
+
+    def _handle_agent_line(stream_name, line):
+        if not line.startswith(AGENT_EVENT_PREFIX):
+            logger.debug('Agent output - %s', line)
+            return
+        try:
+            event = json.loads(line[len(AGENT_EVENT_PREFIX):])
+        except ValueError:
+            logger.error('Agent event is not parsed - %s', line)
+            return
+        if event.get('event') != 'output':
+            step_events.append(event)
+        if event_callback is not None:
+            event_callback(event)
+
+    output = CommandOutput(log_file=log_file, line_callback=_handle_agent_line)
+    agent_cmd = [
+        'python3',
+        shlex.quote(archive_path),
+        shlex.quote(plan_path)
+    ]
+    try:
+        run_command(
+            agent_cmd,
+            agent_dir,
+            remote_host=remote_host,
+            remote_ssh_port=remote_ssh_port,
+            remote_ssh_user=remote_ssh_user,
+            remote_ssh_pass=remote_ssh_pass,
+            output=output
+        )
+    finally:
+        remove_file(
+            plan_path,
+            remote_host=remote_host,
+            remote_ssh_port=remote_ssh_port,
+            remote_ssh_user=remote_ssh_user,
+            remote_ssh_pass=remote_ssh_pass,
+            failsafe=True
+        )
+
+    if output.exit_status != 0:
+        errors = [
+            event['error'] for event in step_events if event.get('error')
+        ]
+        raise Exception(
+            'Remote agent failed on host {} with exit status {} - {}'.format(
+            remote_host, output.exit_status,
+            '\n'.join(errors) or output.stdout)
+        )
+    return step_events
+
+def main(argv):
+    """Runs install plan on this host, it is entry point of agent archive.
+
+    Args:
+        argv (list): Plan file path.
+
+    Returns:
+        int: 0 if all packages are installed else 1.
+
+    """
+    # Imported here, setup_packages uses this module.
+    from pkginstaller.internal.setup_packages import SetupPackages
+
+    def _emit(event_name, **event_data):
+        event_data['event'] = event_name
+        print(AGENT_EVENT_PREFIX + json.dumps(event_data), flush=True)
+
+    with open(argv[0], 'r') as plan_file:
+        plan = json.load(plan_file)
+
+    setup_packages = SetupPackages(
+        plan['packages'],
+        *plan['dirs'],
+        verbose=plan.get('verbose', 0),
+        output_line_callback=lambda package_name, stream_name, line: _emit(
+            'output', package=package_name, stream=stream_name, line=line
+        ),
+        **plan.get('options', {})
+    )
+    for step in AGENT_STEPS:
+        _emit('step', step=step, status='started')
+        try:
+            getattr(setup_packages, step)()
+        except Exception as e:
+            logger.exception('Agent step %s failed', step)
+            _emit('step', step=step, status='failed', error=str(e))
+            return 1
+        step_results = {}
+        if step == 'download':
+            step_results = setup_packages.download_results
+        _emit('step', step=step, status='finished', results=step_results)
+    return 0
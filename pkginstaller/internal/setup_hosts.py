@@ -0,0 +1,228 @@
+import os
+import re
+import functools
+import urllib.request
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from pkginstaller.internal.setup_packages import SetupPackages
+from pkginstaller.internal.setup_utils import *
+
+logger = logging.getLogger('pkginstaller.setup_hosts')
+
+# Number of hosts installed in parallel by default.
+HOSTS_MAX_PARALLEL = 8
+HOST_STEPS = ('download', 'extract', 'install')
+
+
+class SetupHosts:
+
+    def __init__(
+        self,
+        packages_config_list,
+        remote_hosts,
+        packages_cache_default_dir,
+        packages_extract_default_root,
+        packages_build_default_root,
+        packages_install_default_root,
+        controller_cache_dir,
+        remote_ssh_port=22,
+        remote_ssh_user=None,
+        remote_ssh_pass=None,
+        verbose=0,
+        max_parallel_hosts=HOSTS_MAX_PARALLEL,
+        max_transfers_per_host=1,
+        download_workers=1,
+        download_race_mirrors=False,
+        download_segments=1,
+        source_snapshots=False,
+        build_log_dir=None,
+        output_line_callback=None,
+        build_fail_fast=False
+    ):
+        self._packages_config_list = packages_config_list
+        self._remote_hosts = remote_hosts
+        self._packages_cache_default_dir = packages_cache_default_dir
+        self._packages_extract_default_root = packages_extract_default_root
+        self._packages_build_default_root = packages_build_default_root
+        self._packages_install_default_root = packages_install_default_root
+        # Package files are downloaded once to this directory on localhost,
+        # and are copied from it to every host.
+        self._controller_cache_dir = controller_cache_dir
+        self._remote_ssh_port = remote_ssh_port
+        self._remote_ssh_user = remote_ssh_user
+        self._remote_ssh_pass = remote_ssh_pass
+        self._verbose = verbose
+        # Number of hosts installed at same time, and number of package files
+        # copied at same time to one host.
+        self._max_parallel_hosts = max_parallel_hosts
+        self._max_transfers_per_host = max_transfers_per_host
+        # Controller download options, see SetupPackages.
+        self._download_workers = download_workers
+        self._download_race_mirrors = download_race_mirrors
+        self._download_segments = download_segments
+        # Host install options, see SetupPackages. Build logs of host are
+        # written to <build_log_dir>/<host>/<package name>.log.
+        self._source_snapshots = source_snapshots
+        self._build_log_dir = build_log_dir
+        # Called with host, package name, stream name and line of package
+        # command output.
+        self._output_line_callback = output_line_callback
+        self._build_fail_fast = build_fail_fast
+
+        # Per package download outcome of controller download, see
+        # SetupPackages.download_results.
+        self.download_results = {}
+        # Per host outcome of last install() call, host to dictionary with
+        # keys status (INSTALLED or FAILED), step, error, download_results
+        # and elapsed_secs.
+        self.host_results = {}
+
+    def download(self):
+        if self._verbose > 0:
+            print('\nDOWNLOADING PACKAGES TO CONTROLLER CACHE...')
+
+        # Every root is controller cache, so packages do not create host
+        # directories on localhost. git repositories are cloned by hosts from
+        # their urls, so they are not cloned to controller cache.
+        controller_config_list = [
+            dict(
+                package_dict,
+                cache_directory=self._controller_cache_dir,
+                extract_root=self._controller_cache_dir,
+                build_root=self._controller_cache_dir,
+                install_root=self._controller_cache_dir
+            )
+            for package_dict in self._packages_config_list
+            if not re.match('.*\.git$', package_dict['file_name'])
+        ]
+        setup_packages = SetupPackages(
+            controller_config_list,
+            self._controller_cache_dir,
+            self._controller_cache_dir,
+            self._controller_cache_dir,
+            self._controller_cache_dir,
+            verbose=self._verbose,
+            download_workers=self._download_workers,
+            download_race_mirrors=self._download_race_mirrors,
+            download_segments=self._download_segments
+        )
+        try:
+            setup_packages.download()
+        finally:
+            self.download_results = setup_packages.download_results
+
+        return True
+
+    def install(self):
+        if self._verbose > 0:
+            print('\nINSTALLING PACKAGES ON {} HOSTS...'.format(
+                len(self._remote_hosts)))
+
+        timer_obj = Timer(verbose=self._verbose)
+        timer_obj.start()
+
+        host_config_list = self._get_host_config_list()
+        self.host_results = {}
+        # Progress messages of parallel hosts would be interleaved, so hosts
+        # are installed without verbose output and only host outcome is
+        # printed.
+        with ThreadPoolExecutor(
+            max_workers=self._max_parallel_hosts
+        ) as executor:
+            futures = {
+                executor.submit(
+                    self._install_host, remote_host, host_config_list
+                ): remote_host
+                for remote_host in self._remote_hosts
+            }
+            for future in as_completed(futures):
+                remote_host = futures[future]
+                host_result = future.result()
+                self.host_results[remote_host] = host_result
+                if self._verbose > 0:
+                    print('[HOST] ' + remote_host + '  [' + \
+                        host_result['status'] + ']')
+
+        # printing elapsed time if verbose
+        timer_obj.stop()
+
+        return self.host_results
+
+    def _get_host_config_list(self):
+        # Hosts download package files from controller cache, with sha256
+        # learned by controller download. git repositories are cloned by
+        # host from their urls.
+        controller_url = 'file://' + urllib.request.pathname2url(
+            os.path.abspath(self._controller_cache_dir)
+        )
+        host_config_list = []
+        for package_dict in self._packages_config_list:
+            if re.match('.*\.git$', package_dict['file_name']):
+                host_config_list.append(package_dict)
+                continue
+            host_config_list.append(dict(
+                package_dict,
+                urls=[controller_url],
+                sha256=package_dict.get('sha256') or get_cached_file_sha256(
+                    package_dict['file_name'], self._controller_cache_dir
+                )
+            ))
+        return host_config_list
+
+    def _install_host(self, remote_host, host_config_list):
+        timer_obj = Timer()
+        timer_obj.start()
+
+        host_result = {
+            'status': 'FAILED',
+            'step': None,
+            'error': None,
+            'download_results': {}
+        }
+        setup_packages = None
+        try:
+            setup_packages = SetupPackages(
+                host_config_list,
+                self._packages_cache_default_dir,
+                self._packages_extract_default_root,
+                self._packages_build_default_root,
+                self._packages_install_default_root,
+                remote_host=remote_host,
+                remote_ssh_port=self._remote_ssh_port,
+                remote_ssh_user=self._remote_ssh_user,
+                remote_ssh_pass=self._remote_ssh_pass,
+                download_workers=self._max_transfers_per_host,
+                source_snapshots=self._source_snapshots,
+                build_log_dir=self._get_build_log_dir(remote_host),
+                output_line_callback=self._get_line_callback(remote_host),
+                build_fail_fast=self._build_fail_fast
+            )
+            for step in HOST_STEPS:
+                host_result['step'] = step
+                getattr(setup_packages, step)()
+            host_result['status'] = 'INSTALLED'
+        except Exception as e:
+            logger.error(
+                'Error in installing packages on host %s in %s step - %s',
+                remote_host, host_result['step'], e
+            )
+            host_result['error'] = str(e)
+        finally:
+            if setup_packages is not None:
+                host_result['download_results'] = \
+                    setup_packages.download_results
+            timer_obj.stop()
+            host_result['elapsed_secs'] = timer_obj.elapsed_secs
+
+        return host_result
+
+    def _get_build_log_dir(self, remote_host):
+        if self._build_log_dir is None:
+            return None
+        return os.path.join(self._build_log_dir, remote_host)
+
+    def _get_line_callback(self, remote_host):
+        if self._output_line_callback is None:
+            return None
+        return functools.partial(self._output_line_callback, remote_host)
@@ -16,6 +16,12 @@ class SetupPackage:
     file_name              - Package file name string.
     urls                   - Package download urls array.
     build_type             - Package build type such as make, distutils.
+    sha256                 - Package file sha256 hex digest, downloaded file
+                             is verified against it.
+    extract_engine         - "native" to extract package in process or
+                             "command" to extract it with tar or unzip.
+    extract_exclude        - Package archive member path patterns array which
+                             are not extracted, needs native extract engine.
     
     cache_directory        - Package cache location, save after download.
     extract_root           - Package extract directory.
@@ -48,7 +54,8 @@ class SetupPackage:
         remote_ssh_port=22,
         remote_ssh_user=None,
         remote_ssh_pass=None,
-        verbose=0
+        verbose=0,
+        line_callback=None
     ):
         logger.debug(
             'Package configuration dictionary is %s',
@@ -60,6 +67,9 @@ class SetupPackage:
         self.remote_ssh_user = remote_ssh_user
         self.remote_ssh_pass = remote_ssh_pass
         self.verbose = verbose
+        # Called with stream name and line of install check and script
+        # commands output while they are running.
+        self.line_callback = line_callback
        
         if not 'name' in package_config_dict.keys():
             raise ValueError(
@@ -93,9 +103,23 @@ class SetupPackage:
         else:
             self.package_build_type = package_config_dict['build_type']
        
+        # Package file sha256, if it is not given then it is learned on first
+        # download.
+        self.package_sha256 = package_config_dict.get('sha256')
+        if self.package_sha256 is not None:
+            self.package_sha256 = self.package_sha256.strip().lower()
+
+        # Package extract engine, None selects default engine of host.
+        self.package_extract_engine = package_config_dict.get(
+            'extract_engine'
+        )
+        self.package_extract_exclude = package_config_dict.get(
+            'extract_exclude', []
+        )
+
         # Getting package name without extension.
         package_extension_re_pattern = \
-            '(\.git|\.zip|\.tar|\.tar\.bz2|\.tar\.gz|\.tar\.xz)$'
+            '(\.git|\.zip|\.tar|\.tar\.bz2|\.tar\.gz|\.tar\.xz|\.tar\.zst)$'
         package_file_name_without_extension = re_replace(
             package_extension_re_pattern, '', self.package_file_name)
         
@@ -138,14 +162,16 @@ class SetupPackage:
             get_sitepackage_cmd = ['python', '-c',
                 'import site; print(site.getsitepackages()[0])'
             ]
+            output = CommandOutput()
             stdout, stderr = run_command(
                 get_sitepackage_cmd,
                 remote_host=self.remote_host,
                 remote_ssh_port=self.remote_ssh_port,
                 remote_ssh_user=self.remote_ssh_user,
-                remote_ssh_pass=self.remote_ssh_pass
+                remote_ssh_pass=self.remote_ssh_pass,
+                output=output
             )
-            if stderr != "":
+            if output.exit_status != 0:
                 raise Exception('ERROR - {}'.format(stderr)) 
             self.package_install_path = stdout.strip()
 
@@ -229,10 +255,10 @@ class SetupPackage:
             )
 
         # Create required directories if does not exists.
-        self._create_dirs(self.source_repo)
-        self._create_dirs(self.source_path)
-        self._create_dirs(self.build_path)
-        self._create_dirs(self.install_path)
+        self._create_dirs([
+            self.source_repo, self.source_path, self.build_path,
+            self.install_path
+        ])
         
         # Adding debug logs to show package properties. 
         class_properties = []
@@ -296,8 +322,10 @@ class SetupPackage:
     
     def is_package_exists(self):
         logger.info('Verifying package exists or not - %s', self.package_name)
-        if is_path_exists(
-            self.package_source_repo,
+        if is_file_cached(
+            self.package_file_name,
+            self.source_repo,
+            sha256=self.package_sha256,
             remote_host=self.remote_host,
             remote_ssh_port=self.remote_ssh_port,
             remote_ssh_user=self.remote_ssh_user,
@@ -312,15 +340,16 @@ class SetupPackage:
         # Verifying installation files.
         logger.info('Verifying package installed or not - %s',
             self.package_name)
+        installation_file_stats = stat_paths(
+            self.package_installation_verify_files,
+            remote_host=self.remote_host,
+            remote_ssh_port=self.remote_ssh_port,
+            remote_ssh_user=self.remote_ssh_user,
+            remote_ssh_pass=self.remote_ssh_pass,
+            verbose=self.verbose
+        )
         for installation_file in self.package_installation_verify_files:
-            if not is_path_exists(
-                installation_file,
-                remote_host=self.remote_host,
-                remote_ssh_port=self.remote_ssh_port,
-                remote_ssh_user=self.remote_ssh_user,
-                remote_ssh_pass=self.remote_ssh_pass,
-                verbose=self.verbose
-            ):
+            if installation_file_stats[installation_file] is None:
                 logger.info(
                     'Installation file ' + installation_file + ' not found'
                 )
@@ -332,16 +361,19 @@ class SetupPackage:
         
         # Verifying installation commands.
         for cmd_array in self.package_installation_verify_cmds:
+            output = CommandOutput()
             stdout, stderr = run_command(
                 cmd_array[0],
                 remote_host=self.remote_host,
                 remote_ssh_port=self.remote_ssh_port,
                 remote_ssh_user=self.remote_ssh_user,
                 remote_ssh_pass=self.remote_ssh_pass,
-                verbose=self.verbose
+                verbose=self.verbose,
+                output=output,
+                line_callback=self.line_callback
             )
 
-            if stderr != "":
+            if output.exit_status != 0:
                 logger.info('Command execution failed. Error is %s', stderr)
                 return False
             if stdout.strip() != cmd_array[1].strip():
@@ -389,6 +421,26 @@ class SetupPackage:
 
     def setup_config_files(self):
         
+        if not self.package_configuration_files:
+            return True
+
+        # Source files are checked and destination directories are created
+        # with one batch each, before files are copied.
+        source_file_stats = stat_paths(
+            [source_dest_files[0] for source_dest_files in \
+                self.package_configuration_files],
+            remote_host=self.remote_host,
+            remote_ssh_port=self.remote_ssh_port,
+            remote_ssh_user=self.remote_ssh_user,
+            remote_ssh_pass=self.remote_ssh_pass,
+            verbose=self.verbose
+        )
+        self._create_dirs(sorted(set(
+            os.path.dirname(source_dest_files[1]) for source_dest_files in \
+                self.package_configuration_files
+            if source_file_stats[source_dest_files[0]] is not None
+        )))
+
         # Source file and destination file both should be absolute path.
         for source_dest_files in self.package_configuration_files:
             source_file_path = source_dest_files[0]
@@ -400,35 +452,11 @@ class SetupPackage:
                     end=''
                 )
 
-            if not is_path_exists(
-                source_file_path,
-                remote_host=self.remote_host,
-                remote_ssh_port=self.remote_ssh_port,
-                remote_ssh_user=self.remote_ssh_user,
-                remote_ssh_pass=self.remote_ssh_pass,
-                verbose=self.verbose
-            ):
+            if source_file_stats[source_file_path] is None:
                 if self.verbose > 0:
                     print('  [FAILED]')
                 return False
 
-            if not is_path_exists(
-                os.path.dirname(dest_file_path),
-                remote_host=self.remote_host,
-                remote_ssh_port=self.remote_ssh_port,
-                remote_ssh_user=self.remote_ssh_user,
-                remote_ssh_pass=self.remote_ssh_pass,
-                verbose=self.verbose
-            ):
-                mkdirs(
-                    os.path.dirname(dest_file_path),
-                    remote_host=self.remote_host,
-                    remote_ssh_port=self.remote_ssh_port,
-                    remote_ssh_user=self.remote_ssh_user,
-                    remote_ssh_pass=self.remote_ssh_pass,
-                    verbose=self.verbose
-                )
-
             with open(source_file_path, 'r') as source_fd:
                 with open(dest_file_path, 'w+') as dest_fd:
                     source_file_data = source_fd.read()
@@ -442,23 +470,22 @@ class SetupPackage:
 
         return True
     
-    def _create_dirs(self, dir_path):
-        if not is_path_exists(
-            dir_path,
+    def _create_dirs(self, dir_paths):
+        # All directories are created by one remote command.
+        dir_statuses = mkdir_paths(
+            dir_paths,
             remote_host=self.remote_host,
             remote_ssh_port=self.remote_ssh_port,
             remote_ssh_user=self.remote_ssh_user,
             remote_ssh_pass=self.remote_ssh_pass,
             verbose=self.verbose
-        ):
-            mkdirs(
-                dir_path,
-                remote_host=self.remote_host,
-                remote_ssh_port=self.remote_ssh_port,
-                remote_ssh_user=self.remote_ssh_user,
-                remote_ssh_pass=self.remote_ssh_pass,
-                verbose=self.verbose
-            )
+        )
+        for dir_path, dir_status in dir_statuses.items():
+            if not dir_status:
+                raise RuntimeError(
+                    'Error in creating directory {} on host {}'.format(
+                    dir_path, self.remote_host)
+                )
 
     def _run_script(self, script_file, script_execution_dir):
         if self.verbose > 0:
@@ -494,6 +521,7 @@ class SetupPackage:
                 write_file.write(read_file_data)
 
         script_bash_cmd = ['bash', script_temp_file]
+        output = CommandOutput()
         stdout, stderr = run_command(
             script_bash_cmd,
             script_execution_dir,
@@ -501,7 +529,9 @@ class SetupPackage:
             remote_ssh_port=self.remote_ssh_port,
             remote_ssh_user=self.remote_ssh_user,
             remote_ssh_pass=self.remote_ssh_pass,
-            verbose=self.verbose
+            verbose=self.verbose,
+            output=output,
+            line_callback=self.line_callback
         )
         remove_file(
             script_temp_file,
@@ -512,7 +542,7 @@ class SetupPackage:
             verbose=self.verbose 
         )
         
-        if stderr == "":
+        if output.exit_status == 0:
             if self.verbose > 0:
                 print('  [EXECUTION PASSED]')
             return True
@@ -2,8 +2,12 @@ import os
 import json
 import re
 import subprocess
+import functools
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from pkginstaller.internal.setup_package import SetupPackage
+from pkginstaller.internal.remote_agent import run_agent
 from pkginstaller.internal.setup_packages_utils import *
 from pkginstaller.internal.setup_utils import *
 
@@ -23,7 +27,20 @@ class SetupPackages:
         remote_ssh_port=22,
         remote_ssh_user=None,
         remote_ssh_pass=None,
-        verbose=0
+        verbose=0,
+        download_workers=1,
+        download_race_mirrors=False,
+        download_race_timeout=30,
+        download_segments=1,
+        download_max_connections=None,
+        stream_extract=False,
+        source_snapshots=False,
+        source_snapshot_copy_mode='reflink',
+        build_log_dir=None,
+        output_line_callback=None,
+        build_error_classifier=classify_build_error,
+        build_fail_fast=False,
+        remote_agent=False
     ):
         self._packages_config_list = packages_config_list
         self._packages_cache_default_dir = packages_cache_default_dir
@@ -35,6 +52,114 @@ class SetupPackages:
         self._remote_ssh_user = remote_ssh_user
         self._remote_ssh_pass = remote_ssh_pass
         self._verbose = verbose
+        # Number of packages downloaded in parallel, 1 downloads packages one
+        # after another.
+        self._download_workers = download_workers
+        # Probe all package urls at same time and download from the fastest
+        # one instead of trying urls in configured order.
+        self._download_race_mirrors = download_race_mirrors
+        self._download_race_timeout = download_race_timeout
+        # Number of parallel connections used to download single package.
+        self._download_segments = download_segments
+        # Maximum keep-alive connections opened to one mirror by downloads of
+        # this object, None keeps pool default.
+        self._download_max_connections = download_max_connections
+        # Extract tar archives while they are downloading, on localhost only.
+        self._stream_extract = stream_extract
+        # Keep extracted and patched source trees in snapshot cache and copy
+        # package source path from it, patches are then applied during
+        # extraction instead of installation.
+        self._source_snapshots = source_snapshots
+        self._source_snapshot_copy_mode = source_snapshot_copy_mode
+        # Complete output of package patch, configure, build and install
+        # commands is written to <build_log_dir>/<package name>.log on
+        # localhost, only output tail is kept in memory.
+        self._build_log_dir = build_log_dir
+        # Called with package name, stream name and line of package command
+        # output as soon as line is read, while command is running.
+        self._output_line_callback = output_line_callback
+        # Package build succeeds only if its commands exit with zero status,
+        # errors reported by classifier are printed on failure. With fail
+        # fast, build command is stopped on first classified error.
+        self._build_error_classifier = build_error_classifier
+        self._build_fail_fast = build_fail_fast
+        # Runs download, extract and install on remote host by agent, see
+        # run_remote_agent.
+        self._remote_agent = remote_agent and not (
+            remote_host == "localhost" or remote_host == "127.0.0.1"
+        )
+
+        # Per package download outcome of last download() call, package name
+        # to one of FOUND, DOWNLOADED, FAILED, PENDING or CANCELLED.
+        self.download_results = {}
+
+    def uses_remote_agent(self):
+        """Returns True if packages are installed by run_remote_agent.
+
+        Agent is used only if it was requested and host is not localhost.
+        """
+        return self._remote_agent
+
+    def run_remote_agent(self):
+        """Downloads, extracts and installs packages by agent on remote host.
+
+        Agent runs all steps on remote host, so number of SSH round trips
+        does not depend on number of packages and paths. Paths of packages
+        configuration are paths on remote host. Error classifier is not sent
+        to agent, default classifier is used there.
+        """
+        if self._verbose > 0:
+            print('\nRUNNING REMOTE AGENT ON ' + self._remote_host + '...')
+
+        plan = {
+            'packages': self._packages_config_list,
+            'dirs': [
+                self._packages_cache_default_dir,
+                self._packages_extract_default_root,
+                self._packages_build_default_root,
+                self._packages_install_default_root
+            ],
+            'options': {
+                'download_workers': self._download_workers,
+                'download_race_mirrors': self._download_race_mirrors,
+                'download_race_timeout': self._download_race_timeout,
+                'download_segments': self._download_segments,
+                'download_max_connections': self._download_max_connections,
+                'stream_extract': self._stream_extract,
+                'source_snapshots': self._source_snapshots,
+                'source_snapshot_copy_mode': self._source_snapshot_copy_mode,
+                'build_log_dir': self._build_log_dir,
+                'build_fail_fast': self._build_fail_fast
+            },
+            'verbose': 0
+        }
+        run_agent(
+            plan,
+            self._packages_cache_default_dir,
+            self._remote_host,
+            remote_ssh_port=self._remote_ssh_port,
+            remote_ssh_user=self._remote_ssh_user,
+            remote_ssh_pass=self._remote_ssh_pass,
+            event_callback=self._handle_agent_event,
+            verbose=self._verbose
+        )
+        return True
+
+    def _handle_agent_event(self, event):
+        if event['event'] == 'output':
+            if self._verbose > 1:
+                print(event['line'])
+            if self._output_line_callback is not None:
+                self._output_line_callback(
+                    event['package'], event['stream'], event['line']
+                )
+            return
+
+        if self._verbose > 0:
+            print('[AGENT] ' + event['step'].upper() + ' ' + \
+                event['status'].upper())
+        if event['step'] == 'download' and event['status'] == 'finished':
+            self.download_results = event['results']
 
     def download(self):
         if self._verbose > 0:
@@ -45,36 +170,155 @@ class SetupPackages:
             self._packages_config_list
         )
 
+        self.download_results = {}
+        if self._download_workers > 1:
+            return self._download_concurrently()
+
         for package_dict in self._packages_config_list:
             # Starting timer.
             timer_obj = Timer(verbose=self._verbose)
             timer_obj.start()
 
-            package_obj = SetupPackage(
-                package_dict,
-                self._packages_cache_default_dir,
-                self._packages_extract_default_root,
-                self._packages_build_default_root,
-                self._packages_install_default_root,
-                remote_host=self._remote_host,
-                remote_ssh_port=self._remote_ssh_port,
-                remote_ssh_user=self._remote_ssh_user,
-                remote_ssh_pass=self._remote_ssh_pass,
-                verbose=self._verbose
-            )
+            package_obj = self._get_package_obj(package_dict)
             if self._verbose > 0:
                 print('[FILE] ' + package_obj.package_source_repo, end='')
             
             if package_obj.is_package_exists():
+                self.download_results[package_obj.package_name] = 'FOUND'
                 if self._verbose > 0:
                     print('  [FOUND]')
                 continue
 
-            file_downloaded_success = False
             if self._verbose > 0:
                 print('  [NOT FOUND] [DOWNLOADING...]\n')    
-            for package_download_url in package_obj.package_download_urls:
-                file_downloaded_success = download_file(
+            if not self._download_package(package_obj, self._verbose):
+                self.download_results[package_obj.package_name] = 'FAILED'
+                raise Exception(
+                    'Error in downloading package ' + package_obj.package_name
+                )
+            self.download_results[package_obj.package_name] = 'DOWNLOADED'
+
+            # printing elapsed time if verbose
+            timer_obj.stop()
+
+        return True
+
+    def _download_concurrently(self):
+        timer_obj = Timer(verbose=self._verbose)
+        timer_obj.start()
+
+        # Package objects are created up front in this thread, constructor
+        # creates root directories which are shared between packages.
+        package_objs = []
+        for package_dict in self._packages_config_list:
+            package_obj = self._get_package_obj(package_dict)
+            if package_obj.is_package_exists():
+                self.download_results[package_obj.package_name] = 'FOUND'
+                if self._verbose > 0:
+                    print(
+                        '[FILE] ' + package_obj.package_source_repo + \
+                        '  [FOUND]'
+                    )
+                continue
+            package_objs.append(package_obj)
+
+        logger.info(
+            'Downloading %s packages with %s workers',
+            len(package_objs), self._download_workers
+        )
+
+        # Progress messages of parallel downloads would be interleaved, so
+        # download_file runs without verbose output here.
+        executor = ThreadPoolExecutor(max_workers=self._download_workers)
+        futures = {}
+        for package_obj in package_objs:
+            self.download_results[package_obj.package_name] = 'PENDING'
+            future = executor.submit(self._download_package, package_obj, 0)
+            futures[future] = package_obj
+
+        failed_package_obj = None
+        try:
+            for future in as_completed(futures):
+                package_obj = futures[future]
+                try:
+                    status = future.result()
+                except Exception as e:
+                    logger.error(
+                        'Error in downloading package %s - %s',
+                        package_obj.package_name, e
+                    )
+                    status = False
+
+                if status:
+                    self.download_results[package_obj.package_name] = \
+                        'DOWNLOADED'
+                    if self._verbose > 0:
+                        print(
+                            '[FILE] ' + package_obj.package_source_repo + \
+                            '  [DOWNLOADED]'
+                        )
+                else:
+                    self.download_results[package_obj.package_name] = 'FAILED'
+                    if self._verbose > 0:
+                        print(
+                            '[FILE] ' + package_obj.package_source_repo + \
+                            '  [FAILED]'
+                        )
+                    failed_package_obj = package_obj
+                    break
+        finally:
+            # Downloads which did not start yet are dropped on failure,
+            # running ones are allowed to finish.
+            for future in futures:
+                if future.cancel():
+                    self.download_results[futures[future].package_name] = \
+                        'CANCELLED'
+            executor.shutdown(wait=True)
+
+        for future, package_obj in futures.items():
+            if self.download_results[package_obj.package_name] != 'PENDING':
+                continue
+            if future.exception() is None and future.result():
+                self.download_results[package_obj.package_name] = 'DOWNLOADED'
+            else:
+                self.download_results[package_obj.package_name] = 'FAILED'
+
+        # printing elapsed time if verbose
+        timer_obj.stop()
+
+        if failed_package_obj is not None:
+            raise Exception(
+                'Error in downloading package ' + \
+                failed_package_obj.package_name
+            )
+
+        return True
+
+    def _download_package(self, package_obj, verbose):
+        package_download_urls = package_obj.package_download_urls
+        if self._download_race_mirrors:
+            package_download_urls = race_download_urls(
+                package_obj.package_file_name,
+                package_download_urls,
+                metadata_dir=get_download_metadata_dir(
+                    package_obj.source_repo, self._remote_host
+                ),
+                timeout=self._download_race_timeout,
+                max_connections=self._download_max_connections,
+                verbose=verbose
+            )
+
+        extract_path = None
+        if self._stream_extract and (
+            self._remote_host == "localhost" or \
+            self._remote_host == "127.0.0.1"
+        ):
+            extract_path = package_obj.source_path
+
+        # Failure of one url is not fatal, next url is tried.
+        for package_download_url in package_download_urls:
+            try:
+                if download_file(
                     package_obj.package_file_name,
                     package_download_url,
                     package_obj.source_repo,
@@ -82,18 +326,58 @@ class SetupPackages:
                     remote_ssh_port=self._remote_ssh_port,
                     remote_ssh_user=self._remote_ssh_user,
                     remote_ssh_pass=self._remote_ssh_pass,
-                    verbose=self._verbose
+                    verbose=verbose,
+                    sha256=package_obj.package_sha256,
+                    segments=self._download_segments,
+                    extract_path=extract_path,
+                    max_connections=self._download_max_connections
+                ):
+                    return True
+            except Exception as e:
+                logger.error(
+                    'Error in downloading package %s from %s - %s',
+                    package_obj.package_name, package_download_url, e
                 )
-                if file_downloaded_success:
-                    break
 
-            if not file_downloaded_success:
-                raise Exception(
-                    'Error in downloading package ' + package_obj.package_name
-                )
+        return False
 
-            # printing elapsed time if verbose
-            timer_obj.stop()
+    def _is_snapshot_package(self, package_obj):
+        # git repositories are copied, they do not have snapshots.
+        return self._source_snapshots and \
+            not re.match('.*\.git$', package_obj.package_file_name)
+
+    def _get_install_patches(self, package_obj):
+        # Snapshot source trees are already patched.
+        if self._is_snapshot_package(package_obj):
+            return []
+        return package_obj.package_patches
+
+    def _get_build_log_file(self, package_obj):
+        if self._build_log_dir is None:
+            return None
+        return os.path.join(
+            self._build_log_dir, package_obj.package_name + '.log'
+        )
+
+    def _get_line_callback(self, package_name):
+        if self._output_line_callback is None:
+            return None
+        return functools.partial(self._output_line_callback, package_name)
+
+    def _get_package_obj(self, package_dict):
+        return SetupPackage(
+            package_dict,
+            self._packages_cache_default_dir,
+            self._packages_extract_default_root,
+            self._packages_build_default_root,
+            self._packages_install_default_root,
+            remote_host=self._remote_host,
+            remote_ssh_port=self._remote_ssh_port,
+            remote_ssh_user=self._remote_ssh_user,
+            remote_ssh_pass=self._remote_ssh_pass,
+            verbose=self._verbose,
+            line_callback=self._get_line_callback(package_dict.get('name'))
+        )
 
     def extract(self):
         if self._verbose > 0:
@@ -104,26 +388,24 @@ class SetupPackages:
             timer_obj = Timer(verbose=self._verbose)
             timer_obj.start()
 
-            package_obj = SetupPackage(
-                package_dict,
-                self._packages_cache_default_dir,
-                self._packages_extract_default_root,
-                self._packages_build_default_root,
-                self._packages_install_default_root,
-                remote_host=self._remote_host,
-                remote_ssh_port=self._remote_ssh_port,
-                remote_ssh_user=self._remote_ssh_user,
-                remote_ssh_pass=self._remote_ssh_pass,
-                verbose=self._verbose
-            )
+            package_obj = self._get_package_obj(package_dict)
             if self._verbose > 0:
                 print(
                     '[EXTRACTION] ' + package_obj.package_source_path,
                     end=''
                 )
 
-            if is_path_exists(
-                package_obj.package_source_path,
+            # Existing source path is trusted only if its extraction
+            # completed from current package file, and it is patched only in
+            # snapshot mode, patches are applied by install otherwise.
+            is_snapshot_package = self._is_snapshot_package(package_obj)
+            if is_file_extracted(
+                package_obj.package_file_name,
+                package_obj.source_repo,
+                package_obj.source_path,
+                sha256=package_obj.package_sha256,
+                patch_files=package_obj.package_patches \
+                    if is_snapshot_package else [],
                 remote_host=self._remote_host,
                 remote_ssh_port=self._remote_ssh_port,
                 remote_ssh_user=self._remote_ssh_user,
@@ -132,18 +414,36 @@ class SetupPackages:
             ):
                 if self._verbose > 0:
                     print('  [CACHED]')
-                    continue
+                continue
 
-            extract_file(
-                package_obj.package_file_name,
-                package_obj.source_repo,
-                package_obj.source_path,
-                remote_host=self._remote_host,
-                remote_ssh_port=self._remote_ssh_port,
-                remote_ssh_user=self._remote_ssh_user,
-                remote_ssh_pass=self._remote_ssh_pass,
-                verbose=self._verbose
-            )
+            if is_snapshot_package:
+                extract_source_snapshot(
+                    package_obj.package_file_name,
+                    package_obj.source_repo,
+                    package_obj.source_path,
+                    patch_files=package_obj.package_patches,
+                    copy_mode=self._source_snapshot_copy_mode,
+                    remote_host=self._remote_host,
+                    remote_ssh_port=self._remote_ssh_port,
+                    remote_ssh_user=self._remote_ssh_user,
+                    remote_ssh_pass=self._remote_ssh_pass,
+                    verbose=self._verbose,
+                    engine=package_obj.package_extract_engine,
+                    exclude_patterns=package_obj.package_extract_exclude
+                )
+            else:
+                extract_file(
+                    package_obj.package_file_name,
+                    package_obj.source_repo,
+                    package_obj.source_path,
+                    remote_host=self._remote_host,
+                    remote_ssh_port=self._remote_ssh_port,
+                    remote_ssh_user=self._remote_ssh_user,
+                    remote_ssh_pass=self._remote_ssh_pass,
+                    verbose=self._verbose,
+                    engine=package_obj.package_extract_engine,
+                    exclude_patterns=package_obj.package_extract_exclude
+                )
             if self._verbose > 0:
                 print('  [EXTRACTED]')
             # printing elapsed time if verbose
@@ -160,18 +460,7 @@ class SetupPackages:
             timer_obj = Timer(verbose=self._verbose)
             timer_obj.start()
 
-            package_obj = SetupPackage(
-                package_dict,
-                self._packages_cache_default_dir,
-                self._packages_extract_default_root,
-                self._packages_build_default_root,
-                self._packages_install_default_root,
-                remote_host=self._remote_host,
-                remote_ssh_port=self._remote_ssh_port,
-                remote_ssh_user=self._remote_ssh_user,
-                remote_ssh_pass=self._remote_ssh_pass,
-                verbose=self._verbose
-            )
+            package_obj = self._get_package_obj(package_dict)
 
             if package_obj.is_package_installed():
                 if self._verbose > 0:
@@ -190,6 +479,10 @@ class SetupPackages:
             if self._verbose > 0:
                 print('Installing package ' + package_obj.package_name + '...')   
             
+            build_log_file = self._get_build_log_file(package_obj)
+            if self._verbose > 0 and build_log_file is not None:
+                print('Build log file ' + build_log_file)
+
             status = package_obj.run_pre_install_scripts()
             if status == False:
                 raise Exception('Pre Install Script execution failed.') 
@@ -197,22 +490,15 @@ class SetupPackages:
             if package_obj.package_build_type == "make" or \
                 package_obj.package_build_type == "imake":
                 
-                if not is_path_exists(
-                    package_obj.package_build_path,
+                if not mkdir_paths(
+                    [package_obj.package_build_path],
                     remote_host=self._remote_host,
                     remote_ssh_port=self._remote_ssh_port,
                     remote_ssh_user=self._remote_ssh_user,
                     remote_ssh_pass=self._remote_ssh_pass,
                     verbose=self._verbose
-                ):
-                    mkdirs(
-                        package_obj.package_build_path,
-                        remote_host=self._remote_host,
-                        remote_ssh_port=self._remote_ssh_port,
-                        remote_ssh_user=self._remote_ssh_user,
-                        remote_ssh_pass=self._remote_ssh_pass,
-                        verbose=self._verbose
-                    )
+                )[package_obj.package_build_path]:
+                    raise Exception('Creating build directory failed.')
 
                 status = run_make_build(
                     package_obj.package_source_path,
@@ -220,53 +506,58 @@ class SetupPackages:
                     package_obj.package_install_path,
                     package_obj.package_configure_args,
                     package_obj.package_configure_cmd,
-                    package_patches=package_obj.package_patches,
+                    package_patches=self._get_install_patches(package_obj),
                     remote_host=self._remote_host,
                     remote_ssh_port=self._remote_ssh_port,
                     remote_ssh_user=self._remote_ssh_user,
                     remote_ssh_pass=self._remote_ssh_pass,
-                    verbose=self._verbose
+                    verbose=self._verbose,
+                    log_file=build_log_file,
+                    line_callback=package_obj.line_callback,
+                    error_classifier=self._build_error_classifier,
+                    fail_fast=self._build_fail_fast
                 )
             elif package_obj.package_build_type == "cmake":
-                if not is_path_exists(
-                    package_obj.package_build_path,
+                if not mkdir_paths(
+                    [package_obj.package_build_path],
                     remote_host=self._remote_host,
                     remote_ssh_port=self._remote_ssh_port,
                     remote_ssh_user=self._remote_ssh_user,
                     remote_ssh_pass=self._remote_ssh_pass,
                     verbose=self._verbose
-                ):
-                    mkdirs(
-                        package_obj.package_build_path,
-                        remote_host=self._remote_host,
-                        remote_ssh_port=self._remote_ssh_port,
-                        remote_ssh_user=self._remote_ssh_user,
-                        remote_ssh_pass=self._remote_ssh_pass,
-                        verbose=self._verbose
-                    )
+                )[package_obj.package_build_path]:
+                    raise Exception('Creating build directory failed.')
                 
                 status = run_make_build(
                     package_obj.package_source_path,
                     package_obj.package_build_path,
                     package_obj.package_install_path,
                     package_obj.package_configure_args,
-                    package_patches=package_obj.package_patches,
+                    package_patches=self._get_install_patches(package_obj),
                     is_cmake=True,
                     remote_host=self._remote_host,
                     remote_ssh_port=self._remote_ssh_port,
                     remote_ssh_user=self._remote_ssh_user,
                     remote_ssh_pass=self._remote_ssh_pass,
-                    verbose=self._verbose
+                    verbose=self._verbose,
+                    log_file=build_log_file,
+                    line_callback=package_obj.line_callback,
+                    error_classifier=self._build_error_classifier,
+                    fail_fast=self._build_fail_fast
                 )
             elif package_obj.package_build_type == "distutils":
                 status = run_distutils_build(
                     package_obj.package_source_path,
-                    package_patches=package_obj.package_patches,
+                    package_patches=self._get_install_patches(package_obj),
                     remote_host=self._remote_host,
                     remote_ssh_port=self._remote_ssh_port,
                     remote_ssh_user=self._remote_ssh_user,
                     remote_ssh_pass=self._remote_ssh_pass,
-                    verbose=self._verbose
+                    verbose=self._verbose,
+                    log_file=build_log_file,
+                    line_callback=package_obj.line_callback,
+                    error_classifier=self._build_error_classifier,
+                    fail_fast=self._build_fail_fast
                 )
             else:
                 raise Exception(
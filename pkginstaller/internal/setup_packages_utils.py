@@ -8,6 +8,42 @@ from pkginstaller.internal.setup_utils import *
 
 logger = logging.getLogger('pkginstaller.setup_packages_utils')
 
+# Output lines of configure, build and install commands which report fatal
+# error, build can not succeed after any of them.
+BUILD_FATAL_ERROR_RE_PATTERNS = [
+    r'fatal error:',
+    r'^\S+:\d+(:\d+)?: error: ',
+    r'^configure: error: ',
+    r'^CMake Error',
+    r'^make(\[\d+\])?: \*\*\* ',
+    r'ld returned \d+ exit status',
+    r'^error: '
+]
+_build_fatal_error_re = re.compile('|'.join(BUILD_FATAL_ERROR_RE_PATTERNS))
+
+
+def classify_build_error(stream_name, line):
+    """Default error classifier of package build commands.
+
+    Args:
+        stream_name (str): Output stream name, stdout or stderr.
+        line (str): Output line of command.
+
+    Returns:
+        str: line if it matches any of BUILD_FATAL_ERROR_RE_PATTERNS else
+            None.
+
+    """
+    if _build_fatal_error_re.search(line):
+        return line.strip()
+    return None
+
+def _get_build_error(output):
+    # Classified errors are more precise than output tail.
+    if output.errors:
+        return '\n'.join(output.errors)
+    return output.stderr or output.stdout
+
 
 def run_make_configure_cmd(
     src_dir,
@@ -19,7 +55,11 @@ def run_make_configure_cmd(
     remote_ssh_port = 22,
     remote_ssh_user = None,
     remote_ssh_pass = None,
-    verbose = 0
+    verbose = 0,
+    log_file = None,
+    line_callback = None,
+    error_classifier = classify_build_error,
+    fail_fast = False
 ):
     optional_argument = configure_args
     configure_file = configure_cmd
@@ -31,24 +71,31 @@ def run_make_configure_cmd(
 
     if verbose > 0:
         print('[MAKE] Configuration package...')
-    stdout, stderr = run_command(
+    output = CommandOutput(
+        log_file=log_file,
+        line_callback=line_callback,
+        error_classifier=error_classifier
+    )
+    run_command(
         configure_cmd,
         build_dir,
         remote_host=remote_host,
         remote_ssh_port=remote_ssh_port,
         remote_ssh_user=remote_ssh_user,
         remote_ssh_pass=remote_ssh_pass,
-        verbose=verbose
+        verbose=verbose,
+        output=output,
+        fail_fast=fail_fast
     )
-    if "error " in stderr or "Error " in stderr or "ERROR " in stderr:
+    if output.exit_status != 0:
         if verbose > 0:
             print('[MAKE] Configuration was failed.')
-        print('Error  {}'.format(stderr))
+        print('Error  {}'.format(_get_build_error(output)))
         return False
     else:
         if verbose > 0:
             print('[MAKE] Configuration was successed.')
-        logger.debug('Configuration output %s', stdout)
+        logger.debug('Configuration output %s', output.stdout)
         return True
 
 def run_cmake_configure_cmd(
@@ -60,7 +107,11 @@ def run_cmake_configure_cmd(
     remote_ssh_port = 22,
     remote_ssh_user = None,
     remote_ssh_pass = None,
-    verbose = 0
+    verbose = 0,
+    log_file = None,
+    line_callback = None,
+    error_classifier = classify_build_error,
+    fail_fast = False
 ):
     optional_argument = configure_args
 
@@ -70,24 +121,31 @@ def run_cmake_configure_cmd(
 
     if verbose > 0:
         print('[CMAKE] Configuration package...')
-    stdout, stderr = run_command(
+    output = CommandOutput(
+        log_file=log_file,
+        line_callback=line_callback,
+        error_classifier=error_classifier
+    )
+    run_command(
         configure_cmd,
         build_dir,
         remote_host=remote_host,
         remote_ssh_port=remote_ssh_port,
         remote_ssh_user=remote_ssh_user,
         remote_ssh_pass=remote_ssh_pass,
-        verbose=verbose
+        verbose=verbose,
+        output=output,
+        fail_fast=fail_fast
     )
-    if "error " in stderr or "Error " in stderr or "ERROR " in stderr:
+    if output.exit_status != 0:
         if verbose > 0:
             print('[CMAKE] Configuration was failed.')
-        print('Error  {}'.format(stderr))
+        print('Error  {}'.format(_get_build_error(output)))
         return False
     else:
         if verbose > 0:
             print('[CMAKE] Configuration was successed.')
-        logger.debug('Configuration output %s', stdout)
+        logger.debug('Configuration output %s', output.stdout)
         return True
 
 def run_make_build_cmd(
@@ -96,24 +154,35 @@ def run_make_build_cmd(
     remote_ssh_port = 22,
     remote_ssh_user = None,
     remote_ssh_pass = None,
-    verbose = 0 
+    verbose = 0,
+    log_file = None,
+    line_callback = None,
+    error_classifier = classify_build_error,
+    fail_fast = False
 ):
     build_cmd = ['make']
     if verbose > 0:
         print('[MAKE] Building package...')
-    stdout, stderr = run_command(
+    output = CommandOutput(
+        log_file=log_file,
+        line_callback=line_callback,
+        error_classifier=error_classifier
+    )
+    run_command(
         build_cmd,
         build_dir,
         remote_host=remote_host,
         remote_ssh_port=remote_ssh_port,
         remote_ssh_user=remote_ssh_user,
         remote_ssh_pass=remote_ssh_pass,
-        verbose=verbose
+        verbose=verbose,
+        output=output,
+        fail_fast=fail_fast
     )
-    if "error " in stderr or "Error " in stderr or "ERROR " in stderr:
+    if output.exit_status != 0:
         if verbose > 0:
             print('[MAKE] Build was failed.')
-        print('Error  {}'.format(stderr))
+        print('Error  {}'.format(_get_build_error(output)))
         return False
     else:
         if verbose > 0:
@@ -126,24 +195,35 @@ def run_make_install_cmd(
     remote_ssh_port = 22,
     remote_ssh_user = None,
     remote_ssh_pass = None,
-    verbose = 0
+    verbose = 0,
+    log_file = None,
+    line_callback = None,
+    error_classifier = classify_build_error,
+    fail_fast = False
 ):
     install_cmd = ['make', 'install']
     if verbose > 0:
         print('[MAKE] Installing package...')
-    stdout, stderr = run_command(
+    output = CommandOutput(
+        log_file=log_file,
+        line_callback=line_callback,
+        error_classifier=error_classifier
+    )
+    run_command(
         install_cmd,
         build_dir,
         remote_host=remote_host,
         remote_ssh_port=remote_ssh_port,
         remote_ssh_user=remote_ssh_user,
         remote_ssh_pass=remote_ssh_pass,
-        verbose=verbose
+        verbose=verbose,
+        output=output,
+        fail_fast=fail_fast
     )
-    if "error " in stderr or "Error " in stderr or "ERROR " in stderr:
+    if output.exit_status != 0:
         if verbose > 0:
             print('[MAKE] Installation was failed.')
-        print('Error  {}'.format(stderr))
+        print('Error  {}'.format(_get_build_error(output)))
         return False
     else:
         if verbose > 0:
@@ -162,7 +242,11 @@ def run_make_build(
     remote_ssh_port = 22,
     remote_ssh_user = None,
     remote_ssh_pass = None,
-    verbose = 0
+    verbose = 0,
+    log_file = None,
+    line_callback = None,
+    error_classifier = classify_build_error,
+    fail_fast = False
 ):
 
     logger.debug(
@@ -181,7 +265,9 @@ def run_make_build(
             remote_ssh_port=remote_ssh_port,
             remote_ssh_user=remote_ssh_user,
             remote_ssh_pass=remote_ssh_pass,
-            verbose=verbose
+            verbose=verbose,
+            log_file=log_file,
+            line_callback=line_callback
         )
     
     # Configuring package.
@@ -196,7 +282,11 @@ def run_make_build(
             remote_ssh_port=remote_ssh_port,
             remote_ssh_user=remote_ssh_user,
             remote_ssh_pass=remote_ssh_pass,
-            verbose=verbose
+            verbose=verbose,
+            log_file=log_file,
+            line_callback=line_callback,
+            error_classifier=error_classifier,
+            fail_fast=fail_fast
         )
     else:
         status = run_make_configure_cmd(
@@ -209,7 +299,11 @@ def run_make_build(
             remote_ssh_port=remote_ssh_port,
             remote_ssh_user=remote_ssh_user,
             remote_ssh_pass=remote_ssh_pass,
-            verbose=verbose
+            verbose=verbose,
+            log_file=log_file,
+            line_callback=line_callback,
+            error_classifier=error_classifier,
+            fail_fast=fail_fast
         )
 
     if status == False:
@@ -224,7 +318,11 @@ def run_make_build(
         remote_ssh_port=remote_ssh_port,
         remote_ssh_user=remote_ssh_user,
         remote_ssh_pass=remote_ssh_pass,
-        verbose=verbose
+        verbose=verbose,
+        log_file=log_file,
+        line_callback=line_callback,
+        error_classifier=error_classifier,
+        fail_fast=fail_fast
     ) == False:
         if verbose > 0:
             print('Building package failed.')
@@ -237,7 +335,11 @@ def run_make_build(
         remote_ssh_port=remote_ssh_port,
         remote_ssh_user=remote_ssh_user,
         remote_ssh_pass=remote_ssh_pass,
-        verbose=verbose
+        verbose=verbose,
+        log_file=log_file,
+        line_callback=line_callback,
+        error_classifier=error_classifier,
+        fail_fast=fail_fast
     ) == False:
         if verbose > 0:
             print('Installing package failed.')
@@ -252,7 +354,11 @@ def run_distutils_build(
     remote_ssh_port = 22,
     remote_ssh_user = None,
     remote_ssh_pass = None,
-    verbose = 0
+    verbose = 0,
+    log_file = None,
+    line_callback = None,
+    error_classifier = classify_build_error,
+    fail_fast = False
 ):
     # Applying patches
     for patch in package_patches:
@@ -263,7 +369,9 @@ def run_distutils_build(
             remote_ssh_port=remote_ssh_port,
             remote_ssh_user=remote_ssh_user,
             remote_ssh_pass=remote_ssh_pass,
-            verbose=verbose
+            verbose=verbose,
+            log_file=log_file,
+            line_callback=line_callback
         )
 
     # distutils installation.
@@ -271,19 +379,26 @@ def run_distutils_build(
 
     if verbose > 0:
         print('[DISTUTILS] Installing package...')
-    stdout, stderr = run_command(
+    output = CommandOutput(
+        log_file=log_file,
+        line_callback=line_callback,
+        error_classifier=error_classifier
+    )
+    run_command(
         install_cmd,
         pkg_source_path,
         remote_host=remote_host,
         remote_ssh_port=remote_ssh_port,
         remote_ssh_user=remote_ssh_user,
         remote_ssh_pass=remote_ssh_pass,
-        verbose=verbose
+        verbose=verbose,
+        output=output,
+        fail_fast=fail_fast
     )
-    if "error " in stderr or "Error " in stderr or "ERROR " in stderr:
+    if output.exit_status != 0:
         if verbose > 0:
             print('[DISTUTILS] Installation was failed.')
-        print('Error  {}'.format(stderr))
+        print('Error  {}'.format(_get_build_error(output)))
         return False
     else:
         if verbose > 0:
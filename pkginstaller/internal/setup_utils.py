@@ -5,16 +5,171 @@ import re
 import subprocess
 import tarfile
 import urllib.request
+import urllib.error
+import urllib.parse
+import http.client
+import io
+import socket
 import logging
-import paramiko
 import stat
 import shutil
+import threading
+import hashlib
+import time
+import zipfile
+import fnmatch
+import shlex
+import selectors
+import codecs
+import collections
+import signal
+import contextlib
+import atexit
+import tempfile
+import queue
 
-from fcntl import fcntl, F_GETFL, F_SETFL
-from os import O_NONBLOCK, read
+from concurrent.futures import ThreadPoolExecutor
+
+# paramiko is needed only for remote hosts, remote agent runs without it.
+try:
+    import paramiko
+except ImportError:
+    paramiko = None
 
 logger = logging.getLogger('pkginstaller.setup_utils')
 
+# Download metadata such as mirror latencies is kept in the package cache
+# directory, if cache directory is on remote host then it is kept on this host
+# in below directory.
+DOWNLOAD_METADATA_DEFAULT_DIR = os.path.join(
+    os.path.expanduser('~'), '.pkginstaller'
+)
+MIRROR_LATENCY_FILE_NAME = '.mirror_latency.json'
+# Mirrors abandoned by race are recorded slower than race winner by below
+# seconds, their real latency is not known.
+MIRROR_ABANDONED_PENALTY_SECS = 1
+URL_METADATA_FILE_NAME = '.url_metadata.json'
+
+# Segmented download splits file in byte ranges of at least below size.
+DOWNLOAD_SEGMENT_MIN_SIZE = 1024 * 1024
+
+# Archives which can be extracted while they are downloading.
+STREAM_EXTRACT_RE_PATTERN = r'.*(\.tar|\.tar\.bz2|\.tar\.gz|\.tar\.xz)$'
+
+# Archives extracted in process by native extraction engine are read and
+# written in below size of buffers.
+EXTRACT_COPY_BUFFER_SIZE = 1024 * 1024
+
+# Zip archive members are extracted by threads in batches of below number of
+# members or compressed bytes.
+EXTRACT_ZIP_BATCH_MEMBERS = 256
+EXTRACT_ZIP_BATCH_SIZE = 8 * 1024 * 1024
+
+# Archives are extracted in temporary directory of extract location and moved
+# to it after extraction, then completion stamp file ".<package>.extracted.json"
+# recording archive sha256 is written next to extracted package directory.
+EXTRACT_STAMP_FILE_SUFFIX = '.extracted.json'
+ARCHIVE_EXTENSION_RE_PATTERN = \
+    r'(\.git|\.zip|\.tar|\.tar\.bz2|\.tar\.gz|\.tar\.xz|\.tar\.zst)$'
+
+# Extracted and patched source trees are kept in below directory of package
+# cache directory by hash of archive sha256 and its patches sha256, new
+# source trees are copied from them.
+SNAPSHOT_CACHE_DIR_NAME = 'snapshots'
+SNAPSHOT_COPY_MODES = {
+    'reflink': ['cp', '-a', '--reflink=auto'],
+    'hardlink': ['cp', '-al']
+}
+
+# Command output is read in below size of chunks as soon as it is available,
+# only last below number of characters of stdout and stderr are kept in
+# memory.
+RUN_COMMAND_READ_SIZE = 64 * 1024
+COMMAND_OUTPUT_TAIL_SIZE = 1024 * 1024
+# Remote command exit status is checked at least once in below seconds, in case
+# it is received without channel becoming readable.
+RUN_COMMAND_REMOTE_WAIT_SECS = 1
+# Local command exit is checked at least once in below seconds, since pipes
+# inherited by background children are not closed when command exits.
+RUN_COMMAND_LOCAL_WAIT_SECS = 0.1
+# Longer lines are given to line callback and error classifier in parts, only
+# below number of classified errors are kept.
+COMMAND_OUTPUT_MAX_LINE_SIZE = 64 * 1024
+COMMAND_OUTPUT_MAX_ERRORS = 100
+
+# Parallel decompressors of tar archive types in order of preference, first
+# one found on host is used instead of single threaded gzip, bzip2 or xz.
+PARALLEL_DECOMPRESSORS = {
+    '.tar.gz': ['pigz'],
+    '.tar.bz2': ['lbzip2', 'pbzip2'],
+    '.tar.xz': ['xz -T0'],
+    '.tar.zst': ['zstd -T0']
+}
+
+# Interrupted downloads are kept in "<file name>.part" file of content
+# addressed cache directory and resumed later, downloaded offset is recorded
+# in "<file name>.part.json" file after every below number of bytes.
+DOWNLOAD_RESUME_STATE_INTERVAL = 4 * 1024 * 1024
+
+# Downloaded files are stored in content addressed cache, under below
+# directory of package cache directory, by their sha256 and package cache
+# directory file is a symbolic link to it. Index file records learned sha256
+# of every downloaded file name.
+SHA256_CACHE_DIR_NAME = 'sha256'
+SHA256_INDEX_FILE_NAME = 'index.json'
+
+# Serializes read-modify-write of json metadata files between download threads.
+_metadata_file_lock = threading.Lock()
+
+# Decompressor programs found on hosts, (host, port) to program names.
+_host_decompressors = {}
+_host_decompressors_lock = threading.Lock()
+
+# Http and https requests are sent on keep-alive connections pooled per
+# (scheme, host, port), at most below number of connections are opened to one
+# mirror at a time by requests without their own limit.
+HTTP_POOL_MAX_CONNECTIONS_PER_HOST = 8
+HTTP_POOL_MAX_REDIRECTS = 10
+HTTP_REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+_http_pool_lock = threading.Lock()
+_http_pool_max_connections = HTTP_POOL_MAX_CONNECTIONS_PER_HOST
+_http_pool_idle_connections = {}
+_http_pool_semaphores = {}
+
+# SSH transports are authenticated once per (host, port, user) and shared by
+# all remote operations, commands run on channels of pooled transport and
+# sftp sessions are reused. Transports which are not used and idle sftp
+# sessions are closed after below seconds.
+SSH_POOL_MAX_IDLE_SECS = 300
+SSH_POOL_MAX_IDLE_SFTP_SESSIONS_PER_HOST = 8
+SSH_POOL_KEEPALIVE_SECS = 30
+
+# Remote paths given to batch operations are handled by one remote command
+# per below number of paths.
+REMOTE_BATCH_MAX_PATHS = 256
+# Prints stat of $path as parsed by _parse_remote_stat_output.
+_REMOTE_STAT_CMD = 'stat -L -c "%f %s %Y" -- "$path" 2>/dev/null || echo -'
+
+_ssh_pool_lock = threading.Lock()
+_ssh_pool_max_idle_secs = SSH_POOL_MAX_IDLE_SECS
+# Pool key to [transport, number of users, last used time].
+_ssh_pool_transports = {}
+# Pool key to list of [sftp session, last used time].
+_ssh_pool_idle_sftp_sessions = {}
+_ssh_pool_connect_locks = {}
+
+# Remote path stats are cached per (host, port, user) for below seconds, so
+# paths checked again in same run do not need remote round trip. Cached stats
+# of paths changed by this module are removed, and all cached stats of host
+# are removed after command runs on it.
+REMOTE_STAT_CACHE_TTL_SECS = 10
+
+_remote_stat_cache_lock = threading.Lock()
+_remote_stat_cache_ttl_secs = REMOTE_STAT_CACHE_TTL_SECS
+# Pool key to dictionary of path to (stat result or None, expire time).
+_remote_stat_cache = {}
+
 def is_file_downloaded(
     file_name,
     from_location,
@@ -23,7 +178,8 @@ def is_file_downloaded(
     remote_ssh_port=22,
     remote_ssh_user=None,
     remote_ssh_pass=None,
-    verbose=0
+    verbose=0,
+    sha256=None
 ):
     """Checks file downloaded or not at given location on localhost or
        remotehost.
@@ -32,6 +188,8 @@ def is_file_downloaded(
         file_name (str): File name which will download.
         from_location (str): URL to download file.
         to_location (str): Directory path where file will be save.
+        sha256 (str): Expected file sha256, file with known sha256 is checked
+            in content addressed cache without any request to file url.
         remote_host (str): Remote host address if to_location is not local.
         remote_ssh_port (int): Remote host SSH port.
         remote_ssh_user (str): Remote host SSH User name.
@@ -48,15 +206,15 @@ def is_file_downloaded(
         if os.path.exists(to_file):
             logger.info('File exists at %s, checking file size', to_file)
 
-            response = urllib.request.urlopen(from_file)
-            remote_file_size = response.headers['Content-Length'].strip()
+            remote_file_size = get_url_metadata(
+                from_file, get_download_metadata_dir(to_location)
+            )['size']
 
             statinfo = os.stat(to_file)
-            if int(remote_file_size) == statinfo.st_size:
+            if remote_file_size == statinfo.st_size:
                 logger.info('File size %s matches at remote location, '\
                     'skipping download', remote_file_size
                 )
-                response.close()
                 return True
             else:
                 logger.info(
@@ -73,31 +231,25 @@ def is_file_downloaded(
         from_file = os.path.join(from_location, file_name)
         to_file = os.path.join(to_location, file_name)
         
-        t = paramiko.Transport((remote_host, remote_ssh_port))
-        t.connect(username=remote_ssh_user, password=remote_ssh_pass)
-        sftp = paramiko.SFTPClient.from_transport(t)
-            
-        response = urllib.request.urlopen(from_file)
-        remote_file_size = response.headers['Content-Length'].strip()
-        
         statinfo = None
-        try:
-            statinfo = sftp.stat(to_file)
-        except FileNotFoundError:
-            response.close()
-            sftp.close()
-            return False
+        with sftp_session(
+            remote_host, remote_ssh_port, remote_ssh_user, remote_ssh_pass
+        ) as sftp:
+            try:
+                statinfo = sftp.stat(to_file)
+            except FileNotFoundError:
+                return False
+
+        remote_file_size = get_url_metadata(
+            from_file, get_download_metadata_dir(to_location, remote_host)
+        )['size']
             
-        if int(remote_file_size) == statinfo.st_size:
+        if remote_file_size == statinfo.st_size:
             logger.info('File size %s matches at remote location, '\
                 'skipping download', remote_file_size
             )
-            response.close()
-            sftp.close()
             return True
         
-        response.close()
-        sftp.close()
         return False
 
     def _is_git_repo_exist_on_localhost(file_name, from_location, to_location):
@@ -117,11 +269,10 @@ def is_file_downloaded(
         git_repo = os.path.join(to_location, file_name, '.git')
         
         try:
-            t = paramiko.Transport((remote_host, remote_ssh_port))
-            t.connect(username=remote_ssh_user, password=remote_ssh_pass)
-            sftp = paramiko.SFTPClient.from_transport(t)
-            sftp.stat(git_repo)
-            sftp.close()
+            with sftp_session(
+                remote_host, remote_ssh_port, remote_ssh_user, remote_ssh_pass
+            ) as sftp:
+                sftp.stat(git_repo)
         except FileNotFoundError:
             logger.info('Git repo %s does not exist.', git_repo)
             return False
@@ -130,6 +281,13 @@ def is_file_downloaded(
             return True
 
     # Main code
+    sha256_cache_status = _is_file_in_sha256_cache(
+        file_name, to_location, sha256, remote_host, remote_ssh_port,
+        remote_ssh_user, remote_ssh_pass
+    )
+    if sha256_cache_status is not None:
+        return sha256_cache_status
+
     if remote_host == "localhost" or remote_host == "127.0.0.1":
         if re.match('.*\.git$', file_name):
             return _is_git_repo_exist_on_localhost(
@@ -151,304 +309,2214 @@ def is_file_downloaded(
                 remote_ssh_port, remote_ssh_user, remote_ssh_pass
             )
 
-def download_file(
+def is_file_cached(
     file_name,
-    from_location,
     to_location,
+    sha256=None,
     remote_host='localhost',
     remote_ssh_port=22,
     remote_ssh_user=None,
     remote_ssh_pass=None,
     verbose=0
 ):
-    """Download file and save it to destination on localhost or remotehost
+    """Checks file is in package cache without any request to file url.
+
+    File with declared or learned sha256 is in cache only if content
+    addressed cache has file with that sha256 and to_location file links to
+    it, other files are in cache if they exist.
 
     Args:
         file_name (str): File name which will download.
-        from_location (str): URL to download file.
         to_location (str): Directory path where file will be save.
+        sha256 (str): Expected file sha256.
         remote_host (str): Remote host address if to_location is not local.
         remote_ssh_port (int): Remote host SSH port.
         remote_ssh_user (str): Remote host SSH User name.
         remote_ssh_pass (str): Remote host SSH Password.
 
     Returns:
-        bool: True if file was successfully downloaded otherwise False
-        
+        bool: True if file found otherwise False
+
     """
-  
-    logger.debug(
-        'Downloading file %s from location %s and installing to host %s to'
-        ' location %s', file_name, from_location, remote_host, to_location
+    status = _is_file_in_sha256_cache(
+        file_name, to_location, sha256, remote_host, remote_ssh_port,
+        remote_ssh_user, remote_ssh_pass
     )
-    
-    def _print_downloading_message(bytes_so_far, chunk_size, total_size):
-        downloaded_size = float(bytes_so_far) / total_size
-        downloaded_percentage = round(downloaded_size*100, 2)
-        print("Downloaded {} of {} bytes {}%\r".format(
-            bytes_so_far, total_size, downloaded_percentage), end=''
+    if status is None:
+        return is_path_exists(
+            os.path.join(to_location, file_name),
+            remote_host=remote_host,
+            remote_ssh_port=remote_ssh_port,
+            remote_ssh_user=remote_ssh_user,
+            remote_ssh_pass=remote_ssh_pass,
+            verbose=verbose
         )
-        #sys.stdout.flush()
-        if bytes_so_far >= total_size:
-            print('\n')
+    return status
 
-    def _download_file_to_localhost(
-        file_name, from_location, to_location,
-        chunk_size=8192, report_hook=None
-    ):
-        from_file = os.path.join(from_location, file_name)
-        response = urllib.request.urlopen(from_file)
-        total_size = int(response.headers['Content-Length'].strip())
-        
-        bytes_so_far = 0
+def get_cached_file_sha256(file_name, to_location):
+    """Returns sha256 of file learned when it was downloaded to cache on
+    localhost.
 
-        logger.info('Total file size is %s', total_size)
-        to_file = os.path.join(to_location, file_name)
+    Args:
+        file_name (str): Downloaded file name.
+        to_location (str): Directory path where file is saved.
 
-        # Checks file in cache.
-        if _is_file_exist_at_localhost(from_file, to_file):
-            logger.info('File found in cache.')
-            return total_size
+    Returns:
+        str: Sha256 hex digest, None if file is not downloaded with sha256.
 
-        # Creating parent dirs, if does not exists.
-        if not os.path.exists(to_location):
-            os.makedirs(to_location)
+    """
+    return _read_json_file(_get_sha256_index_path(to_location)).get(file_name)
 
-        if verbose > 0:
-            #Adding newline before printing downloaded message.
-            print('\n', end='')
-        write_file_handler = open(to_file, "wb")
-        while True:
-            chunk = response.read(chunk_size)
-            if not chunk:
-                break
-            
-            bytes_so_far += len(chunk)
-            write_file_handler.write(chunk)
-            write_file_handler.flush()
+def _is_file_in_sha256_cache(
+    file_name, to_location, sha256, remote_host, remote_ssh_port,
+    remote_ssh_user, remote_ssh_pass
+):
+    # Returns None if file sha256 is neither declared nor learned.
+    if re.match('.*\.git$', file_name):
+        return None
 
-            if report_hook and verbose > 0:
-                report_hook(
-                    bytes_so_far, chunk_size, total_size
+    to_file = os.path.join(to_location, file_name)
+    if remote_host == "localhost" or remote_host == "127.0.0.1":
+        expected_sha256 = sha256 or _read_json_file(
+            _get_sha256_index_path(to_location)
+        ).get(file_name)
+        if expected_sha256 is None:
+            return None
+
+        return os.path.islink(to_file) and \
+            os.readlink(to_file) == _get_sha256_link_target(expected_sha256) \
+            and os.path.exists(
+                _get_sha256_object_path(to_location, expected_sha256)
+            )
+    else:
+        with sftp_session(
+            remote_host, remote_ssh_port, remote_ssh_user, remote_ssh_pass
+        ) as sftp:
+            try:
+                expected_sha256 = sha256 or _read_sftp_json_file(
+                    sftp, _get_sha256_index_path(to_location)
+                ).get(file_name)
+                if expected_sha256 is None:
+                    return None
+
+                if sftp.readlink(to_file) != \
+                    _get_sha256_link_target(expected_sha256):
+                    return False
+                sftp.stat(
+                    _get_sha256_object_path(to_location, expected_sha256)
                 )
+                return True
+            except OSError:
+                return False
 
-        write_file_handler.close()
-        response.close()
-        logger.info('Total bytes written to file is %s', bytes_so_far)
-        return bytes_so_far
-    
-    def _download_file_to_remotehost(
-        file_name, from_location, to_location, remote_host, remote_ssh_port,
-        remote_ssh_user, remote_ssh_pass, chunk_size=8192, report_hook=None
-    ):
-        from_file = os.path.join(from_location, file_name)
-        response = urllib.request.urlopen(from_file)
-        total_size = int(response.headers['Content-Length'].strip())
-        bytes_so_far = 0
+def open_url(
+    url, method='GET', headers=None, timeout=None, max_connections=None
+):
+    """Opens url and returns its response.
 
-        logger.info('Total file size is %s', total_size)
-       
-        to_file = os.path.join(to_location, file_name)
+    Http and https urls are requested on pooled keep-alive connections,
+    redirects are followed. Not modified response of conditional request is
+    returned as response, other http errors are raised. Connection is given
+    back to pool when response is read completely or closed.
 
-        # Checks file in cache.
-        if _is_file_exist_at_remotehost(from_file, to_file, remote_host,
-            remote_ssh_port, remote_ssh_user, remote_ssh_pass
-        ):
-            logger.info('File found in cache.')
-            return total_size
+    Args:
+        url (str): URL to open.
+        method (str): Request method.
+        headers (dict): Request headers.
+        timeout (int): Seconds to wait for free connection and for response.
+        max_connections (int): Maximum connections opened to url host by
+            requests with same limit, pool limit is used if it is None.
 
-        t = paramiko.Transport((remote_host, remote_ssh_port))
-        t.connect(username=remote_ssh_user, password=remote_ssh_pass)
-        sftp = paramiko.SFTPClient.from_transport(t)
-        
-        # Creating parent dirs, if does not exists.
-        logger.info('Creating %s directory if does not exist', to_location)
-        mkdirs(to_location, remote_host=remote_host,
-            remote_ssh_port=remote_ssh_port, remote_ssh_user=remote_ssh_user,
-            remote_ssh_pass=remote_ssh_pass, failsafe=False
+    Returns:
+        object: Response object having status, headers, read and close.
+
+    """
+    scheme = urllib.parse.urlsplit(url).scheme.lower()
+    if scheme in ('http', 'https') and not _is_url_proxied(url):
+        return _open_pooled_url(
+            url, method, headers or {}, timeout, max_connections
         )
-        
-        sftp.chdir(path=to_location) 
-        write_file_handler = sftp.open(file_name, "wb")
-        
-        if verbose > 0:
-            #Adding newline before printing downloaded message.
-            print('\n', end='')
-        while True:
-            chunk = response.read(chunk_size)
-            if not chunk:
-                break
-            
-            bytes_so_far += len(chunk)
-            write_file_handler.write(chunk)
 
-            if report_hook and verbose > 0:
-                report_hook(
-                    bytes_so_far, chunk_size, total_size
+    request = urllib.request.Request(
+        url, method=method, headers=headers or {}
+    )
+    try:
+        if timeout is None:
+            return urllib.request.urlopen(request)
+        return urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return e
+        raise
+
+def configure_http_pool(max_connections_per_host=None):
+    """Configures keep-alive connection pool used by all url requests.
+
+    Idle connections are closed, requests which are already sent finish with
+    earlier limit.
+
+    Args:
+        max_connections_per_host (int): Maximum connections opened to one
+            mirror at a time by requests without their own limit, requests
+            wait for free connection after it.
+
+    """
+    global _http_pool_max_connections
+
+    with _http_pool_lock:
+        if max_connections_per_host is not None:
+            if max_connections_per_host < 1:
+                raise ValueError(
+                    'max_connections_per_host must be at least 1, it is '
+                    '{}'.format(max_connections_per_host)
                 )
+            _http_pool_max_connections = max_connections_per_host
+        _http_pool_semaphores.clear()
+        idle_connections = list(_http_pool_idle_connections.values())
+        _http_pool_idle_connections.clear()
 
-        write_file_handler.close()
-        response.close()
-        sftp.close()
-        
-        logger.info('Total bytes written to file is %s', bytes_so_far)
-        return bytes_so_far
+    for connections in idle_connections:
+        for connection in connections:
+            connection.close()
 
-    def _download_git_repo_to_localhost(
-        file_name, from_location, to_location
-    ):
-        git_repo_dir = os.path.join(to_location, file_name)
+class _PooledHTTPResponse:
+    # Response of pooled connection, connection is returned to pool on close
+    # if response is read completely and server keeps it alive.
+    def __init__(self, url, pool_key, connection, response, semaphore):
+        self.url = url
+        self.status = response.status
+        self.code = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        self._pool_key = pool_key
+        self._connection = connection
+        self._response = response
+        self._semaphore = semaphore
 
-        logger.info(
-            'Cloning git repository %s to location %s',
-            from_location, to_location
-        )
-      
-        # Creating parent directories if not exists.
-        if not os.path.exists(to_location):
-            os.makedirs(to_location)
-        
-        from_file = os.path.join(from_location, file_name) 
-        cloning_cmd = ["git", "clone", from_file, file_name]
-        stdout, stderr = run_command(
-            cloning_cmd, to_location, verbose=verbose+1
-        )
-        
-        logger.debug('Git Cloning output %s', stdout)
-        if stderr != "":
-            logger.info('\n%s', stderr)
-            return False
-        
-        logger.info('Git repository cloned successfully.')    
-        return True
+    def read(self, amt=None):
+        data = self._response.read(amt)
+        # Connection is free as soon as body is read, so caller can open next
+        # url of same host before closing this response.
+        if self._response.isclosed():
+            self.close()
+        return data
 
-    def _download_git_repo_to_remotehost(
-        file_name, from_location, to_location, remote_host, remote_ssh_port,
-        remote_ssh_user, remote_ssh_pass
-    ):
-        client = paramiko.SSHClient()
-        client.load_system_host_keys()
-        client.set_missing_host_key_policy(paramiko.WarningPolicy())
-        client.connect(remote_host, remote_ssh_port, remote_ssh_user,
-            remote_ssh_pass)
-        
-        to_file = os.path.join(to_location, file_name)
-        mkdirs(to_file, remote_host=remote_host,
-            remote_ssh_port=remote_ssh_port, remote_ssh_user=remote_ssh_user,
-            remote_ssh_pass=remote_ssh_pass, failsafe=False
-        )
+    def getcode(self):
+        return self.status
 
-        from_file = os.path.join(from_location, file_name)
-        cloning_cmd = "git clone " + from_file + " " + to_file
-        
-        logger.info(
-            'Cloning git repository %s to remotehost %s to location %s, '
-            'cloning command %s',
-            from_location, remote_host, to_location, cloning_cmd
-        )
-        
-        stdin, stdout, stderr = client.exec_command(cloning_cmd)
-        client.close()
-        
-        stdout_str = ""
-        stderr_str = ""
-        for line in stdout:
-            stdout_str += line.strip()
-        for line in stderr:
-            stderr_str += line.strip()
-            
-        logger.debug('Git Cloning output - %s', stdout_str)
+    def geturl(self):
+        return self.url
 
-        if "ERROR" in stderr_str or "Error" in stderr_str:
-            logger.error('Git cloning error - \n%s', stderr_str)
-            return False
-        
-        logger.info('Git repository cloned successfully.')    
-        return True
+    def info(self):
+        return self.headers
 
-    def _is_file_exist_at_localhost(from_file, to_file):
-        if os.path.exists(to_file):
-            logger.info('File exists at %s, checking file size', to_file)
+    def close(self):
+        if self._connection is None:
+            return
+        connection, self._connection = self._connection, None
 
-            response = urllib.request.urlopen(from_file)
-            remote_file_size = response.headers['Content-Length'].strip()
+        # Responses without body are finished by reading them.
+        if not self._response.isclosed() and self._response.length == 0:
+            self._response.read()
+        if self._response.isclosed() and not self._response.will_close:
+            _release_http_connection(self._pool_key, connection)
+        else:
+            self._response.close()
+            connection.close()
+        self._semaphore.release()
 
-            statinfo = os.stat(to_file)
-            if int(remote_file_size) == statinfo.st_size:
-                logger.info('File size %s matches at remote location, '\
-                    'skipping download', remote_file_size
-                )
-                response.close()
-                return True
-            else:
-                logger.info(
-                    'Remote file size %s does not match with local file size '
-                    '%s', remote_file_size, str(statinfo.st_size)
-                )
-                
+def _is_url_proxied(url):
+    # Proxied urls are opened by urllib which knows proxy settings.
+    parsed_url = urllib.parse.urlsplit(url)
+    proxies = urllib.request.getproxies()
+    if parsed_url.scheme.lower() not in proxies:
         return False
+    return not urllib.request.proxy_bypass(parsed_url.hostname or '')
 
-    def _is_file_exist_at_remotehost(from_file, to_file, remote_host,
-        remote_ssh_port, remote_ssh_user, remote_ssh_pass
-    ):
-        t = paramiko.Transport((remote_host, remote_ssh_port))
-        t.connect(username=remote_ssh_user, password=remote_ssh_pass)
-        sftp = paramiko.SFTPClient.from_transport(t)
-            
-        response = urllib.request.urlopen(from_file)
-        remote_file_size = response.headers['Content-Length'].strip()
-        
-        statinfo = None
+def _get_http_pool_semaphore(pool_key, max_connections):
+    # Requests with same connection limit share a semaphore per pool_key.
+    with _http_pool_lock:
+        semaphore_key = (pool_key, max_connections)
+        if semaphore_key not in _http_pool_semaphores:
+            _http_pool_semaphores[semaphore_key] = threading.BoundedSemaphore(
+                max_connections or _http_pool_max_connections
+            )
+        return _http_pool_semaphores[semaphore_key]
+
+def _acquire_http_connection(pool_key):
+    # Returns idle connection of pool_key and True, or new connection and
+    # False if there is no idle connection.
+    with _http_pool_lock:
+        connections = _http_pool_idle_connections.get(pool_key)
+        if connections:
+            return connections.pop(), True
+
+    scheme, host, port = pool_key
+    if scheme == 'https':
+        return http.client.HTTPSConnection(host, port), False
+    return http.client.HTTPConnection(host, port), False
+
+def _release_http_connection(pool_key, connection):
+    with _http_pool_lock:
+        connections = _http_pool_idle_connections.setdefault(pool_key, [])
+        if len(connections) < _http_pool_max_connections:
+            connections.append(connection)
+            return
+    connection.close()
+
+def _send_pooled_request(pool_key, method, path, headers, timeout):
+    connection, is_reused = _acquire_http_connection(pool_key)
+    while True:
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
         try:
-            statinfo = sftp.stat(to_file)
-        except FileNotFoundError:
-            response.close()
-            sftp.close()
-            return False
-            
-        if int(remote_file_size) == statinfo.st_size:
-            logger.info('File size %s matches at remote location, '\
-                'skipping download', remote_file_size
+            connection.request(method, path, headers=headers)
+            return connection, connection.getresponse()
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            if not is_reused:
+                raise
+        # Idle connection was closed by server, request is sent again on
+        # next idle or new connection.
+        logger.info('Reconnecting to %s://%s:%s', *pool_key)
+        connection, is_reused = _acquire_http_connection(pool_key)
+
+def _open_pooled_url(url, method, headers, timeout, max_connections):
+    request_headers = {
+        'User-Agent': 'Python-urllib/{}'.format(urllib.request.__version__)
+    }
+    request_headers.update(headers)
+    if timeout is None:
+        timeout = socket.getdefaulttimeout()
+
+    for redirect_count in range(HTTP_POOL_MAX_REDIRECTS + 1):
+        parsed_url = urllib.parse.urlsplit(url)
+        scheme = parsed_url.scheme.lower()
+        port = parsed_url.port or (443 if scheme == 'https' else 80)
+        pool_key = (scheme, parsed_url.hostname, port)
+        path = parsed_url.path or '/'
+        if parsed_url.query:
+            path += '?' + parsed_url.query
+
+        semaphore = _get_http_pool_semaphore(pool_key, max_connections)
+        if not semaphore.acquire(timeout=timeout):
+            raise TimeoutError(
+                'No free connection to {}://{}:{} in {} secs'.format(
+                *pool_key, timeout)
             )
-            response.close()
-            sftp.close()
-            return True
-        
-        response.close()
-        sftp.close()
-        return False
-    
-    # Main code
-    status = False
-    if remote_host == "localhost" or remote_host == "127.0.0.1":
-        if re.match('.*\.git$', file_name):
-            status = _download_git_repo_to_localhost(
+        try:
+            connection, response = _send_pooled_request(
+                pool_key, method, path, request_headers, timeout
+            )
+        except Exception:
+            semaphore.release()
+            raise
+        pooled_response = _PooledHTTPResponse(
+            url, pool_key, connection, response, semaphore
+        )
+
+        location = response.getheader('Location')
+        if response.status in HTTP_REDIRECT_CODES and location:
+            # Redirect body is read so connection can be reused.
+            pooled_response.read()
+            pooled_response.close()
+            logger.info('Url %s is redirected to %s', url, location)
+            url = urllib.parse.urljoin(url, location)
+            if response.status == 303 and method != 'HEAD':
+                method = 'GET'
+            continue
+
+        if response.status >= 400:
+            error_body = pooled_response.read()
+            pooled_response.close()
+            raise urllib.error.HTTPError(
+                url, response.status, response.reason, response.headers,
+                io.BytesIO(error_body)
+            )
+        return pooled_response
+
+    raise urllib.error.HTTPError(
+        url, response.status, 'Too many redirects', response.headers, None
+    )
+
+def configure_ssh_pool(max_idle_secs=None):
+    """Configures SSH connection pool used by all remote operations.
+
+    Transports and sftp sessions which are idle for more than max_idle_secs
+    are closed.
+
+    Args:
+        max_idle_secs (int): Seconds after which unused transports and idle
+            sftp sessions are closed.
+
+    """
+    global _ssh_pool_max_idle_secs
+
+    if max_idle_secs is not None:
+        if max_idle_secs < 0:
+            raise ValueError(
+                'max_idle_secs must not be negative, it is {}'.format(
+                    max_idle_secs
+                )
+            )
+        with _ssh_pool_lock:
+            _ssh_pool_max_idle_secs = max_idle_secs
+    _evict_idle_ssh_connections()
+
+def close_ssh_pool():
+    """Closes all pooled SSH transports and sftp sessions.
+
+    Operations which are using pooled transport fail, later operations open
+    new transports.
+    """
+    with _ssh_pool_lock:
+        sftp_sessions = [
+            sftp for sessions in _ssh_pool_idle_sftp_sessions.values()
+            for sftp, last_used in sessions
+        ]
+        transports = [
+            entry[0] for entry in _ssh_pool_transports.values()
+        ]
+        _ssh_pool_idle_sftp_sessions.clear()
+        _ssh_pool_transports.clear()
+
+    for sftp in sftp_sessions:
+        sftp.close()
+    for transport in transports:
+        transport.close()
+
+atexit.register(close_ssh_pool)
+
+@contextlib.contextmanager
+def ssh_transport(remote_host, remote_ssh_port, remote_ssh_user,
+    remote_ssh_pass):
+    """Context manager of pooled and authenticated SSH transport.
+
+    Transport is checked before it is given, and it is reconnected if it is
+    not active. Transport is shared, channels opened on it must be closed by
+    caller.
+
+    Args:
+        remote_host (str): Remote host address.
+        remote_ssh_port (int): Remote host SSH port.
+        remote_ssh_user (str): Remote host SSH User name.
+        remote_ssh_pass (str): Remote host SSH Password.
+
+    Yields:
+        paramiko.Transport: Authenticated transport.
+
+    """
+    pool_key = (remote_host, remote_ssh_port, remote_ssh_user)
+    transport = _acquire_ssh_transport(pool_key, remote_ssh_pass)
+    try:
+        yield transport
+    finally:
+        _release_ssh_transport(pool_key)
+
+@contextlib.contextmanager
+def sftp_session(remote_host, remote_ssh_port, remote_ssh_user,
+    remote_ssh_pass):
+    """Context manager of pooled sftp session.
+
+    Session is returned to pool when context exits, unless it exits with
+    error other than sftp operation error.
+
+    Args:
+        remote_host (str): Remote host address.
+        remote_ssh_port (int): Remote host SSH port.
+        remote_ssh_user (str): Remote host SSH User name.
+        remote_ssh_pass (str): Remote host SSH Password.
+
+    Yields:
+        paramiko.SFTPClient: Sftp session.
+
+    """
+    pool_key = (remote_host, remote_ssh_port, remote_ssh_user)
+    transport = _acquire_ssh_transport(pool_key, remote_ssh_pass)
+    sftp = None
+    is_reusable = False
+    try:
+        sftp = _acquire_sftp_session(pool_key, transport)
+        yield sftp
+        is_reusable = True
+    except OSError:
+        # Sftp status errors like missing files do not break session.
+        is_reusable = True
+        raise
+    finally:
+        if sftp is not None:
+            _release_sftp_session(pool_key, sftp, is_reusable)
+        _release_ssh_transport(pool_key)
+
+def _is_ssh_transport_healthy(transport):
+    return transport.is_active() and transport.is_authenticated()
+
+def _is_sftp_session_healthy(sftp):
+    channel = sftp.get_channel()
+    return not channel.closed and \
+        _is_ssh_transport_healthy(channel.get_transport())
+
+def _connect_ssh_transport(pool_key, remote_ssh_pass):
+    remote_host, remote_ssh_port, remote_ssh_user = pool_key
+    if paramiko is None:
+        raise ImportError(
+            'paramiko is required for remote host {}'.format(remote_host)
+        )
+    logger.debug(
+        'Connecting to %s@%s:%s', remote_ssh_user, remote_host,
+        remote_ssh_port
+    )
+    transport = paramiko.Transport((remote_host, remote_ssh_port))
+    transport.set_keepalive(SSH_POOL_KEEPALIVE_SECS)
+    try:
+        transport.connect(username=remote_ssh_user, password=remote_ssh_pass)
+    except Exception:
+        transport.close()
+        raise
+    return transport
+
+def _acquire_ssh_transport(pool_key, remote_ssh_pass):
+    _evict_idle_ssh_connections()
+    with _ssh_pool_lock:
+        connect_lock = _ssh_pool_connect_locks.setdefault(
+            pool_key, threading.Lock()
+        )
+
+    # Threads of same host wait for single handshake.
+    with connect_lock:
+        with _ssh_pool_lock:
+            entry = _ssh_pool_transports.get(pool_key)
+            if entry is not None and _is_ssh_transport_healthy(entry[0]):
+                entry[1] += 1
+                return entry[0]
+            stale_entry = _ssh_pool_transports.pop(pool_key, None)
+            stale_sftp_sessions = _ssh_pool_idle_sftp_sessions.pop(
+                pool_key, []
+            )
+
+        if stale_entry is not None:
+            logger.info('Reconnecting inactive transport of %s', pool_key)
+            for sftp, last_used in stale_sftp_sessions:
+                sftp.close()
+            stale_entry[0].close()
+
+        transport = _connect_ssh_transport(pool_key, remote_ssh_pass)
+        with _ssh_pool_lock:
+            # Users of replaced transport are still counted.
+            users = stale_entry[1] if stale_entry is not None else 0
+            _ssh_pool_transports[pool_key] = [
+                transport, users + 1, time.time()
+            ]
+        return transport
+
+def _release_ssh_transport(pool_key):
+    with _ssh_pool_lock:
+        entry = _ssh_pool_transports.get(pool_key)
+        if entry is not None:
+            entry[1] = max(entry[1] - 1, 0)
+            entry[2] = time.time()
+
+def _acquire_sftp_session(pool_key, transport):
+    with _ssh_pool_lock:
+        sessions = _ssh_pool_idle_sftp_sessions.get(pool_key, [])
+        while sessions:
+            sftp, last_used = sessions.pop()
+            if sftp.get_channel().get_transport() is transport and \
+                _is_sftp_session_healthy(sftp):
+                return sftp
+            sftp.close()
+    return paramiko.SFTPClient.from_transport(transport)
+
+def _release_sftp_session(pool_key, sftp, is_reusable):
+    if is_reusable and _is_sftp_session_healthy(sftp):
+        with _ssh_pool_lock:
+            sessions = _ssh_pool_idle_sftp_sessions.setdefault(pool_key, [])
+            if len(sessions) < SSH_POOL_MAX_IDLE_SFTP_SESSIONS_PER_HOST:
+                sessions.append([sftp, time.time()])
+                return
+    sftp.close()
+
+def _evict_idle_ssh_connections():
+    expired_sftp_sessions = []
+    expired_transports = []
+    with _ssh_pool_lock:
+        expire_time = time.time() - _ssh_pool_max_idle_secs
+        for pool_key, sessions in _ssh_pool_idle_sftp_sessions.items():
+            expired_sftp_sessions.extend(
+                sftp for sftp, last_used in sessions
+                if last_used < expire_time
+            )
+            sessions[:] = [
+                session for session in sessions if session[1] >= expire_time
+            ]
+        for pool_key, entry in list(_ssh_pool_transports.items()):
+            if entry[1] == 0 and entry[2] < expire_time:
+                del _ssh_pool_transports[pool_key]
+                expired_sftp_sessions.extend(
+                    sftp for sftp, last_used in
+                    _ssh_pool_idle_sftp_sessions.pop(pool_key, [])
+                )
+                expired_transports.append(entry[0])
+
+    for sftp in expired_sftp_sessions:
+        sftp.close()
+    for transport in expired_transports:
+        logger.debug('Closing idle transport %s', transport)
+        transport.close()
+
+def configure_remote_stat_cache(ttl_secs=None):
+    """Configures cache of remote path stats.
+
+    Args:
+        ttl_secs (int): Seconds for which stat of remote path is cached, 0
+            disables cache.
+
+    """
+    global _remote_stat_cache_ttl_secs
+
+    if ttl_secs is not None:
+        if ttl_secs < 0:
+            raise ValueError(
+                'ttl_secs must not be negative, it is {}'.format(ttl_secs)
+            )
+        with _remote_stat_cache_lock:
+            _remote_stat_cache_ttl_secs = ttl_secs
+            _remote_stat_cache.clear()
+
+def invalidate_remote_stats(
+    paths=None,
+    remote_host="localhost",
+    remote_ssh_port=22,
+    remote_ssh_user=None
+):
+    """Removes cached stats of remote paths.
+
+    Stats of paths, of their parent directories and of paths under them are
+    removed. Paths changed on remote host other than by this module should
+    be invalidated by caller.
+
+    Args:
+        paths (list): Changed paths, all cached stats of host are removed if
+            it is None.
+        remote_host (str): Remote host address.
+        remote_ssh_port (int): Remote host SSH port.
+        remote_ssh_user (str): Remote host SSH User name.
+
+    """
+    if remote_host == "localhost" or remote_host == "127.0.0.1":
+        return
+
+    pool_key = (remote_host, remote_ssh_port, remote_ssh_user)
+    with _remote_stat_cache_lock:
+        if paths is None:
+            _remote_stat_cache.pop(pool_key, None)
+            return
+        host_cache = _remote_stat_cache.get(pool_key)
+        if not host_cache:
+            return
+        for path in paths:
+            path = os.path.normpath(path)
+            parent_paths = set()
+            parent_path = os.path.dirname(path)
+            while parent_path not in parent_paths and parent_path:
+                parent_paths.add(parent_path)
+                parent_path = os.path.dirname(parent_path)
+            child_prefix = path.rstrip('/') + '/'
+            for cached_path in list(host_cache):
+                if cached_path == path or cached_path in parent_paths or \
+                    cached_path.startswith(child_prefix):
+                    del host_cache[cached_path]
+
+def _get_cached_remote_stats(pool_key, paths):
+    # Returns path to stat result or None of paths found in cache.
+    path_stats = {}
+    curr_time = time.time()
+    with _remote_stat_cache_lock:
+        host_cache = _remote_stat_cache.get(pool_key, {})
+        for path in paths:
+            entry = host_cache.get(os.path.normpath(path))
+            if entry is not None and entry[1] > curr_time:
+                path_stats[path] = entry[0]
+    return path_stats
+
+def _cache_remote_stats(pool_key, path_stats):
+    with _remote_stat_cache_lock:
+        if _remote_stat_cache_ttl_secs == 0:
+            return
+        expire_time = time.time() + _remote_stat_cache_ttl_secs
+        host_cache = _remote_stat_cache.setdefault(pool_key, {})
+        for path, path_stat in path_stats.items():
+            host_cache[os.path.normpath(path)] = (path_stat, expire_time)
+
+def get_url_metadata(
+    url, metadata_dir=None, timeout=None, max_connections=None
+):
+    """Returns size, ETag and Last-Modified of url without downloading it.
+
+    HEAD request is sent to url, it is conditional request if url metadata
+    was recorded in metadata_dir before, and recorded metadata is used when
+    url is not modified.
+
+    Args:
+        url (str): File URL.
+        metadata_dir (str): Directory where url metadata is recorded, it is
+            not recorded if it is None.
+        timeout (int): Seconds to wait for response.
+        max_connections (int): Maximum connections opened to url host, see
+            open_url.
+
+    Returns:
+        dict: url metadata with keys size, etag, last_modified and
+            accept_ranges, value is None if it is not known.
+
+    """
+    recorded_metadata = None
+    if metadata_dir is not None:
+        recorded_metadata = _read_json_file(
+            os.path.join(metadata_dir, URL_METADATA_FILE_NAME)
+        ).get(url)
+
+    headers = _get_conditional_request_headers(recorded_metadata)
+    try:
+        response = open_url(url, 'HEAD', headers, timeout, max_connections)
+    except urllib.error.HTTPError as e:
+        if e.code not in (405, 501):
+            raise
+        # Server does not allow HEAD, requesting first byte only.
+        logger.info('HEAD request is not allowed for %s', url)
+        headers['Range'] = 'bytes=0-0'
+        response = open_url(url, 'GET', headers, timeout, max_connections)
+    response.close()
+
+    if getattr(response, 'status', None) == 304:
+        logger.info('Url %s is not modified', url)
+        return recorded_metadata
+
+    metadata = _get_response_metadata(response)
+    logger.info('Url %s metadata is %s', url, metadata)
+    if metadata_dir is not None:
+        _record_url_metadata(url, metadata, metadata_dir)
+    return metadata
+
+def _download_url_to_part_file(
+    from_file, part_file, sftp=None, chunk_size=8192, report_hook=None,
+    chunk_sink=None, max_connections=None, verbose=0
+):
+    # Downloads url to part file on localhost, or on remotehost if sftp is
+    # given, resuming earlier partial download of any url with same size.
+    # Every file byte from start of file is also written to chunk_sink if it
+    # is given. Returns tuple of file sha256, file size and url metadata,
+    # sha256 is None if url did not send whole file.
+    resume_file = part_file + '.json'
+
+    def _open_file(file_path, mode):
+        if sftp is None:
+            return open(file_path, mode)
+        return sftp.open(file_path, mode)
+
+    def _get_file_size(file_path):
+        try:
+            if sftp is None:
+                return os.stat(file_path).st_size
+            return sftp.stat(file_path).st_size
+        except OSError:
+            return 0
+
+    def _write_resume_state(resume_state):
+        if sftp is None:
+            _write_json_file(resume_file, resume_state)
+        else:
+            _write_sftp_json_file(sftp, resume_file, resume_state)
+
+    resume_state = {}
+    part_file_size = _get_file_size(part_file)
+    if part_file_size > 0:
+        if sftp is None:
+            resume_state = _read_json_file(resume_file)
+        else:
+            resume_state = _read_sftp_json_file(sftp, resume_file)
+    offset = min(resume_state.get('offset', 0), part_file_size)
+
+    headers = {}
+    if offset > 0:
+        headers['Range'] = 'bytes={}-'.format(offset)
+        # Validators are only valid for url which sent partial file.
+        if resume_state.get('url') == from_file:
+            validator = _get_range_validator(resume_state)
+            if validator:
+                headers['If-Range'] = validator
+
+    response = open_url(
+        from_file, headers=headers, max_connections=max_connections
+    )
+    response_metadata = _get_response_metadata(response)
+    total_size = response_metadata['size']
+    logger.info('Total file size is %s', total_size)
+
+    sha256_obj = hashlib.sha256()
+    content_range = response.headers.get('Content-Range') or ''
+    is_resumed = offset > 0 and getattr(response, 'status', None) == 206 and \
+        content_range.startswith('bytes {}-'.format(offset)) and \
+        total_size == resume_state.get('size')
+    if offset > 0 and not is_resumed and \
+        getattr(response, 'status', None) == 206:
+        # Part file is of another file, whole file is requested again.
+        logger.info(
+            'Discarding partial download of %s, it does not match url',
+            from_file
+        )
+        response.close()
+        response = open_url(from_file, max_connections=max_connections)
+        response_metadata = _get_response_metadata(response)
+        total_size = response_metadata['size']
+
+    if is_resumed:
+        logger.info('Resuming download of %s at byte %s', from_file, offset)
+        write_file_handler = _open_file(part_file, 'r+b')
+        # Already downloaded bytes are read back to compute sha256.
+        bytes_to_hash = offset
+        while bytes_to_hash > 0:
+            chunk = write_file_handler.read(min(1024 * 1024, bytes_to_hash))
+            if not chunk:
+                break
+            sha256_obj.update(chunk)
+            if chunk_sink is not None:
+                chunk_sink.write(chunk)
+            bytes_to_hash -= len(chunk)
+        write_file_handler.truncate(offset)
+        write_file_handler.seek(offset)
+    else:
+        offset = 0
+        write_file_handler = _open_file(part_file, 'wb')
+
+    resume_state = {
+        'url': from_file,
+        'size': total_size,
+        'etag': response_metadata['etag'],
+        'last_modified': response_metadata['last_modified'],
+        'offset': offset
+    }
+    _write_resume_state(resume_state)
+
+    bytes_so_far = offset
+    try:
+        while True:
+            chunk = response.read(chunk_size)
+            if not chunk:
+                break
+
+            bytes_so_far += len(chunk)
+            sha256_obj.update(chunk)
+            write_file_handler.write(chunk)
+            if chunk_sink is not None:
+                chunk_sink.write(chunk)
+
+            if bytes_so_far - resume_state['offset'] >= \
+                DOWNLOAD_RESUME_STATE_INTERVAL:
+                write_file_handler.flush()
+                resume_state['offset'] = bytes_so_far
+                _write_resume_state(resume_state)
+
+            if report_hook and verbose > 0:
+                report_hook(
+                    bytes_so_far, chunk_size, total_size
+                )
+    finally:
+        write_file_handler.close()
+        response.close()
+        resume_state['offset'] = bytes_so_far
+        _write_resume_state(resume_state)
+
+    if total_size is not None and bytes_so_far != total_size:
+        logger.error(
+            'Download of %s is incomplete, %s of %s bytes downloaded',
+            from_file, bytes_so_far, total_size
+        )
+        return None, bytes_so_far, response_metadata
+
+    if sftp is None:
+        os.remove(resume_file)
+    else:
+        sftp.remove(resume_file)
+    return sha256_obj.hexdigest(), bytes_so_far, response_metadata
+
+class _StreamExtractor:
+    # Extracts tar archive in a thread from bytes written to it. Archive is
+    # extracted in temporary directory of extract_path and moved in
+    # extract_path by finish(), abort() discards it. Extraction errors are
+    # logged and leave extract_path unchanged, so file can still be
+    # extracted from cache.
+    def __init__(self, file_name, extract_path):
+        self.file_name = file_name
+        self.extract_path = extract_path
+        self.temp_path = os.path.join(
+            extract_path, _get_temp_file_name(file_name)
+        )
+        os.makedirs(self.temp_path)
+
+        read_fd, write_fd = os.pipe()
+        self._reader = os.fdopen(read_fd, 'rb')
+        self._writer = os.fdopen(write_fd, 'wb')
+        self._is_reader_closed = False
+        self._error = None
+        self._thread = threading.Thread(
+            target=self._extract, name='extract-' + file_name, daemon=True
+        )
+        self._thread.start()
+
+    def _extract(self):
+        try:
+            with tarfile.open(fileobj=self._reader, mode='r|*') as tar:
+                if hasattr(tarfile, 'tar_filter'):
+                    tar.extractall(self.temp_path, filter='tar')
+                else:
+                    tar.extractall(self.temp_path)
+            # Trailing padding is read so writer never blocks.
+            while self._reader.read(65536):
+                pass
+        except Exception as e:
+            self._error = e
+        finally:
+            self._reader.close()
+
+    def write(self, chunk):
+        if self._is_reader_closed:
+            return
+        try:
+            self._writer.write(chunk)
+        except BrokenPipeError:
+            # Extraction thread has failed and stopped reading.
+            self._is_reader_closed = True
+
+    def _close(self):
+        try:
+            self._writer.close()
+        except BrokenPipeError:
+            pass
+        self._thread.join()
+
+    def finish(self, file_sha256):
+        self._close()
+        if self._error is not None:
+            logger.error(
+                'Error in extracting file %s while downloading - %s',
+                self.file_name, self._error
+            )
+            self.abort()
+            return False
+
+        _finish_staged_extraction(
+            self.file_name, self.temp_path, self.extract_path,
+            {'file_name': self.file_name, 'sha256': file_sha256, 'patches': []},
+            'localhost', None, None, None
+        )
+        logger.info(
+            'File %s has extracted successfully at %s while downloading',
+            self.file_name, self.extract_path
+        )
+        return True
+
+    def abort(self):
+        self._close()
+        shutil.rmtree(self.temp_path, ignore_errors=True)
+
+def _get_download_segments(url_metadata, segments):
+    # Number of segments which can be downloaded in parallel for url.
+    if not url_metadata.get('accept_ranges') or not url_metadata.get('size'):
+        return 1
+    return max(1, min(
+        segments, url_metadata['size'] // DOWNLOAD_SEGMENT_MIN_SIZE
+    ))
+
+def _get_range_validator(url_metadata):
+    # Returns If-Range header value of url metadata, weak ETag can not be
+    # used in If-Range.
+    etag = url_metadata.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return url_metadata.get('last_modified')
+
+def _download_url_segments(
+    from_file, file_path, file_size, segments, chunk_size=65536,
+    report_hook=None, validator=None, max_connections=None, verbose=0
+):
+    # Downloads file byte ranges in parallel connections and writes them at
+    # their position in preallocated file on localhost. Ranges are requested
+    # with If-Range validator if it is given, download is aborted when any
+    # range is not served, e.g. because url has changed.
+    logger.info(
+        'Downloading %s in %s segments, total file size is %s',
+        from_file, segments, file_size
+    )
+
+    # Earlier single stream partial download can not be resumed any more.
+    if os.path.exists(file_path + '.json'):
+        os.remove(file_path + '.json')
+
+    fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(fd, 0, file_size)
+        else:
+            os.ftruncate(fd, file_size)
+
+        progress_lock = threading.Lock()
+        progress = {'bytes_so_far': 0}
+        abort_event = threading.Event()
+
+        def _download_segment(start, end):
+            headers = {'Range': 'bytes={}-{}'.format(start, end)}
+            if validator:
+                headers['If-Range'] = validator
+            if abort_event.is_set():
+                return
+            response = open_url(
+                from_file, headers=headers, max_connections=max_connections
+            )
+            try:
+                content_range = response.headers.get('Content-Range') or ''
+                if getattr(response, 'status', None) != 206 or \
+                    not content_range.startswith(
+                        'bytes {}-{}/'.format(start, end)
+                    ):
+                    raise Exception(
+                        'Range {}-{} request of {} is not served, status is '
+                        '{} and content range is {}'.format(start, end,
+                        from_file, getattr(response, 'status', None),
+                        content_range)
+                    )
+
+                position = start
+                while position <= end and not abort_event.is_set():
+                    chunk = response.read(min(chunk_size, end - position + 1))
+                    if not chunk:
+                        raise Exception(
+                            'Range {}-{} of {} ended at byte {}'.format(
+                            start, end, from_file, position)
+                        )
+                    os.pwrite(fd, chunk, position)
+                    position += len(chunk)
+
+                    with progress_lock:
+                        progress['bytes_so_far'] += len(chunk)
+                        if report_hook and verbose > 0:
+                            report_hook(
+                                progress['bytes_so_far'], chunk_size,
+                                file_size
+                            )
+            except Exception:
+                # Other segments stop at their next chunk.
+                abort_event.set()
+                raise
+            finally:
+                response.close()
+
+        segment_size = file_size // segments
+        executor = ThreadPoolExecutor(max_workers=segments)
+        futures = []
+        for index in range(segments):
+            start = index * segment_size
+            end = file_size - 1 if index == segments - 1 else \
+                start + segment_size - 1
+            futures.append(executor.submit(_download_segment, start, end))
+        executor.shutdown(wait=True)
+
+        for future in futures:
+            if future.exception() is not None:
+                raise future.exception()
+    finally:
+        os.close(fd)
+
+    logger.info('Total bytes written to file is %s', file_size)
+    return file_size
+
+def _get_file_sha256(file_path):
+    sha256_obj = hashlib.sha256()
+    with open(file_path, 'rb') as read_file:
+        while True:
+            chunk = read_file.read(1024 * 1024)
+            if not chunk:
+                break
+            sha256_obj.update(chunk)
+    return sha256_obj.hexdigest()
+
+def _get_conditional_request_headers(url_metadata):
+    headers = {}
+    if url_metadata is None or url_metadata.get('size') is None:
+        return headers
+    if url_metadata.get('etag'):
+        headers['If-None-Match'] = url_metadata['etag']
+    if url_metadata.get('last_modified'):
+        headers['If-Modified-Since'] = url_metadata['last_modified']
+    return headers
+
+def _get_response_metadata(response):
+    size = None
+    content_range = response.headers.get('Content-Range')
+    content_length = response.headers.get('Content-Length')
+    if content_range and '/' in content_range:
+        # Partial response, total size is after slash "bytes 0-0/1234".
+        total = content_range.rsplit('/', 1)[1].strip()
+        if total.isdigit():
+            size = int(total)
+    elif content_length and content_length.strip().isdigit():
+        size = int(content_length.strip())
+
+    accept_ranges = response.headers.get('Accept-Ranges')
+    return {
+        'size': size,
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'accept_ranges': accept_ranges is not None and \
+            'bytes' in accept_ranges.lower()
+    }
+
+def _record_url_metadata(url, url_metadata, metadata_dir):
+    url_metadata_file = os.path.join(metadata_dir, URL_METADATA_FILE_NAME)
+    with _metadata_file_lock:
+        all_url_metadata = _read_json_file(url_metadata_file)
+        all_url_metadata[url] = url_metadata
+        _write_json_file(url_metadata_file, all_url_metadata)
+
+def get_download_metadata_dir(to_location, remote_host='localhost'):
+    """Returns directory on this host where download metadata is kept for
+       files downloaded to to_location.
+
+    Args:
+        to_location (str): Directory path where files will be save.
+        remote_host (str): Remote host address if to_location is not local.
+
+    Returns:
+        str: Metadata directory path on localhost.
+
+    """
+    if remote_host == "localhost" or remote_host == "127.0.0.1":
+        return to_location
+    return DOWNLOAD_METADATA_DEFAULT_DIR
+
+def race_download_urls(
+    file_name,
+    from_locations,
+    metadata_dir=None,
+    timeout=30,
+    max_connections=None,
+    verbose=0
+):
+    """Probes all download urls concurrently and orders them by response time.
+
+    Every url is probed with a HEAD request at the same time, first url which
+    responds wins and remaining probes are abandoned. Measured latencies are
+    recorded in metadata_dir so next race starts with best known mirror and
+    fallback order is known if no mirror responds. Mirrors which do not
+    respond in timeout are failed.
+
+    Args:
+        file_name (str): File name which will download.
+        from_locations (list): URLs to download file.
+        metadata_dir (str): Directory where mirror latencies are recorded,
+            latencies are not recorded if it is None.
+        timeout (int): Seconds to wait for any mirror response.
+        max_connections (int): Maximum connections opened to one mirror, see
+            open_url.
+
+    Returns:
+        list: URLs ordered fastest first, failed urls are at the end.
+
+    """
+    if len(from_locations) < 2 or re.match('.*\.git$', file_name):
+        return list(from_locations)
+
+    latency_file = None
+    recorded_latencies = {}
+    if metadata_dir is not None:
+        latency_file = os.path.join(metadata_dir, MIRROR_LATENCY_FILE_NAME)
+        recorded_latencies = _read_json_file(latency_file)
+
+    def _recorded_latency(from_location):
+        latency = recorded_latencies.get(from_location, 0)
+        # Failed mirrors are recorded without latency.
+        return float('inf') if latency is None else latency
+
+    candidates = sorted(from_locations, key=_recorded_latency)
+
+    def _probe_mirror(from_location, probe_results):
+        from_file = os.path.join(from_location, file_name)
+        start_time = time.time()
+        try:
+            response = open_url(
+                from_file, 'HEAD', timeout=timeout,
+                max_connections=max_connections
+            )
+            response.close()
+        except Exception as e:
+            probe_results.put((from_location, None, e))
+            return
+        probe_results.put((from_location, time.time() - start_time, None))
+
+    # Probes are daemon threads, so abandoned probes do not keep waiting
+    # callers or interpreter exit, they end by their own timeout.
+    race_start_time = time.time()
+    probe_results = queue.Queue()
+    for from_location in candidates:
+        threading.Thread(
+            target=_probe_mirror, args=(from_location, probe_results),
+            name='probe-' + from_location, daemon=True
+        ).start()
+
+    latencies = {}
+    while len(latencies) < len(candidates):
+        remaining_secs = race_start_time + timeout - time.time()
+        if remaining_secs <= 0:
+            break
+        try:
+            from_location, latency, error = probe_results.get(
+                timeout=remaining_secs
+            )
+        except queue.Empty:
+            break
+        if error is not None:
+            logger.info('Mirror %s probe failed - %s', from_location, error)
+        latencies[from_location] = latency
+        if latency is not None:
+            break
+
+    # Abandoning slower mirrors, their latency is more than the race time.
+    # Mirrors are failed if none responded in timeout.
+    race_time = time.time() - race_start_time
+    has_winner = any(latency is not None for latency in latencies.values())
+    abandoned_locations = set()
+    for from_location in candidates:
+        if from_location in latencies:
+            continue
+        if has_winner:
+            abandoned_locations.add(from_location)
+            latencies[from_location] = \
+                race_time + MIRROR_ABANDONED_PENALTY_SECS
+        else:
+            logger.info('Mirror %s probe timed out', from_location)
+            latencies[from_location] = None
+
+    logger.info('Mirror latencies for %s are %s', file_name, latencies)
+    if verbose > 0:
+        for from_location, latency in latencies.items():
+            print('[MIRROR] {} {}'.format(
+                from_location,
+                'FAILED' if latency is None else '{:.3f} secs'.format(latency)
+            ))
+
+    if latency_file is not None:
+        with _metadata_file_lock:
+            all_latencies = _read_json_file(latency_file)
+            all_latencies.update(latencies)
+            _write_json_file(latency_file, all_latencies)
+
+    # Mirrors which answered first, then unanswered mirrors in recorded order
+    # and failed mirrors at the end.
+    def _race_order(from_location):
+        latency = latencies[from_location]
+        if latency is None:
+            return (2, 0)
+        if from_location in abandoned_locations:
+            return (1, _recorded_latency(from_location))
+        return (0, latency)
+
+    return sorted(candidates, key=_race_order)
+
+def download_file(
+    file_name,
+    from_location,
+    to_location,
+    remote_host='localhost',
+    remote_ssh_port=22,
+    remote_ssh_user=None,
+    remote_ssh_pass=None,
+    verbose=0,
+    sha256=None,
+    segments=1,
+    extract_path=None,
+    max_connections=None
+):
+    """Download file and save it to destination on localhost or remotehost
+
+    File is saved in content addressed cache of to_location, its sha256 is
+    computed while downloading and file is not downloaded again if cache has
+    file with declared or earlier learned sha256.
+
+    Args:
+        file_name (str): File name which will download.
+        from_location (str): URL to download file.
+        to_location (str): Directory path where file will be save.
+        sha256 (str): Expected file sha256, download fails if it does not
+            match.
+        segments (int): Number of byte ranges of file downloaded in parallel
+            connections, file is downloaded in single stream if server does
+            not accept ranges.
+        extract_path (str): Directory path where tar archive is extracted
+            while it is downloading, it is extracted only if file is
+            downloaded in single stream on localhost.
+        max_connections (int): Maximum connections opened to url host, see
+            open_url.
+        remote_host (str): Remote host address if to_location is not local.
+        remote_ssh_port (int): Remote host SSH port.
+        remote_ssh_user (str): Remote host SSH User name.
+        remote_ssh_pass (str): Remote host SSH Password.
+
+    Returns:
+        bool: True if file was successfully downloaded otherwise False
+        
+    """
+  
+    logger.debug(
+        'Downloading file %s from location %s and installing to host %s to'
+        ' location %s', file_name, from_location, remote_host, to_location
+    )
+    
+    def _print_downloading_message(bytes_so_far, chunk_size, total_size):
+        if total_size is None:
+            print("Downloaded {} bytes\r".format(bytes_so_far), end='')
+            return
+        downloaded_size = float(bytes_so_far) / total_size
+        downloaded_percentage = round(downloaded_size*100, 2)
+        print("Downloaded {} of {} bytes {}%\r".format(
+            bytes_so_far, total_size, downloaded_percentage), end=''
+        )
+        #sys.stdout.flush()
+        if bytes_so_far >= total_size:
+            print('\n')
+
+    def _download_file_to_localhost(
+        file_name, from_location, to_location, sha256=None, segments=1,
+        extract_path=None, chunk_size=8192, report_hook=None
+    ):
+        from_file = os.path.join(from_location, file_name)
+        to_file = os.path.join(to_location, file_name)
+
+        # Checks file in content addressed cache, it does not need any network
+        # request.
+        expected_sha256 = sha256 or _read_json_file(
+            _get_sha256_index_path(to_location)
+        ).get(file_name)
+        if expected_sha256 is not None:
+            sha256_file = _get_sha256_object_path(to_location, expected_sha256)
+            if os.path.exists(sha256_file):
+                logger.info(
+                    'File found in cache with sha256 %s.', expected_sha256
+                )
+                _link_sha256_object_on_localhost(
+                    file_name, to_location, expected_sha256
+                )
+                return os.stat(sha256_file).st_size
+
+        # Checks file in cache, file size is only verification for files
+        # downloaded without sha256.
+        metadata_dir = get_download_metadata_dir(to_location)
+        if expected_sha256 is None and \
+            _is_file_exist_at_localhost(from_file, to_file, metadata_dir):
+            logger.info('File found in cache.')
+            return os.stat(to_file).st_size
+
+        # Creating parent dirs, if does not exists.
+        sha256_dir = os.path.join(to_location, SHA256_CACHE_DIR_NAME)
+        if not os.path.exists(sha256_dir):
+            os.makedirs(sha256_dir, exist_ok=True)
+
+        if verbose > 0:
+            #Adding newline before printing downloaded message.
+            print('\n', end='')
+        part_file = os.path.join(sha256_dir, file_name + '.part')
+        url_metadata = None
+        if segments > 1:
+            url_metadata = get_url_metadata(
+                from_file, metadata_dir, max_connections=max_connections
+            )
+        if url_metadata is not None and \
+            _get_download_segments(url_metadata, segments) > 1:
+            _download_url_segments(
+                from_file, part_file, url_metadata['size'],
+                _get_download_segments(url_metadata, segments),
+                report_hook=report_hook,
+                validator=_get_range_validator(url_metadata),
+                max_connections=max_connections, verbose=verbose
+            )
+            # Segments are written out of order, so sha256 is computed after
+            # download.
+            file_sha256 = _get_file_sha256(part_file)
+            bytes_so_far = url_metadata['size']
+            response_metadata = url_metadata
+        else:
+            stream_extractor = None
+            if extract_path is not None and \
+                re.match(STREAM_EXTRACT_RE_PATTERN, file_name):
+                if not os.path.exists(extract_path):
+                    os.makedirs(extract_path, exist_ok=True)
+                stream_extractor = _StreamExtractor(file_name, extract_path)
+            try:
+                file_sha256, bytes_so_far, response_metadata = \
+                    _download_url_to_part_file(
+                        from_file, part_file, chunk_size=chunk_size,
+                        report_hook=report_hook, chunk_sink=stream_extractor,
+                        max_connections=max_connections, verbose=verbose
+                    )
+            except Exception:
+                if stream_extractor is not None:
+                    stream_extractor.abort()
+                raise
+            # Extracted files are kept only for complete and verified file.
+            if stream_extractor is not None:
+                if file_sha256 is None or \
+                    (sha256 is not None and file_sha256 != sha256):
+                    stream_extractor.abort()
+                else:
+                    stream_extractor.finish(file_sha256)
+        logger.info('Total bytes written to file is %s', bytes_so_far)
+        if file_sha256 is None:
+            return False
+
+        if sha256 is not None and file_sha256 != sha256:
+            logger.error(
+                'Downloaded file %s sha256 %s does not match expected sha256 '
+                '%s', from_file, file_sha256, sha256
+            )
+            os.remove(part_file)
+            return False
+
+        os.replace(part_file, _get_sha256_object_path(to_location, file_sha256))
+        _link_sha256_object_on_localhost(file_name, to_location, file_sha256)
+        _record_url_metadata(from_file, response_metadata, metadata_dir)
+        with _metadata_file_lock:
+            sha256_index_file = _get_sha256_index_path(to_location)
+            sha256_index = _read_json_file(sha256_index_file)
+            sha256_index[file_name] = file_sha256
+            _write_json_file(sha256_index_file, sha256_index)
+
+        logger.info('File %s sha256 is %s', to_file, file_sha256)
+        return bytes_so_far
+    
+    def _download_file_to_remotehost(
+        file_name, from_location, to_location, remote_host, remote_ssh_port,
+        remote_ssh_user, remote_ssh_pass, sha256=None, segments=1,
+        chunk_size=8192, report_hook=None
+    ):
+        from_file = os.path.join(from_location, file_name)
+        to_file = os.path.join(to_location, file_name)
+
+        with sftp_session(
+            remote_host, remote_ssh_port, remote_ssh_user, remote_ssh_pass
+        ) as sftp:
+            # Checks file in content addressed cache, it does not need any
+            # network request to file url.
+            expected_sha256 = sha256 or _read_sftp_json_file(
+                sftp, _get_sha256_index_path(to_location)
+            ).get(file_name)
+            if expected_sha256 is not None:
+                sha256_file = _get_sha256_object_path(
+                    to_location, expected_sha256
+                )
+                try:
+                    statinfo = sftp.stat(sha256_file)
+                except OSError:
+                    statinfo = None
+                if statinfo is not None:
+                    logger.info(
+                        'File found in cache with sha256 %s.', expected_sha256
+                    )
+                    _link_sha256_object_on_remotehost(
+                        sftp, file_name, to_location, expected_sha256
+                    )
+                    return statinfo.st_size
+
+            # Checks file in cache, file size is only verification for files
+            # downloaded without sha256.
+            metadata_dir = get_download_metadata_dir(to_location, remote_host)
+            if expected_sha256 is None:
+                file_size = _is_file_exist_at_remotehost(
+                    sftp, from_file, to_file, metadata_dir
+                )
+                if file_size:
+                    logger.info('File found in cache.')
+                    return file_size
+
+            # Creating parent dirs, if does not exists.
+            sha256_dir = os.path.join(to_location, SHA256_CACHE_DIR_NAME)
+            logger.info('Creating %s directory if does not exist', sha256_dir)
+            mkdirs(sha256_dir, remote_host=remote_host,
+                remote_ssh_port=remote_ssh_port,
+                remote_ssh_user=remote_ssh_user,
+                remote_ssh_pass=remote_ssh_pass, failsafe=False
+            )
+
+            if verbose > 0:
+                #Adding newline before printing downloaded message.
+                print('\n', end='')
+            part_file = os.path.join(sha256_dir, file_name + '.part')
+            url_metadata = None
+            if segments > 1:
+                url_metadata = get_url_metadata(
+                    from_file, metadata_dir, max_connections=max_connections
+                )
+            if url_metadata is not None and \
+                _get_download_segments(url_metadata, segments) > 1:
+                # Segments are downloaded to this host and then streamed to
+                # remotehost.
+                if not os.path.exists(DOWNLOAD_METADATA_DEFAULT_DIR):
+                    os.makedirs(DOWNLOAD_METADATA_DEFAULT_DIR, exist_ok=True)
+                segments_file = os.path.join(
+                    DOWNLOAD_METADATA_DEFAULT_DIR,
+                    _get_temp_file_name(file_name)
+                )
+                try:
+                    _download_url_segments(
+                        from_file, segments_file, url_metadata['size'],
+                        _get_download_segments(url_metadata, segments),
+                        report_hook=report_hook,
+                        validator=_get_range_validator(url_metadata),
+                        max_connections=max_connections, verbose=verbose
+                    )
+                    file_sha256, bytes_so_far, response_metadata = \
+                        _download_url_to_part_file(
+                            'file://' + segments_file, part_file, sftp=sftp,
+                            chunk_size=chunk_size
+                        )
+                finally:
+                    if os.path.exists(segments_file):
+                        os.remove(segments_file)
+                response_metadata = url_metadata
+            else:
+                file_sha256, bytes_so_far, response_metadata = \
+                    _download_url_to_part_file(
+                        from_file, part_file, sftp=sftp,
+                        chunk_size=chunk_size, report_hook=report_hook,
+                        max_connections=max_connections, verbose=verbose
+                    )
+            logger.info('Total bytes written to file is %s', bytes_so_far)
+            if file_sha256 is None:
+                return False
+
+            if sha256 is not None and file_sha256 != sha256:
+                logger.error(
+                    'Downloaded file %s sha256 %s does not match expected '
+                    'sha256 %s', from_file, file_sha256, sha256
+                )
+                sftp.remove(part_file)
+                return False
+
+            sftp.posix_rename(
+                part_file, _get_sha256_object_path(to_location, file_sha256)
+            )
+            _link_sha256_object_on_remotehost(
+                sftp, file_name, to_location, file_sha256
+            )
+            _record_url_metadata(from_file, response_metadata, metadata_dir)
+            with _metadata_file_lock:
+                sha256_index_file = _get_sha256_index_path(to_location)
+                sha256_index = _read_sftp_json_file(sftp, sha256_index_file)
+                sha256_index[file_name] = file_sha256
+                _write_sftp_json_file(sftp, sha256_index_file, sha256_index)
+
+        logger.info('File %s sha256 is %s', to_file, file_sha256)
+        return bytes_so_far
+
+    def _download_git_repo_to_localhost(
+        file_name, from_location, to_location
+    ):
+        git_repo_dir = os.path.join(to_location, file_name)
+
+        logger.info(
+            'Cloning git repository %s to location %s',
+            from_location, to_location
+        )
+      
+        # Creating parent directories if not exists.
+        if not os.path.exists(to_location):
+            os.makedirs(to_location)
+        
+        from_file = os.path.join(from_location, file_name) 
+        cloning_cmd = ["git", "clone", from_file, file_name]
+        # git writes progress to stderr, so only exit status means failure.
+        output = CommandOutput()
+        stdout, stderr = run_command(
+            cloning_cmd, to_location, verbose=verbose+1, output=output
+        )
+        
+        logger.debug('Git Cloning output %s', stdout)
+        if output.exit_status != 0:
+            logger.info('\n%s', stderr)
+            return False
+        
+        logger.info('Git repository cloned successfully.')    
+        return True
+
+    def _download_git_repo_to_remotehost(
+        file_name, from_location, to_location, remote_host, remote_ssh_port,
+        remote_ssh_user, remote_ssh_pass
+    ):
+        to_file = os.path.join(to_location, file_name)
+        mkdirs(to_file, remote_host=remote_host,
+            remote_ssh_port=remote_ssh_port, remote_ssh_user=remote_ssh_user,
+            remote_ssh_pass=remote_ssh_pass, failsafe=False
+        )
+
+        from_file = os.path.join(from_location, file_name)
+        cloning_cmd = ['git', 'clone', shlex.quote(from_file),
+            shlex.quote(to_file)]
+        
+        logger.info(
+            'Cloning git repository %s to remotehost %s to location %s, '
+            'cloning command %s',
+            from_location, remote_host, to_location, " ".join(cloning_cmd)
+        )
+        
+        # Cloned on pooled transport, output is read before channel is
+        # closed.
+        output = CommandOutput()
+        run_command(
+            cloning_cmd,
+            to_location,
+            remote_host=remote_host,
+            remote_ssh_port=remote_ssh_port,
+            remote_ssh_user=remote_ssh_user,
+            remote_ssh_pass=remote_ssh_pass,
+            output=output
+        )
+        logger.debug('Git Cloning output - %s', output.stdout)
+
+        if output.exit_status != 0:
+            logger.error('Git cloning error - \n%s', output.stdout)
+            return False
+        
+        logger.info('Git repository cloned successfully.')    
+        return True
+
+    def _is_file_exist_at_localhost(from_file, to_file, metadata_dir):
+        if os.path.exists(to_file):
+            logger.info('File exists at %s, checking file size', to_file)
+
+            remote_file_size = get_url_metadata(
+                from_file, metadata_dir, max_connections=max_connections
+            )['size']
+
+            statinfo = os.stat(to_file)
+            if remote_file_size == statinfo.st_size:
+                logger.info('File size %s matches at remote location, '\
+                    'skipping download', remote_file_size
+                )
+                return True
+            else:
+                logger.info(
+                    'Remote file size %s does not match with local file size '
+                    '%s', remote_file_size, str(statinfo.st_size)
+                )
+                
+        return False
+
+    def _is_file_exist_at_remotehost(sftp, from_file, to_file, metadata_dir):
+        # Returns file size if file exists with url file size.
+        statinfo = None
+        try:
+            statinfo = sftp.stat(to_file)
+        except FileNotFoundError:
+            return 0
+            
+        remote_file_size = get_url_metadata(
+            from_file, metadata_dir, max_connections=max_connections
+        )['size']
+        if remote_file_size == statinfo.st_size:
+            logger.info('File size %s matches at remote location, '\
+                'skipping download', remote_file_size
+            )
+            return statinfo.st_size
+        
+        return 0
+    
+    # Main code
+    status = False
+    if remote_host == "localhost" or remote_host == "127.0.0.1":
+        if re.match('.*\.git$', file_name):
+            status = _download_git_repo_to_localhost(
                 file_name, from_location, to_location
             )
-        else:
-            status = _download_file_to_localhost(
-                file_name, from_location, to_location,
-                report_hook=_print_downloading_message
+        else:
+            status = _download_file_to_localhost(
+                file_name, from_location, to_location, sha256=sha256,
+                segments=segments, extract_path=extract_path,
+                report_hook=_print_downloading_message
+            )
+    else:
+        if re.match('.*\.git$', file_name):
+            status = _download_git_repo_to_remotehost(
+                file_name, from_location, to_location, remote_host,
+                remote_ssh_port, remote_ssh_user, remote_ssh_pass
+            )
+        else:
+            try:
+                status = _download_file_to_remotehost(
+                    file_name, from_location, to_location, remote_host,
+                    remote_ssh_port, remote_ssh_user, remote_ssh_pass,
+                    sha256=sha256, segments=segments,
+                    report_hook=_print_downloading_message
+                )
+            finally:
+                # Cache files are written on sftp session.
+                invalidate_remote_stats(
+                    [to_location], remote_host, remote_ssh_port,
+                    remote_ssh_user
+                )
+
+    if status:
+        logger.info('%s file downloaded successfully.', file_name)
+        return True
+    else:
+        logger.error('file download failed %s', file_name)
+        return False
+
+def is_file_extracted(
+    file_name,
+    file_source_path,
+    file_dest_path,
+    sha256=None,
+    patch_files=None,
+    remote_host="localhost",
+    remote_ssh_port=22,
+    remote_ssh_user=None,
+    remote_ssh_pass=None,
+    verbose=0
+):
+    """Checks archive extraction was completed from current archive file.
+
+    Extraction is complete only if its stamp exists and stamp sha256 is sha256
+    of archive file, git repositories are extracted if their directory exists.
+
+    Args:
+        file_name (str): Archive file name.
+        file_source_path (str): Source directory path where file exist.
+        file_dest_path (str): Destination directory path where file was
+            extracted.
+        sha256 (str): Archive file sha256 if it is known.
+        patch_files (list): Patch files which must have been applied to
+            extracted files, in order, an empty list if extracted files must
+            not be patched. Applied patches are not checked if it is None.
+        remote_host (str): Remote host address if to_location is not local.
+        remote_ssh_port (int): Remote host SSH port.
+        remote_ssh_user (str): Remote host SSH User name.
+        remote_ssh_pass (str): Remote host SSH Password.
+
+    Returns:
+        bool: True if file has extracted otherwise False
+
+    """
+    file_dest_path_without_ext = os.path.join(
+        file_dest_path, re.sub(ARCHIVE_EXTENSION_RE_PATTERN, '', file_name)
+    )
+    if re.match('.*\.git$', file_name):
+        return is_path_exists(
+            file_dest_path_without_ext,
+            remote_host=remote_host,
+            remote_ssh_port=remote_ssh_port,
+            remote_ssh_user=remote_ssh_user,
+            remote_ssh_pass=remote_ssh_pass,
+            verbose=verbose
+        )
+
+    stamp_path = _get_extract_stamp_path(file_name, file_dest_path)
+    if remote_host == "localhost" or remote_host == "127.0.0.1":
+        stamp = _read_json_file(stamp_path)
+    else:
+        with sftp_session(
+            remote_host, remote_ssh_port, remote_ssh_user, remote_ssh_pass
+        ) as sftp:
+            stamp = _read_sftp_json_file(sftp, stamp_path)
+    if not stamp.get('sha256'):
+        return False
+
+    archive_sha256 = sha256 or _get_archive_sha256(
+        file_name, file_source_path, remote_host, remote_ssh_port,
+        remote_ssh_user, remote_ssh_pass
+    )
+    if stamp['sha256'] != archive_sha256:
+        logger.info(
+            'File %s has changed since it was extracted at %s',
+            file_name, file_dest_path
+        )
+        return False
+    if patch_files is not None and stamp.get('patches') != \
+        _get_files_sha256(
+            patch_files, remote_host, remote_ssh_port, remote_ssh_user,
+            remote_ssh_pass
+        ):
+        logger.info(
+            'Patches of file %s have changed since it was extracted at %s',
+            file_name, file_dest_path
+        )
+        return False
+    return is_path_exists(
+        file_dest_path_without_ext,
+        remote_host=remote_host,
+        remote_ssh_port=remote_ssh_port,
+        remote_ssh_user=remote_ssh_user,
+        remote_ssh_pass=remote_ssh_pass,
+        verbose=verbose
+    )
+
+def _get_extract_stamp_path(file_name, file_dest_path):
+    return os.path.join(
+        file_dest_path,
+        '.' + re.sub(ARCHIVE_EXTENSION_RE_PATTERN, '', file_name) + \
+        EXTRACT_STAMP_FILE_SUFFIX
+    )
+
+def _finish_staged_extraction(
+    file_name, staged_path, file_dest_path, stamp, remote_host,
+    remote_ssh_port, remote_ssh_user, remote_ssh_pass, verbose=0
+):
+    # Moves entries of staged extraction directory to destination and writes
+    # extraction stamp.
+    if remote_host == "localhost" or remote_host == "127.0.0.1":
+        entry_names = _move_extracted_entries_on_localhost(
+            file_name, staged_path, file_dest_path
+        )
+        stamp = dict(stamp, entries=sorted(entry_names))
+        _write_json_file(
+            _get_extract_stamp_path(file_name, file_dest_path), stamp
+        )
+        return
+
+    # Entries are moved and stamp is written by one remote command, earlier
+    # stamp is removed first so interrupted move is never trusted.
+    stamp_path = _get_extract_stamp_path(file_name, file_dest_path)
+    move_cmd = 'rm -f {stamp_path} && cd {staged} && ' \
+        'for entry in * .[!.]* ..?*; do ' \
+        '[ -e "$entry" ] || [ -L "$entry" ] || continue; ' \
+        'rm -rf ../"$entry" && mv "$entry" ../ || exit 1; done && ' \
+        'cd .. && rmdir {staged} && printf %s {stamp_data} > ' \
+        '{stamp_path}.tmp && mv {stamp_path}.tmp {stamp_path}'.format(
+        staged=shlex.quote(staged_path),
+        stamp_data=shlex.quote(json.dumps(stamp)),
+        stamp_path=shlex.quote(stamp_path)
+    )
+    output = CommandOutput()
+    stdout, stderr = run_command(
+        ['bash', '-c', shlex.quote(move_cmd)],
+        remote_host=remote_host,
+        remote_ssh_port=remote_ssh_port,
+        remote_ssh_user=remote_ssh_user,
+        remote_ssh_pass=remote_ssh_pass,
+        verbose=verbose,
+        output=output
+    )
+    if output.exit_status != 0:
+        raise Exception('Error in moving extracted file - {}'.format(stderr))
+
+def _move_extracted_entries_on_localhost(
+    file_name, staged_path, file_dest_path
+):
+    # Moves entries of staged extraction directory to destination, replacing
+    # earlier entries, and returns their names. Earlier stamp is removed
+    # first, so interrupted move is never trusted.
+    stamp_path = _get_extract_stamp_path(file_name, file_dest_path)
+    if os.path.exists(stamp_path):
+        os.remove(stamp_path)
+
+    entry_names = os.listdir(staged_path)
+    for entry_name in entry_names:
+        entry_path = os.path.join(file_dest_path, entry_name)
+        if os.path.isdir(entry_path) and not os.path.islink(entry_path):
+            shutil.rmtree(entry_path)
+        elif os.path.lexists(entry_path):
+            os.remove(entry_path)
+        os.replace(os.path.join(staged_path, entry_name), entry_path)
+    os.rmdir(staged_path)
+    return entry_names
+
+def _get_files_sha256(
+    file_paths, remote_host, remote_ssh_port, remote_ssh_user,
+    remote_ssh_pass
+):
+    # Returns sha256 of files in same order, files on remotehost are hashed by
+    # one command.
+    if not file_paths:
+        return []
+    if remote_host == "localhost" or remote_host == "127.0.0.1":
+        return [_get_file_sha256(file_path) for file_path in file_paths]
+
+    stdout, stderr = run_command(
+        ['sha256sum'] + [shlex.quote(file_path) for file_path in file_paths],
+        remote_host=remote_host,
+        remote_ssh_port=remote_ssh_port,
+        remote_ssh_user=remote_ssh_user,
+        remote_ssh_pass=remote_ssh_pass
+    )
+    files_sha256 = re.findall('^([0-9a-f]{64})\\s', stdout, re.MULTILINE)
+    if len(files_sha256) != len(file_paths):
+        raise Exception(
+            'Error in computing sha256 of files {} - {}'.format(
+            file_paths, stdout)
+        )
+    return files_sha256
+
+def _get_archive_sha256(
+    file_name, file_source_path, remote_host, remote_ssh_port,
+    remote_ssh_user, remote_ssh_pass
+):
+    # Sha256 of file in content addressed cache is name of its link target,
+    # other files are hashed. Returns None if file does not exist.
+    file_abs_path = os.path.join(file_source_path, file_name)
+    link_target_re_pattern = '^' + SHA256_CACHE_DIR_NAME + '/([0-9a-f]{64})$'
+    if remote_host == "localhost" or remote_host == "127.0.0.1":
+        if os.path.islink(file_abs_path):
+            match = re.match(link_target_re_pattern, os.readlink(file_abs_path))
+            if match:
+                return match.group(1)
+        if not os.path.exists(file_abs_path):
+            return None
+        return _get_file_sha256(file_abs_path)
+
+    try:
+        with sftp_session(
+            remote_host, remote_ssh_port, remote_ssh_user, remote_ssh_pass
+        ) as sftp:
+            link_target = sftp.readlink(file_abs_path)
+        match = re.match(link_target_re_pattern, link_target)
+        if match:
+            return match.group(1)
+    except OSError:
+        pass
+
+    stdout, stderr = run_command(
+        ['sha256sum', shlex.quote(file_abs_path)],
+        remote_host=remote_host,
+        remote_ssh_port=remote_ssh_port,
+        remote_ssh_user=remote_ssh_user,
+        remote_ssh_pass=remote_ssh_pass
+    )
+    match = re.match('^([0-9a-f]{64})\\s', stdout.strip() + ' ')
+    return match.group(1) if match else None
+
+def extract_archive(
+    file_abs_path,
+    file_dest_path,
+    exclude_patterns=None,
+    workers=None,
+    verbose=0
+):
+    """Extracts tar or zip archive on localhost without tar or unzip command.
+
+    Archive is read as stream with large buffers, members whose path is
+    outside of destination directory are refused. Zip archive members are
+    extracted in parallel threads.
+
+    Args:
+        file_abs_path (str): Archive file path.
+        file_dest_path (str): Destination directory path where archive will be
+            extracted.
+        exclude_patterns (list): Shell style patterns of member paths which
+            are not extracted, for example "*/docs/*".
+        workers (int): Number of threads extracting zip archive members,
+            default is number of processors.
+
+    Returns:
+        dict: Number of extracted members and bytes, as "members" and "bytes".
+
+    """
+    exclude_patterns = exclude_patterns or []
+    summary = {'members': 0, 'bytes': 0}
+
+    def _is_excluded(member_name):
+        for exclude_pattern in exclude_patterns:
+            if fnmatch.fnmatch(member_name, exclude_pattern):
+                return True
+        return False
+
+    dest_real_path = os.path.realpath(file_dest_path)
+
+    def _check_member_path(member_name, link_name=None):
+        member_path = os.path.realpath(
+            os.path.join(dest_real_path, member_name)
+        )
+        if os.path.commonpath([dest_real_path, member_path]) != \
+            dest_real_path:
+            raise Exception(
+                'Archive member {} is outside of extract location {}'.format(
+                member_name, file_dest_path)
+            )
+        if link_name is not None:
+            link_path = os.path.realpath(os.path.join(
+                os.path.dirname(member_path), link_name
+            ))
+            if os.path.commonpath([dest_real_path, link_path]) != \
+                dest_real_path:
+                raise Exception(
+                    'Archive member {} links outside of extract location '
+                    '{}'.format(member_name, file_dest_path)
+                )
+
+    def _extract_tar(fileobj=None):
+        with tarfile.open(
+            file_abs_path, mode='r|' if fileobj else 'r|*', fileobj=fileobj,
+            bufsize=EXTRACT_COPY_BUFFER_SIZE,
+            copybufsize=EXTRACT_COPY_BUFFER_SIZE
+        ) as tar:
+
+            def _iter_members():
+                for member in tar:
+                    if _is_excluded(member.name):
+                        continue
+                    if member.issym():
+                        _check_member_path(member.name, member.linkname)
+                    elif member.islnk():
+                        _check_member_path(member.name)
+                        _check_member_path(member.linkname)
+                    else:
+                        _check_member_path(member.name)
+                    summary['members'] += 1
+                    if member.isreg():
+                        summary['bytes'] += member.size
+                    yield member
+
+            if hasattr(tarfile, 'tar_filter'):
+                tar.extractall(
+                    file_dest_path, members=_iter_members(), filter='tar'
+                )
+            else:
+                tar.extractall(file_dest_path, members=_iter_members())
+
+    def _extract_zip():
+        with zipfile.ZipFile(file_abs_path) as zip_file:
+            # Central directory is read once and members are sorted in
+            # directories, symbolic links and files.
+            dir_members = []
+            link_members = []
+            file_members = []
+            for member in zip_file.infolist():
+                if _is_excluded(member.filename):
+                    continue
+                # Links of archive are created after all files, member path
+                # is resolved through links already in extract location.
+                _check_member_path(member.filename)
+                summary['members'] += 1
+                if member.is_dir():
+                    dir_members.append(member)
+                elif stat.S_ISLNK(member.external_attr >> 16):
+                    link_members.append(member)
+                else:
+                    file_members.append(member)
+                    summary['bytes'] += member.file_size
+
+            # All directories are created before members are extracted.
+            dir_paths = set()
+            for member in dir_members:
+                dir_paths.add(os.path.join(file_dest_path, member.filename))
+            for member in file_members + link_members:
+                dir_paths.add(os.path.dirname(
+                    os.path.join(file_dest_path, member.filename)
+                ))
+            for dir_path in sorted(dir_paths):
+                os.makedirs(dir_path, exist_ok=True)
+
+            # Every thread reads archive with its own file handle.
+            thread_data = threading.local()
+            thread_zip_files = []
+            thread_zip_files_lock = threading.Lock()
+
+            def _extract_zip_members(members):
+                if not hasattr(thread_data, 'zip_file'):
+                    thread_data.zip_file = zipfile.ZipFile(file_abs_path)
+                    with thread_zip_files_lock:
+                        thread_zip_files.append(thread_data.zip_file)
+
+                for member in members:
+                    member_path = os.path.join(
+                        file_dest_path, member.filename
+                    )
+                    with thread_data.zip_file.open(member) as source, \
+                        open(member_path, 'wb') as target:
+                        if member.file_size <= EXTRACT_COPY_BUFFER_SIZE:
+                            target.write(source.read())
+                        else:
+                            shutil.copyfileobj(
+                                source, target, EXTRACT_COPY_BUFFER_SIZE
+                            )
+                    _set_zip_member_mode(member, member_path)
+
+            # Small members are extracted in batches to keep thread pool
+            # overhead low.
+            member_batches = [[]]
+            batch_size = 0
+            for member in file_members:
+                if len(member_batches[-1]) >= EXTRACT_ZIP_BATCH_MEMBERS or \
+                    batch_size >= EXTRACT_ZIP_BATCH_SIZE:
+                    member_batches.append([])
+                    batch_size = 0
+                member_batches[-1].append(member)
+                batch_size += member.compress_size
+
+            zip_workers = workers or min(32, os.cpu_count() or 1)
+            try:
+                if zip_workers <= 1 or len(member_batches) == 1:
+                    # Thread pool does not help on single processor.
+                    for members in member_batches:
+                        _extract_zip_members(members)
+                else:
+                    executor = ThreadPoolExecutor(max_workers=zip_workers)
+                    futures = [
+                        executor.submit(_extract_zip_members, members)
+                        for members in member_batches
+                    ]
+                    try:
+                        for future in futures:
+                            future.result()
+                    finally:
+                        for future in futures:
+                            future.cancel()
+                        executor.shutdown(wait=True)
+            finally:
+                for thread_zip_file in thread_zip_files:
+                    thread_zip_file.close()
+
+            # Symbolic link target is content of its member.
+            for member in link_members:
+                link_name = zip_file.read(member).decode('utf-8')
+                _check_member_path(member.filename, link_name)
+                member_path = os.path.join(file_dest_path, member.filename)
+                if os.path.lexists(member_path):
+                    os.remove(member_path)
+                os.symlink(link_name, member_path)
+
+            # Directory permissions are set after their files are written.
+            for member in reversed(dir_members):
+                _set_zip_member_mode(
+                    member, os.path.join(file_dest_path, member.filename)
+                )
+
+    def _set_zip_member_mode(member, member_path):
+        # Unix permissions are kept in high bits of external attributes.
+        file_mode = (member.external_attr >> 16) & 0o7777
+        if file_mode:
+            os.chmod(member_path, file_mode)
+
+    def _extract_decompressed_tar(decompress_program):
+        # Archive is decompressed by decompressor process and its output is
+        # read as uncompressed tar stream. Its errors are written to temporary
+        # file, so decompressor never blocks on full stderr pipe.
+        logger.info(
+            'Decompressing %s with %s', file_abs_path, decompress_program
+        )
+        with tempfile.TemporaryFile() as stderr_file:
+            proc = subprocess.Popen(
+                shlex.split(decompress_program) + ['-d', '-c', file_abs_path],
+                stdout=subprocess.PIPE,
+                stderr=stderr_file
+            )
+            try:
+                _extract_tar(proc.stdout)
+                # Trailing padding is read so decompressor can finish.
+                while proc.stdout.read(EXTRACT_COPY_BUFFER_SIZE):
+                    pass
+            finally:
+                proc.stdout.close()
+                proc.wait()
+                stderr_file.seek(0)
+                stderr = stderr_file.read().decode('utf-8', 'replace')
+        if proc.returncode != 0:
+            raise Exception(
+                'Error in decompressing file {} - {}'.format(
+                file_abs_path, stderr)
             )
+
+    if re.match('.*\\.zip$', file_abs_path):
+        _extract_zip()
     else:
-        if re.match('.*\.git$', file_name):
-            status = _download_git_repo_to_remotehost(
-                file_name, from_location, to_location, remote_host,
-                remote_ssh_port, remote_ssh_user, remote_ssh_pass
+        decompress_program = get_decompress_program(file_abs_path)
+        if decompress_program is not None:
+            _extract_decompressed_tar(decompress_program)
+        elif re.match('.*\\.tar\\.zst$', file_abs_path):
+            raise Exception(
+                'zstd is required to extract file {}'.format(file_abs_path)
             )
         else:
-            status = _download_file_to_remotehost(
-                file_name, from_location, to_location, remote_host,
-                remote_ssh_port, remote_ssh_user, remote_ssh_pass,
-                report_hook=_print_downloading_message
+            _extract_tar()
+
+    logger.info(
+        'Extracted %s members and %s bytes of %s to %s',
+        summary['members'], summary['bytes'], file_abs_path, file_dest_path
+    )
+    return summary
+
+def get_decompress_program(
+    file_name,
+    remote_host="localhost",
+    remote_ssh_port=22,
+    remote_ssh_user=None,
+    remote_ssh_pass=None,
+    verbose=0
+):
+    """Returns parallel decompressor program of tar archive found on host.
+
+    Programs found on host are detected once and remembered.
+
+    Args:
+        file_name (str): Archive file name.
+        remote_host (str): Remote host address if archive is not local.
+        remote_ssh_port (int): Remote host SSH port.
+        remote_ssh_user (str): Remote host SSH User name.
+        remote_ssh_pass (str): Remote host SSH Password.
+
+    Returns:
+        str: Decompressor program with its arguments, None if archive is not
+            compressed tar or host does not have its decompressor.
+
+    """
+    decompress_programs = None
+    for extension, programs in PARALLEL_DECOMPRESSORS.items():
+        if file_name.endswith(extension):
+            decompress_programs = programs
+    if decompress_programs is None:
+        return None
+
+    host_key = (remote_host, remote_ssh_port)
+    if remote_host == "localhost" or remote_host == "127.0.0.1":
+        host_key = ("localhost", None)
+    with _host_decompressors_lock:
+        host_programs = _host_decompressors.get(host_key)
+
+    if host_programs is None:
+        program_names = sorted(set(
+            program.split()[0]
+            for programs in PARALLEL_DECOMPRESSORS.values()
+            for program in programs
+        ))
+        # xz decompresses in threads only if it knows threads option.
+        detect_cmd = 'for program in {}; do command -v $program > ' \
+            '/dev/null 2>&1 && echo $program; done; xz --help 2>&1 | ' \
+            'grep -q -- --threads && echo xz-threads'.format(
+            ' '.join(program_names))
+        if remote_host == "localhost" or remote_host == "127.0.0.1":
+            stdout, stderr = run_command(
+                ['bash', '-c', detect_cmd], verbose=verbose
             )
+        else:
+            stdout, stderr = run_command(
+                ['bash', '-c', shlex.quote(detect_cmd)],
+                remote_host=remote_host,
+                remote_ssh_port=remote_ssh_port,
+                remote_ssh_user=remote_ssh_user,
+                remote_ssh_pass=remote_ssh_pass,
+                verbose=verbose
+            )
+        host_programs = stdout.split()
+        if 'xz-threads' not in host_programs and 'xz' in host_programs:
+            host_programs.remove('xz')
+        logger.info(
+            'Decompressor programs on host %s are %s', remote_host,
+            host_programs
+        )
+        with _host_decompressors_lock:
+            _host_decompressors[host_key] = host_programs
 
-    if status:
-        logger.info('%s file downloaded successfully.', file_name)
-        return True
-    else:
-        logger.error('file download failed %s', file_name)
-        return False
+    for program in decompress_programs:
+        if program.split()[0] in host_programs:
+            return program
+    return None
 
 def extract_file(
     file_name,
@@ -458,7 +2526,9 @@ def extract_file(
     remote_ssh_port=22,
     remote_ssh_user=None,
     remote_ssh_pass=None,
-    verbose=0
+    verbose=0,
+    engine=None,
+    exclude_patterns=None
 ):
     """ Extract file and returns the path where it was extracted.
     
@@ -467,6 +2537,11 @@ def extract_file(
         file_source_path (str): Source directory path where file exist.
         file_dest_path (str): Destination directory path where file will be
             extracted. 
+        engine (str): "native" extracts archive in process on localhost,
+            "command" runs tar or unzip command. Default is "native" on
+            localhost and "command" on remotehost.
+        exclude_patterns (list): Shell style patterns of archive member paths
+            which are not extracted, only native engine supports it.
         remote_host (str): Remote host address if to_location is not local.
         remote_ssh_port (int): Remote host SSH port.
         remote_ssh_user (str): Remote host SSH User name.
@@ -483,16 +2558,17 @@ def extract_file(
     ) 
     # Checks that input file is supported archive file or not.
     supported_archive_re_pattern = \
-        '.*(\.git|\.zip|\.tar|\.tar\.bz2|\.tar\.gz|\.tar\.xz)$' 
+        '.*(\.git|\.zip|\.tar|\.tar\.bz2|\.tar\.gz|\.tar\.xz|\.tar\.zst)$' 
     if re.match(supported_archive_re_pattern, file_name) == None:
         raise Exception(
             'File ' + file_name + ' is not a supported archive file. ' +
-            'Supported archives are git, tar, tar.bz2, tar.gz and tar.xz'
+            'Supported archives are git, zip, tar, tar.bz2, tar.gz, tar.xz ' +
+            'and tar.zst'
         )
 
     # Getting file name without extension
     file_name_without_ext = re.sub(
-        '(\.git|\.tar|\.tar\.bz2|\.tar\.gz|\.tar\.xz)$', '', file_name
+        ARCHIVE_EXTENSION_RE_PATTERN, '', file_name
     )
     file_dest_path_without_ext = os.path.join(
         file_dest_path, 
@@ -500,29 +2576,38 @@ def extract_file(
     )
     file_abs_path = os.path.join(file_source_path, file_name)
 
+    is_localhost = remote_host == "localhost" or remote_host == "127.0.0.1"
+
     # If it is git repository then just copy to extract location.
     if re.match('.*\.git$', file_name):
         logger.info('git repository - copying to extract location.')
-        if not is_path_exists(file_dest_path_without_ext, remote_host,
-            remote_ssh_port, remote_ssh_user, remote_ssh_pass
-        ):
-            os.makedirs(file_dest_path_without_ext, remote_host,
-                remote_ssh_port, remote_ssh_user, remote_ssh_pass)
+        mkdir_paths(
+            [file_dest_path_without_ext],
+            remote_host=remote_host,
+            remote_ssh_port=remote_ssh_port,
+            remote_ssh_user=remote_ssh_user,
+            remote_ssh_pass=remote_ssh_pass,
+            verbose=verbose
+        )
         
         copy_cmd = ['bash', '-c', 'cp -rfv ' + file_abs_path + '/* ' + \
             file_dest_path_without_ext]
         
+        output = CommandOutput()
         stdout, stderr = run_command(
             copy_cmd,
             remote_host=remote_host,
             remote_ssh_port=remote_ssh_port,
             remote_ssh_user=remote_ssh_user,
             remote_ssh_pass=remote_ssh_pass,
-            verbose=verbose
+            verbose=verbose,
+            output=output
         )
         
-        if stderr != "":
-            raise Exception('Error in extracting git repo.')
+        if output.exit_status != 0:
+            raise Exception(
+                'Error in extracting git repo - {}'.format(stderr)
+            )
             
         logger.info(
             'Copied git repository successfully to extraction location %s.',
@@ -536,47 +2621,274 @@ def extract_file(
             '.*\.tar$': ['tar', 'xvf', file_abs_path],
             '.*\.tar\.bz2$': ['tar', 'xvjf', file_abs_path],
             '.*\.tar\.gz$': ['tar', 'xvzf', file_abs_path],
-            '.*\.tar\.xz$': ['tar', 'xvJf', file_abs_path]
+            '.*\.tar\.xz$': ['tar', 'xvJf', file_abs_path],
+            '.*\.tar\.zst$': ['tar', '--zstd', '-xvf', file_abs_path]
         }
+
+        # Parallel decompressor is given to tar as compress program.
+        decompress_program = get_decompress_program(
+            file_name,
+            remote_host=remote_host,
+            remote_ssh_port=remote_ssh_port,
+            remote_ssh_user=remote_ssh_user,
+            remote_ssh_pass=remote_ssh_pass,
+            verbose=verbose
+        )
+        if decompress_program is not None:
+            if not is_localhost:
+                # Remote command arguments are joined with spaces.
+                decompress_program = shlex.quote(decompress_program)
+            return ['tar', '-I', decompress_program, '-xvf', file_abs_path]
+
         for key, value in pattern_command.items():
             if re.match(key, file_name):
                 return value
         return None
     
-    if not is_path_exists(
-        file_dest_path,
+    if engine is None:
+        engine = "native" if is_localhost else "command"
+    if engine not in ("native", "command"):
+        raise ValueError(
+            'Extract engine ' + str(engine) + ' is not supported. ' +
+            'Supported engines are native and command'
+        )
+    if engine == "native" and not is_localhost:
+        raise ValueError('native extract engine supports only localhost.')
+    if exclude_patterns and engine != "native":
+        raise ValueError('exclude_patterns needs native extract engine.')
+
+    # Archive is extracted in staged directory and moved to destination only
+    # after extraction has completed, so interrupted extraction never leaves
+    # partial package directory.
+    archive_sha256 = _get_archive_sha256(
+        file_name, file_source_path, remote_host, remote_ssh_port,
+        remote_ssh_user, remote_ssh_pass
+    )
+    # Destination directory is created with staged directory.
+    staged_path = os.path.join(
+        file_dest_path, _get_temp_file_name(file_name_without_ext)
+    )
+    if not mkdir_paths(
+        [staged_path],
         remote_host=remote_host,
         remote_ssh_port=remote_ssh_port,
         remote_ssh_user=remote_ssh_user,
         remote_ssh_pass=remote_ssh_pass,
         verbose=verbose
-    ):
-        mkdirs(
-            file_dest_path,
+    )[staged_path]:
+        raise RuntimeError(
+            'Error in creating directory {} on host {}'.format(
+            staged_path, remote_host)
+        )
+    try:
+        if engine == "native":
+            summary = extract_archive(
+                file_abs_path, staged_path,
+                exclude_patterns=exclude_patterns, verbose=verbose
+            )
+            if verbose > 0:
+                print(
+                    '  [{} FILES, {} BYTES]'.format(
+                    summary['members'], summary['bytes']), end=''
+                )
+        else:
+            # If file is compressed tar file or zip file.
+            unzip_cmd = _get_extract_command(file_name, file_abs_path)
+            output = CommandOutput()
+            stdout, stderr = run_command(
+                unzip_cmd,
+                staged_path,
+                remote_host=remote_host,
+                remote_ssh_port=remote_ssh_port,
+                remote_ssh_user=remote_ssh_user,
+                remote_ssh_pass=remote_ssh_pass,
+                verbose=verbose,
+                output=output
+            )
+            if output.exit_status != 0:
+                raise Exception('Error in extracting file - {}'.format(stderr))
+    except Exception:
+        remove_dir(
+            staged_path,
             remote_host=remote_host,
             remote_ssh_port=remote_ssh_port,
             remote_ssh_user=remote_ssh_user,
             remote_ssh_pass=remote_ssh_pass,
             verbose=verbose,
-            failsafe=False
+            failsafe=True
         )
-     
-    # If file is compressed tar file or zip file.
-    unzip_cmd = _get_extract_command(file_name, file_abs_path)
-    stdout, stderr = run_command(
-        unzip_cmd,
-        file_dest_path,
-        remote_host=remote_host,
-        remote_ssh_port=remote_ssh_port,
-        remote_ssh_user=remote_ssh_user,
-        remote_ssh_pass=remote_ssh_pass,
+        raise
+
+    _finish_staged_extraction(
+        file_name, staged_path, file_dest_path,
+        {'file_name': file_name, 'sha256': archive_sha256, 'patches': []},
+        remote_host, remote_ssh_port, remote_ssh_user, remote_ssh_pass,
         verbose=verbose
     )
-    if stderr != "":
-        raise Exception('Error in extracting file - {}'.format(stderr))
+
     logger.info('File has extracted successfully at %s', file_dest_path)
     return file_dest_path_without_ext
 
+def extract_source_snapshot(
+    file_name,
+    file_source_path,
+    file_dest_path,
+    patch_files=None,
+    copy_mode='reflink',
+    remote_host="localhost",
+    remote_ssh_port=22,
+    remote_ssh_user=None,
+    remote_ssh_pass=None,
+    verbose=0,
+    engine=None,
+    exclude_patterns=None
+):
+    """Extracts file with patches applied from source snapshot cache.
+
+    Extracted and patched source tree is kept in snapshot cache of
+    file_source_path once for every archive sha256 and ordered patch files
+    sha256, then source trees are copied from it without extracting and
+    patching archive again.
+
+    Args:
+        file_name (str): File name which will be extracted.
+        file_source_path (str): Source directory path where file exist.
+        file_dest_path (str): Destination directory path where file will be
+            extracted.
+        patch_files (list): Patch files which are applied to extracted files
+            in order.
+        copy_mode (str): "reflink" copies snapshot files and shares their
+            blocks where file system supports it, "hardlink" links snapshot
+            files, so build must not modify source files in place.
+        engine (str): Extract engine used to create snapshot, see
+            extract_file.
+        exclude_patterns (list): Archive member path patterns which are not
+            extracted, see extract_file.
+        remote_host (str): Remote host address if to_location is not local.
+        remote_ssh_port (int): Remote host SSH port.
+        remote_ssh_user (str): Remote host SSH User name.
+        remote_ssh_pass (str): Remote host SSH Password.
+
+    Returns:
+        str: Directory path where file has extracted.
+
+    """
+    patch_files = patch_files or []
+    if copy_mode not in SNAPSHOT_COPY_MODES:
+        raise ValueError(
+            'Snapshot copy mode ' + str(copy_mode) + ' is not supported. ' +
+            'Supported modes are ' + ', '.join(sorted(SNAPSHOT_COPY_MODES))
+        )
+    if re.match('.*\.git$', file_name):
+        raise ValueError('git repository ' + file_name + ' has no snapshot.')
+
+    archive_sha256 = _get_archive_sha256(
+        file_name, file_source_path, remote_host, remote_ssh_port,
+        remote_ssh_user, remote_ssh_pass
+    )
+    if archive_sha256 is None:
+        raise Exception(
+            'File {} does not exist at {}'.format(file_name, file_source_path)
+        )
+    patches_sha256 = _get_files_sha256(
+        patch_files, remote_host, remote_ssh_port, remote_ssh_user,
+        remote_ssh_pass
+    )
+    snapshot_key = hashlib.sha256(json.dumps(
+        [archive_sha256, patches_sha256, exclude_patterns or []]
+    ).encode('utf-8')).hexdigest()
+    snapshot_root = os.path.join(file_source_path, SNAPSHOT_CACHE_DIR_NAME)
+    snapshot_path = os.path.join(snapshot_root, snapshot_key)
+    file_name_without_ext = re.sub(ARCHIVE_EXTENSION_RE_PATTERN, '', file_name)
+
+    ssh_kwargs = {
+        'remote_host': remote_host,
+        'remote_ssh_port': remote_ssh_port,
+        'remote_ssh_user': remote_ssh_user,
+        'remote_ssh_pass': remote_ssh_pass,
+        'verbose': verbose
+    }
+
+    def _quote(path):
+        # Remote command arguments are joined with spaces.
+        if remote_host == "localhost" or remote_host == "127.0.0.1":
+            return path
+        return shlex.quote(path)
+
+    # Snapshot is created in staged directory and renamed to its key, so
+    # snapshot directory exists only if it is complete.
+    if not is_path_exists(snapshot_path, **ssh_kwargs):
+        logger.info(
+            'Creating source snapshot %s of file %s', snapshot_key, file_name
+        )
+        staged_snapshot_path = os.path.join(
+            snapshot_root, _get_temp_file_name(snapshot_key)
+        )
+        mkdirs(staged_snapshot_path, failsafe=False, **ssh_kwargs)
+        try:
+            extracted_path = extract_file(
+                file_name, file_source_path, staged_snapshot_path,
+                engine=engine, exclude_patterns=exclude_patterns,
+                **ssh_kwargs
+            )
+            for patch_file in patch_files:
+                apply_patch(patch_file, extracted_path, **ssh_kwargs)
+            remove_file(
+                _get_extract_stamp_path(file_name, staged_snapshot_path),
+                failsafe=False, **ssh_kwargs
+            )
+            stdout, stderr = run_command(
+                ['mv', '-T', _quote(staged_snapshot_path),
+                _quote(snapshot_path)],
+                **ssh_kwargs
+            )
+            # Snapshot created at same time by other process is also good.
+            if not is_path_exists(snapshot_path, **ssh_kwargs):
+                raise Exception(
+                    'Error in creating source snapshot - {}'.format(stderr)
+                )
+        finally:
+            if is_path_exists(staged_snapshot_path, **ssh_kwargs):
+                remove_dir(staged_snapshot_path, failsafe=True, **ssh_kwargs)
+    else:
+        logger.info(
+            'Source snapshot %s of file %s found in cache', snapshot_key,
+            file_name
+        )
+
+    # Snapshot is copied to staged directory of destination and moved to it.
+    if not is_path_exists(file_dest_path, **ssh_kwargs):
+        mkdirs(file_dest_path, failsafe=False, **ssh_kwargs)
+    staged_path = os.path.join(
+        file_dest_path, _get_temp_file_name(file_name_without_ext)
+    )
+    copy_cmd = SNAPSHOT_COPY_MODES[copy_mode] + [
+        _quote(os.path.join(snapshot_path, '.')), _quote(staged_path)
+    ]
+    output = CommandOutput()
+    stdout, stderr = run_command(copy_cmd, output=output, **ssh_kwargs)
+    if output.exit_status != 0:
+        remove_dir(staged_path, failsafe=True, **ssh_kwargs)
+        raise Exception(
+            'Error in copying source snapshot - {}'.format(stderr)
+        )
+
+    _finish_staged_extraction(
+        file_name, staged_path, file_dest_path,
+        {
+            'file_name': file_name,
+            'sha256': archive_sha256,
+            'patches': patches_sha256
+        },
+        remote_host, remote_ssh_port, remote_ssh_user, remote_ssh_pass,
+        verbose=verbose
+    )
+    logger.info(
+        'File has extracted from source snapshot successfully at %s',
+        file_dest_path
+    )
+    return os.path.join(file_dest_path, file_name_without_ext)
+
 def replace_env_vars(replacing_data, verbose=0):
 
     def _replace_env_vars(replaced_data):
@@ -604,25 +2916,166 @@ def replace_env_vars(replacing_data, verbose=0):
                 replaced_data[key] = _recursive_replace_env_vars(value)
             return replaced_data
         else:
-            raise Exception(
-                'Object type is not supported {}'.format(type(replaced_data))
+            raise Exception(
+                'Object type is not supported {}'.format(type(replaced_data))
+            )
+    
+    replaced_data = replacing_data
+    logger.debug('Replacing environment variables')
+    replaced_data = _recursive_replace_env_vars(replaced_data)
+     
+    logger.debug(
+        'Replaced environment variables \n Before replacement string \n%s' + \
+        '\nAfter replacement string \n%s',
+        replacing_data, replaced_data
+    ) 
+    
+    return replaced_data
+
+def re_replace(pattern, replacement, string, verbose=0):
+    p = re.compile(pattern)
+    return p.sub(replacement, string)
+
+class CommandOutput:
+    """Output and exit status of command executed by run_command.
+
+    Output is decoded incrementally and only last tail_size characters of
+    stdout and stderr are kept in memory, complete output of both streams is
+    appended to log_file if it is given. Same log file can be given to all
+    commands of a package.
+
+    If line_callback is given then it is called with stream name ('stdout' or
+    'stderr') and line without line ending as soon as each line is read, while
+    command is still running. Last line is given when command exits even if
+    it does not end with new line.
+
+    error_classifier is called same as line_callback, it returns error message
+    if line reports fatal error else None. Error messages are collected in
+    errors, run_command stops command on first error if fail_fast is set.
+
+    Attributes:
+        log_file (str): File path where complete output is appended.
+        line_callback (callable): Called with stream name and line.
+        error_classifier (callable): Returns error message of line or None.
+        errors (list): Error messages returned by error_classifier.
+        aborted (bool): True if command was stopped by run_command.
+        exit_status (int): Command exit status, None until command has exited
+            or if it is not known.
+        stdout_size (int): Number of stdout characters written by command.
+        stderr_size (int): Number of stderr characters written by command.
+    """
+
+    def __init__(
+        self,
+        log_file=None,
+        tail_size=COMMAND_OUTPUT_TAIL_SIZE,
+        line_callback=None,
+        error_classifier=None
+    ):
+        self.log_file = log_file
+        self.tail_size = tail_size
+        self.line_callback = line_callback
+        self.error_classifier = error_classifier
+        self.errors = []
+        self.aborted = False
+        self.exit_status = None
+        self.stdout_size = 0
+        self.stderr_size = 0
+        self._tails = {
+            'stdout': collections.deque(), 'stderr': collections.deque()
+        }
+        self._tail_sizes = {'stdout': 0, 'stderr': 0}
+        self._decoders = {
+            'stdout': codecs.getincrementaldecoder('utf-8')('replace'),
+            'stderr': codecs.getincrementaldecoder('utf-8')('replace')
+        }
+        self._partial_lines = {'stdout': '', 'stderr': ''}
+        self._log_file_handler = None
+
+    @property
+    def stdout(self):
+        return self._get_tail('stdout')
+
+    @property
+    def stderr(self):
+        return self._get_tail('stderr')
+
+    def start(self, cmd_str, cmd_exec_dir):
+        if self.log_file is not None:
+            log_dir = os.path.dirname(self.log_file)
+            if log_dir and not os.path.exists(log_dir):
+                os.makedirs(log_dir, exist_ok=True)
+            self._log_file_handler = open(
+                self.log_file, 'a', encoding='utf-8'
+            )
+            self._log_file_handler.write(
+                '$ cd {} && {}\n'.format(cmd_exec_dir, cmd_str)
+            )
+
+    def write(self, stream_name, data, final=False):
+        # Multi byte characters may be split between reads.
+        text = self._decoders[stream_name].decode(data, final=final)
+        if not text:
+            return text
+        if stream_name == 'stdout':
+            self.stdout_size += len(text)
+        else:
+            self.stderr_size += len(text)
+        if self._log_file_handler is not None:
+            self._log_file_handler.write(text)
+        if self.line_callback is not None or \
+            self.error_classifier is not None:
+            self._split_lines(stream_name, text)
+
+        tail = self._tails[stream_name]
+        tail.append(text)
+        self._tail_sizes[stream_name] += len(text)
+        while len(tail) > 1 and \
+            self._tail_sizes[stream_name] - len(tail[0]) >= self.tail_size:
+            self._tail_sizes[stream_name] -= len(tail.popleft())
+        return text
+
+    def finish(self, exit_status):
+        self.write('stdout', b'', final=True)
+        self.write('stderr', b'', final=True)
+        for stream_name, partial_line in self._partial_lines.items():
+            if partial_line:
+                self._process_line(stream_name, partial_line)
+        self._partial_lines = {'stdout': '', 'stderr': ''}
+        self.exit_status = exit_status
+        if self._log_file_handler is not None:
+            self._log_file_handler.write(
+                '$ exit status {}\n'.format(exit_status)
             )
-    
-    replaced_data = replacing_data
-    logger.debug('Replacing environment variables')
-    replaced_data = _recursive_replace_env_vars(replaced_data)
-     
-    logger.debug(
-        'Replaced environment variables \n Before replacement string \n%s' + \
-        '\nAfter replacement string \n%s',
-        replacing_data, replaced_data
-    ) 
-    
-    return replaced_data
+            self._log_file_handler.close()
+            self._log_file_handler = None
 
-def re_replace(pattern, replacement, string, verbose=0):
-    p = re.compile(pattern)
-    return p.sub(replacement, string)
+    def _split_lines(self, stream_name, text):
+        lines = (self._partial_lines[stream_name] + text).split('\n')
+        # Last item is incomplete line, it is completed by next reads.
+        partial_line = lines.pop()
+        if len(partial_line) >= COMMAND_OUTPUT_MAX_LINE_SIZE:
+            lines.append(partial_line)
+            partial_line = ''
+        self._partial_lines[stream_name] = partial_line
+        for line in lines:
+            self._process_line(stream_name, line)
+
+    def _process_line(self, stream_name, line):
+        line = line.rstrip('\r')
+        if self.line_callback is not None:
+            self.line_callback(stream_name, line)
+        if self.error_classifier is not None and \
+            len(self.errors) < COMMAND_OUTPUT_MAX_ERRORS:
+            error = self.error_classifier(stream_name, line)
+            if error:
+                self.errors.append(error)
+
+    def _get_tail(self, stream_name):
+        tail_text = ''.join(self._tails[stream_name])
+        if len(tail_text) > self.tail_size:
+            tail_text = tail_text[-self.tail_size:]
+        return tail_text
 
 def run_command(
     cmd_args_list,
@@ -633,14 +3086,56 @@ def run_command(
     remote_ssh_port=22,
     remote_ssh_user=None,
     remote_ssh_pass=None,
-    verbose=0
+    verbose=0,
+    output=None,
+    log_file=None,
+    line_callback=None,
+    error_classifier=None,
+    fail_fast=False
 ):
-    
+    """Executes command on localhost or remotehost.
+
+    Args:
+        cmd_args_list (list): Command and its arguments.
+        cmd_exec_dir (str): Directory path where command is executed.
+        background (bool): Returns without waiting for command.
+        shell (bool): Executes command through shell on localhost.
+        remote_host (str): Remote host address if command is not local.
+        remote_ssh_port (int): Remote host SSH port.
+        remote_ssh_user (str): Remote host SSH User name.
+        remote_ssh_pass (str): Remote host SSH Password.
+        output (CommandOutput): Captures output and exit status of command,
+            new one is used if it is not given.
+        log_file (str): File path where complete output is appended, if
+            output is not given.
+        line_callback (callable): Called with stream name and each output
+            line as soon as it is read, see CommandOutput.
+        error_classifier (callable): Returns error message of fatal error
+            output line, see CommandOutput.
+        fail_fast (bool): Stops command with its child processes as soon as
+            error_classifier reports an error, CommandOutput.aborted is set.
+
+    Returns:
+        tuple: Last COMMAND_OUTPUT_TAIL_SIZE characters of stdout and stderr,
+            or process object of background command on localhost.
+
+    """
     logger.debug(
         'Executing command - \n%s \nfrom location - %s\n',
         " ".join(cmd_args_list),
         cmd_exec_dir
     )
+    if output is None:
+        output = CommandOutput(
+            log_file=log_file,
+            line_callback=line_callback,
+            error_classifier=error_classifier
+        )
+    else:
+        if line_callback is not None:
+            output.line_callback = line_callback
+        if error_classifier is not None:
+            output.error_classifier = error_classifier
 
     if remote_host == "localhost" or remote_host == "127.0.0.1":
         if background == True:
@@ -652,40 +3147,71 @@ def run_command(
             )
             return proc
 
+        # Command runs in its own process group with fail fast, so make and
+        # compilers started by it are stopped together.
         proc = subprocess.Popen(
             cmd_args_list,
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             cwd=cmd_exec_dir,
-            shell=shell
+            shell=shell,
+            start_new_session=fail_fast
         )
+        # Command gets end of input at once instead of waiting on it.
+        proc.stdin.close()
 
-        flags = fcntl(proc.stdout, F_GETFL)
-        fcntl(proc.stdout, F_SETFL, flags | O_NONBLOCK)
-        flags = fcntl(proc.stderr, F_GETFL)
-        fcntl(proc.stderr, F_SETFL, flags | O_NONBLOCK)
-
-        stdout = ""
-        stderr = ""
-        while proc.poll() is None:
-            try:
-                line = read(proc.stdout.fileno(), 1024)
-                if line:
-                    if verbose > 1:
-                        print(line.decode('utf-8'), end="")
-                    stdout += line.decode('utf-8')
-                line = read(proc.stderr.fileno(), 1024)
-                if line:
+        # Output is read when pipes are readable until both are closed or
+        # command has exited, so output written just before exit is not lost
+        # and a daemon started by command, which keeps pipes open, does not
+        # block the caller.
+        output.start(" ".join(cmd_args_list), cmd_exec_dir)
+        selector = selectors.DefaultSelector()
+        selector.register(proc.stdout, selectors.EVENT_READ, 'stdout')
+        selector.register(proc.stderr, selectors.EVENT_READ, 'stderr')
+        try:
+            while selector.get_map():
+                exited = proc.poll() is not None
+                if exited:
+                    # Output already written is drained without waiting for
+                    # pipes to be closed.
+                    for key in list(selector.get_map().values()):
+                        os.set_blocking(key.fd, False)
+                for key, events in selector.select(
+                    0 if exited else RUN_COMMAND_LOCAL_WAIT_SECS
+                ):
+                    try:
+                        data = os.read(key.fd, RUN_COMMAND_READ_SIZE)
+                    except BlockingIOError:
+                        continue
+                    if not data:
+                        selector.unregister(key.fileobj)
+                        continue
+                    text = output.write(key.data, data)
                     if verbose > 1:
-                        print(line.decode('utf-8'), end="")
-                    stderr += line.decode('utf-8')
-            except OSError:
-                pass
+                        print(text, end="")
+                if exited and not any(
+                    events for key, events in selector.select(0)
+                ):
+                    break
+                if fail_fast and output.errors and not output.aborted:
+                    logger.error(
+                        'Stopping command %s on error %s',
+                        " ".join(cmd_args_list), output.errors[0]
+                    )
+                    try:
+                        os.killpg(proc.pid, signal.SIGTERM)
+                    except ProcessLookupError:
+                        pass
+                    output.aborted = True
+        finally:
+            selector.close()
+            output.finish(proc.wait())
+        stdout = output.stdout
+        stderr = output.stderr
 
         sys.stdout.flush()
         sys.stdin.flush()
-        proc.stdin.close()
         proc.stdout.close()
         proc.stderr.close()
         
@@ -702,39 +3228,84 @@ def run_command(
             if background:
                 cmd_str += " &"
 
-            t = paramiko.Transport((remote_host, remote_ssh_port))
-            t.connect(username=remote_ssh_user, password=remote_ssh_pass)
-            chan = t.open_session()
-            chan.get_pty()
-            chan.settimeout(None)
-            chan.exec_command(cmd_str)
-          
-            stdout_str = ""
-            stderr_str = ""
-            
-            while not chan.exit_status_ready() or chan.recv_ready() or \
-                chan.recv_stderr_ready():
+            # Transport is kept in use until command exits, so it is not
+            # closed as idle.
+            with ssh_transport(
+                remote_host, remote_ssh_port, remote_ssh_user, remote_ssh_pass
+            ) as t:
+                chan = t.open_session()
+                chan.get_pty()
+                chan.settimeout(None)
+                chan.exec_command(cmd_str)
 
-                if chan.recv_ready():
-                    logger.debug('Writing to stdout stream...')
-                    stdout_line = chan.recv(1024).decode('utf-8')
-                    if verbose > 1:
-                        print(stdout_line, end="")
-                    stdout_str += stdout_line
+                output.start(cmd_str, cmd_exec_dir)
+                # Channel file descriptor is readable when stdout or stderr
+                # data is received or channel is closed, so waiting does not
+                # use processor.
+                selector = selectors.DefaultSelector()
+                selector.register(chan, selectors.EVENT_READ)
+                try:
+                    while True:
+                        is_data_read = False
+                        if chan.recv_ready():
+                            stdout_text = output.write(
+                                'stdout', chan.recv(RUN_COMMAND_READ_SIZE)
+                            )
+                            if verbose > 1:
+                                print(stdout_text, end="")
+                            is_data_read = True
 
-                if chan.recv_stderr_ready():
-                    logger.debug('Writing to stderr stream...')
-                    stderr_line = chan.recv_stderr(1024).decode('utf-8')
-                    if verbose > 1:
-                        print(stderr_line, end="")
-                    stderr_str += stderr_line
-            
-            t.close() 
-            chan.close()
-            return stdout_str, stderr_str
+                        if chan.recv_stderr_ready():
+                            stderr_text = output.write(
+                                'stderr',
+                                chan.recv_stderr(RUN_COMMAND_READ_SIZE)
+                            )
+                            if verbose > 1:
+                                print(stderr_text, end="")
+                            is_data_read = True
+
+                        # Closing channel hangs up its terminal, which stops
+                        # remote command with its child processes.
+                        if fail_fast and output.errors:
+                            logger.error(
+                                'Stopping command %s on error %s',
+                                cmd_str, output.errors[0]
+                            )
+                            chan.close()
+                            output.aborted = True
+                            break
+
+                        if is_data_read:
+                            continue
+                        # Output received before exit status is already read.
+                        if chan.exit_status_ready():
+                            break
+                        if chan.eof_received:
+                            # Channel stays readable after end of output,
+                            # exit status is waited for instead.
+                            chan.recv_exit_status()
+                            continue
+                        selector.select(RUN_COMMAND_REMOTE_WAIT_SECS)
+                finally:
+                    selector.close()
+                    output.finish(
+                        chan.recv_exit_status()
+                        if not output.aborted and chan.exit_status_ready()
+                        else None
+                    )
+
+                chan.close()
+                return output.stdout, output.stderr
 
         except Exception as e:
             raise
+        finally:
+            # Command may have changed any path of remote host.
+            invalidate_remote_stats(
+                remote_host=remote_host,
+                remote_ssh_port=remote_ssh_port,
+                remote_ssh_user=remote_ssh_user
+            )
 
 def wget_ftp_download(
     host,
@@ -757,15 +3328,18 @@ def wget_ftp_download(
         mkdirs(destdir, remote_host, remote_ssh_port, remote_ssh_user,
             remote_ssh_pass, failsafe=False)
 
+    # wget writes progress to stderr, so only exit status means failure.
+    output = CommandOutput()
     stdout, stderr = run_command(
         wget_cmd, destdir,
         remote_host=remote_host,
         remote_ssh_port=remote_ssh_port,
         remote_ssh_user=remote_ssh_user,
         remote_ssh_pass=remote_ssh_pass,
-        verbose=verbose
+        verbose=verbose,
+        output=output
     )
-    if stderr != "":
+    if output.exit_status != 0:
         logger.error('Error in downloading ftp file %s', stderr)
         return False
     else:
@@ -780,7 +3354,9 @@ def apply_patch(
     remote_ssh_port=22,
     remote_ssh_user=None,
     remote_ssh_pass=None,
-    verbose=0
+    verbose=0,
+    log_file=None,
+    line_callback=None
 ):
     logger.info("Applying patch %s from directory %s", patch_file, dest_dir)
 
@@ -791,19 +3367,22 @@ def apply_patch(
         raise Exception('patch file %s does not exists', patch_file)
 
     cmd = ["patch", "-p1", "--input=" + patch_file]
+    output = CommandOutput(log_file=log_file, line_callback=line_callback)
     stdout, stderr = run_command(
         cmd, dest_dir,
         remote_host=remote_host,
         remote_ssh_port=remote_ssh_port,
         remote_ssh_user=remote_ssh_user,
         remote_ssh_pass=remote_ssh_pass,
-        verbose=verbose
+        verbose=verbose,
+        output=output
     )
 
-    if stderr != "":
+    # patch reports rejected hunks on stdout, so exit status is checked.
+    if output.exit_status != 0:
         raise Exception(
-            'patch %s execution failed from %s directory',
-            patch_file, dest_dir
+            'patch {} execution failed from {} directory - {}{}'.format(
+            patch_file, dest_dir, stdout, stderr)
         )
 
 def is_path_exists(
@@ -818,19 +3397,254 @@ def is_path_exists(
     if remote_host == "localhost" or remote_host == "127.0.0.1":
         return os.path.exists(file_path)
     else:
-        try:
-            t = paramiko.Transport((remote_host, remote_ssh_port))
-            t.connect(username=remote_ssh_user, password=remote_ssh_pass)
-            sftp = paramiko.SFTPClient.from_transport(t)
-            sftp.stat(file_path)
-            sftp.close()
+        pool_key = (remote_host, remote_ssh_port, remote_ssh_user)
+        path_stats = _get_cached_remote_stats(pool_key, [file_path])
+        if file_path not in path_stats:
+            try:
+                with sftp_session(
+                    remote_host, remote_ssh_port, remote_ssh_user,
+                    remote_ssh_pass
+                ) as sftp:
+                    try:
+                        path_stats[file_path] = _get_sftp_stat_result(
+                            sftp.stat(file_path)
+                        )
+                    except OSError:
+                        path_stats[file_path] = None
+                _cache_remote_stats(pool_key, path_stats)
+            except OSError:
+                # Connection errors are not cached.
+                path_stats[file_path] = None
+        if path_stats[file_path] is not None:
             return True
+        if failsafe:
+            logger.info('Path does not exists %s', file_path)
+            return False
+        else:
+            raise Exception('Path does not exists {}'.format(file_path))
+
+def stat_paths(
+    paths,
+    remote_host="localhost",
+    remote_ssh_port=22,
+    remote_ssh_user=None,
+    remote_ssh_pass=None,
+    verbose=0
+):
+    """Returns stat of many paths, remote paths are checked by one command.
+
+    Symbolic links are followed same as is_path_exists. If remote stat
+    command output can not be parsed then paths are checked on one sftp
+    session. Remote stats are cached, see REMOTE_STAT_CACHE_TTL_SECS.
+
+    Args:
+        paths (list): Paths to check.
+        remote_host (str): Remote host address if paths are not local.
+        remote_ssh_port (int): Remote host SSH port.
+        remote_ssh_user (str): Remote host SSH User name.
+        remote_ssh_pass (str): Remote host SSH Password.
+
+    Returns:
+        dict: Path to os.stat_result or None if path does not exist, remote
+            stat results have only st_mode, st_size and st_mtime.
+
+    """
+    path_stats = {}
+    if remote_host == "localhost" or remote_host == "127.0.0.1":
+        for path in paths:
+            try:
+                path_stats[path] = os.stat(path)
+            except OSError:
+                path_stats[path] = None
+        return path_stats
+
+    pool_key = (remote_host, remote_ssh_port, remote_ssh_user)
+    path_stats = _get_cached_remote_stats(pool_key, paths)
+    for batch_paths in _get_remote_path_batches(
+        path for path in paths if path not in path_stats
+    ):
+        stat_cmd = 'for path in {}; do {}; done'.format(
+            ' '.join(shlex.quote(path) for path in batch_paths),
+            _REMOTE_STAT_CMD
+        )
+        stdout, stderr = run_command(
+            ['bash', '-c', shlex.quote(stat_cmd)],
+            '/',
+            remote_host=remote_host,
+            remote_ssh_port=remote_ssh_port,
+            remote_ssh_user=remote_ssh_user,
+            remote_ssh_pass=remote_ssh_pass,
+            verbose=verbose
+        )
+        batch_stats = _parse_remote_stat_output(stdout, len(batch_paths))
+        if batch_stats is None:
+            logger.info('Remote stat output is not parsed, using sftp.')
+            batch_stats = []
+            with sftp_session(
+                remote_host, remote_ssh_port, remote_ssh_user, remote_ssh_pass
+            ) as sftp:
+                for path in batch_paths:
+                    try:
+                        batch_stats.append(
+                            _get_sftp_stat_result(sftp.stat(path))
+                        )
+                    except OSError:
+                        batch_stats.append(None)
+        batch_path_stats = dict(zip(batch_paths, batch_stats))
+        _cache_remote_stats(pool_key, batch_path_stats)
+        path_stats.update(batch_path_stats)
+    return {path: path_stats[path] for path in paths}
+
+def mkdir_paths(
+    dir_paths,
+    mode=0o755,
+    remote_host="localhost",
+    remote_ssh_port=22,
+    remote_ssh_user=None,
+    remote_ssh_pass=None,
+    verbose=0
+):
+    """Creates many directories with parents, remote directories are created
+    by one command.
+
+    Existing directories are not changed, remote directories found in stat
+    cache are not created again.
+
+    Args:
+        dir_paths (list): Directory paths to create.
+        mode (int): Mode of created directories.
+        remote_host (str): Remote host address if paths are not local.
+        remote_ssh_port (int): Remote host SSH port.
+        remote_ssh_user (str): Remote host SSH User name.
+        remote_ssh_pass (str): Remote host SSH Password.
+
+    Returns:
+        dict: Directory path to True if directory exists after call else
+            False.
+
+    """
+    dir_statuses = {}
+    if remote_host == "localhost" or remote_host == "127.0.0.1":
+        for dir_path in dir_paths:
+            try:
+                os.makedirs(dir_path, mode=mode, exist_ok=True)
+                dir_statuses[dir_path] = True
+            except OSError as e:
+                logger.error('Error in creating directory %s, %s', dir_path, e)
+                dir_statuses[dir_path] = False
+        return dir_statuses
+
+    pool_key = (remote_host, remote_ssh_port, remote_ssh_user)
+    for dir_path, dir_stat in _get_cached_remote_stats(
+        pool_key, dir_paths
+    ).items():
+        if dir_stat is not None and stat.S_ISDIR(dir_stat.st_mode):
+            dir_statuses[dir_path] = True
+
+    # Created directories are checked by same command, so their stats are
+    # cached.
+    for batch_paths in _get_remote_path_batches(
+        dir_path for dir_path in dir_paths if dir_path not in dir_statuses
+    ):
+        mkdir_cmd = 'for path in {}; do mkdir -p -m {:o} -- "$path" ' \
+            '2>/dev/null && {}; done'.format(
+            ' '.join(shlex.quote(path) for path in batch_paths), mode,
+            _REMOTE_STAT_CMD
+        )
+        stdout, stderr = run_command(
+            ['bash', '-c', shlex.quote(mkdir_cmd)],
+            '/',
+            remote_host=remote_host,
+            remote_ssh_port=remote_ssh_port,
+            remote_ssh_user=remote_ssh_user,
+            remote_ssh_pass=remote_ssh_pass,
+            verbose=verbose
+        )
+        invalidate_remote_stats(
+            batch_paths, remote_host, remote_ssh_port, remote_ssh_user
+        )
+        batch_stats = _parse_remote_stat_output(stdout, len(batch_paths))
+        if batch_stats is not None:
+            _cache_remote_stats(pool_key, dict(zip(batch_paths, batch_stats)))
+            batch_statuses = [
+                batch_stat is not None and stat.S_ISDIR(batch_stat.st_mode)
+                for batch_stat in batch_stats
+            ]
+        else:
+            logger.info('Remote mkdir output is not parsed, using sftp.')
+            batch_statuses = []
+            with sftp_session(
+                remote_host, remote_ssh_port, remote_ssh_user, remote_ssh_pass
+            ) as sftp:
+                for dir_path in batch_paths:
+                    try:
+                        _mkdirs_on_sftp(sftp, dir_path, mode)
+                        batch_statuses.append(True)
+                    except OSError:
+                        batch_statuses.append(False)
+        for dir_path, dir_status in zip(batch_paths, batch_statuses):
+            if not dir_status:
+                logger.error('Error in creating directory %s', dir_path)
+            dir_statuses[dir_path] = dir_status
+    return {dir_path: dir_statuses[dir_path] for dir_path in dir_paths}
+
+def _get_sftp_stat_result(attributes):
+    # Sftp attributes have same stat fields as remote stat command.
+    return os.stat_result((
+        attributes.st_mode, 0, 0, 0, 0, 0, attributes.st_size, 0,
+        attributes.st_mtime, 0
+    ))
+
+def _get_remote_path_batches(paths):
+    paths = list(paths)
+    for index in range(0, len(paths), REMOTE_BATCH_MAX_PATHS):
+        yield paths[index:index + REMOTE_BATCH_MAX_PATHS]
+
+def _parse_remote_stat_output(stdout, paths_count):
+    # Returns stat results of stat command output lines, or None if output
+    # does not have one valid line per path.
+    lines = stdout.splitlines()
+    if len(lines) != paths_count:
+        return None
+    path_stats = []
+    for line in lines:
+        line = line.strip()
+        if line == '-':
+            path_stats.append(None)
+            continue
+        match = re.match('^([0-9a-f]+) ([0-9]+) ([0-9]+)$', line)
+        if not match:
+            return None
+        path_stats.append(os.stat_result((
+            int(match.group(1), 16), 0, 0, 0, 0, 0, int(match.group(2)), 0,
+            int(match.group(3)), 0
+        )))
+    return path_stats
+
+def _mkdirs_on_sftp(sftp, dir_path, mode):
+    # Directories are created by absolute path, so working directory of
+    # pooled session is not changed.
+    curr_path = "/"
+    for each_dir in dir_path.split('/'):
+        if not each_dir:
+            continue
+        curr_path = os.path.join(curr_path, each_dir)
+        logger.debug('Creating directory %s', curr_path)
+        try:
+            sftp.stat(curr_path)
         except OSError:
-            if failsafe:
-                logger.info('Path does not exists %s', file_path)
-                return False
-            else:
-                raise Exception('Path does not exists {}'.format(file_path))
+            sftp.mkdir(curr_path, mode=mode)
+
+def _remove_dirs_on_sftp(sftp, dir_path):
+    # Entries are listed with their attributes, so every entry is not checked
+    # by separate request.
+    for attributes in sftp.listdir_attr(path=dir_path):
+        entry_path = os.path.join(dir_path, attributes.filename)
+        if stat.S_ISDIR(attributes.st_mode or 0):
+            _remove_dirs_on_sftp(sftp, entry_path)
+        else:
+            sftp.remove(entry_path)
+    sftp.rmdir(dir_path)
 
 def mkdirs(
     dir_path,
@@ -846,23 +3660,16 @@ def mkdirs(
         if remote_host == "localhost" or remote_host == "127.0.0.1":
             os.makedirs(dir_path, mode=mode)
         else:
-            t = paramiko.Transport((remote_host, remote_ssh_port))
-            t.connect(username=remote_ssh_user, password=remote_ssh_pass)
-            sftp = paramiko.SFTPClient.from_transport(t)
-    
-            path_list = dir_path.split('/')
-            curr_path = "/"
-            for each_dir in path_list:
-                if not each_dir:
-                    continue
-                sftp.chdir(curr_path)
-                curr_path = os.path.join(curr_path, each_dir)
-                logger.debug('Creating directory %s', curr_path)
-                try:
-                    sftp.stat(curr_path)
-                except OSError:
-                    sftp.mkdir(each_dir, mode=mode)
-            sftp.close()
+            if not mkdir_paths(
+                [dir_path],
+                mode=mode,
+                remote_host=remote_host,
+                remote_ssh_port=remote_ssh_port,
+                remote_ssh_user=remote_ssh_user,
+                remote_ssh_pass=remote_ssh_pass,
+                verbose=verbose
+            )[dir_path]:
+                raise Exception('mkdir failed')
     except Exception as e:
         if failsafe:
             logger.error('Error in creating directory %s on host %s, '
@@ -893,12 +3700,17 @@ def create_file(
                 f.close()
                 pass
         else:
-            t = paramiko.Transport((remote_host, remote_ssh_port))
-            t.connect(username=remote_ssh_user, password=remote_ssh_pass)
-            sftp = paramiko.SFTPClient.from_transport(t)
-            fd = sftp.open(file_path, mode='w+')
-            fd.write(file_data)
-            sftp.close()
+            try:
+                with sftp_session(
+                    remote_host, remote_ssh_port, remote_ssh_user,
+                    remote_ssh_pass
+                ) as sftp:
+                    with sftp.open(file_path, mode='w+') as fd:
+                        fd.write(file_data)
+            finally:
+                invalidate_remote_stats(
+                    [file_path], remote_host, remote_ssh_port, remote_ssh_user
+                )
     except Exception as e:
         if failsafe:
             logger.error('File Creation Failed %s', e)
@@ -921,11 +3733,16 @@ def remove_file(
         if remote_host == "localhost" or remote_host == "127.0.0.1":
             os.remove(file_path)
         else:
-            t = paramiko.Transport((remote_host, remote_ssh_port))
-            t.connect(username=remote_ssh_user, password=remote_ssh_pass)
-            sftp = paramiko.SFTPClient.from_transport(t)
-            sftp.remove(file_path)
-            sftp.close()
+            try:
+                with sftp_session(
+                    remote_host, remote_ssh_port, remote_ssh_user,
+                    remote_ssh_pass
+                ) as sftp:
+                    sftp.remove(file_path)
+            finally:
+                invalidate_remote_stats(
+                    [file_path], remote_host, remote_ssh_port, remote_ssh_user
+                )
     except Exception as e:
         if failsafe:
             logger.error('Removing file %s on host %s operation failed %s',
@@ -945,31 +3762,111 @@ def remove_dir(
     remote_ssh_user=None,
     remote_ssh_pass=None,
     verbose=0,
-    failsafe=False
+    failsafe=False,
+    background=False
 ):
-    def _remove_dirs_remotehost(dir_path, sftp_obj):
-        names = sftp_obj.listdir(path=dir_path)
-        for name in names:
-            fullname = os.path.join(dir_path, name)
-            try:
-                mode = sftp_obj.lstat(fullname).st_mode
-            except:
-                mode = 0
-            if stat.S_ISDIR(mode):
-                _remove_dirs_remotehost(fullname, sftp_obj)
+    """Removes directory with its contents.
+
+    Remote directory is removed by one command, or over sftp session if
+    command can not be run on remote host. In background mode directory is
+    renamed to trash directory next to it, and trash directory is removed
+    after function returns.
+
+    Args:
+        dir_path (str): Directory path to remove.
+        remote_host (str): Remote host address if directory is not local.
+        remote_ssh_port (int): Remote host SSH port.
+        remote_ssh_user (str): Remote host SSH User name.
+        remote_ssh_pass (str): Remote host SSH Password.
+        failsafe (bool): Returns False instead of raising exception on error.
+        background (bool): Returns after directory is renamed, its contents
+            are removed in background.
+
+    Returns:
+        bool: True if directory is removed or renamed for removal.
+
+    """
+    def _remove_trash_dir(trash_path):
+        try:
+            if remote_host == "localhost" or remote_host == "127.0.0.1":
+                shutil.rmtree(trash_path)
             else:
-                sftp_obj.remove(fullname)
-        sftp_obj.rmdir(dir_path)
+                with sftp_session(
+                    remote_host, remote_ssh_port, remote_ssh_user,
+                    remote_ssh_pass
+                ) as sftp:
+                    _remove_dirs_on_sftp(sftp, trash_path)
+        except Exception as e:
+            logger.error('Removing trash dir %s on host %s failed %s',
+                trash_path, remote_host, e)
+
+    def _remove_dir_remotehost(dir_path, trash_path):
+        remove_cmd = 'test -d {path} || {{ echo No such directory; exit 1; }}; '
+        if background:
+            remove_cmd += 'mv -T -- {path} {trash} && ' \
+                '(nohup rm -rf -- {trash} > /dev/null 2>&1 &)'
+        else:
+            remove_cmd += 'rm -rf -- {path}'
+        remove_cmd = remove_cmd.format(
+            path=shlex.quote(dir_path), trash=shlex.quote(trash_path)
+        )
+        output = CommandOutput()
+        try:
+            run_command(
+                ['bash', '-c', shlex.quote(remove_cmd)],
+                '/',
+                remote_host=remote_host,
+                remote_ssh_port=remote_ssh_port,
+                remote_ssh_user=remote_ssh_user,
+                remote_ssh_pass=remote_ssh_pass,
+                verbose=verbose,
+                output=output
+            )
+        except Exception as e:
+            logger.info('Removing dir %s by command failed on host %s, '
+                'removing over sftp, %s', dir_path, remote_host, e)
+        else:
+            if output.exit_status != 0:
+                raise Exception('remove command failed with exit status {} '
+                    '{}'.format(output.exit_status, output.stdout.strip())
+                )
+            return
+
+        with sftp_session(
+            remote_host, remote_ssh_port, remote_ssh_user, remote_ssh_pass
+        ) as sftp:
+            if not background:
+                _remove_dirs_on_sftp(sftp, dir_path)
+                return
+            if not stat.S_ISDIR(sftp.stat(dir_path).st_mode):
+                raise NotADirectoryError(dir_path)
+            sftp.posix_rename(dir_path, trash_path)
+        threading.Thread(target=_remove_trash_dir, args=(trash_path,)).start()
 
+    dir_path = os.path.normpath(dir_path)
+    trash_path = os.path.join(
+        os.path.dirname(dir_path), _get_temp_file_name(
+            '{}.{}.trash'.format(os.path.basename(dir_path), time.time_ns())
+        )
+    )
     try:
         if remote_host == "localhost" or remote_host == "127.0.0.1":
-            shutil.rmtree(dir_path)
+            if not background:
+                shutil.rmtree(dir_path)
+            elif not os.path.isdir(dir_path):
+                raise NotADirectoryError(dir_path)
+            else:
+                os.rename(dir_path, trash_path)
+                threading.Thread(
+                    target=_remove_trash_dir, args=(trash_path,)
+                ).start()
         else:
-            t = paramiko.Transport((remote_host, remote_ssh_port))
-            t.connect(username=remote_ssh_user, password=remote_ssh_pass)
-            sftp = paramiko.SFTPClient.from_transport(t)
-            _remove_dirs_remotehost(dir_path, sftp)
-            sftp.close()
+            try:
+                _remove_dir_remotehost(dir_path, trash_path)
+            finally:
+                invalidate_remote_stats(
+                    [dir_path], remote_host, remote_ssh_port, remote_ssh_user
+                )
     except Exception as e:
         if failsafe:
             logger.error('Removing dir %s on host %s operation failed %s',
@@ -982,6 +3879,348 @@ def remove_dir(
 
     return True
 
+def sync_dir(
+    local_dir,
+    remote_dir,
+    remote_host="localhost",
+    remote_ssh_port=22,
+    remote_ssh_user=None,
+    remote_ssh_pass=None,
+    verbose=0,
+    checksum=False,
+    delete=False,
+    failsafe=False
+):
+    """Synchronizes local directory tree to directory on remote host.
+
+    Only files which differ by size or modification time are copied, over
+    one sftp session with pipelined writes. Files are copied to temporary
+    file and renamed, modes and modification times are preserved and
+    symbolic links are created with their targets.
+
+    Args:
+        local_dir (str): Local directory path.
+        remote_dir (str): Directory path on remote host, it is created if it
+            does not exist.
+        remote_host (str): Remote host address.
+        remote_ssh_port (int): Remote host SSH port.
+        remote_ssh_user (str): Remote host SSH User name.
+        remote_ssh_pass (str): Remote host SSH Password.
+        checksum (bool): Files with same size and other modification time
+            are compared by sha256, and are not copied if sha256 is same.
+        delete (bool): Removes remote entries which are not in local tree.
+        failsafe (bool): Returns None instead of raising exception on error.
+
+    Returns:
+        dict: Relative path to action done on remote host, one of 'created',
+            'copied', 'linked', 'updated', 'deleted' or 'unchanged'.
+
+    """
+    is_localhost = remote_host == "localhost" or remote_host == "127.0.0.1"
+
+    def _remove_entry(sftp, path, entry):
+        if entry.kind != 'dir':
+            (os if sftp is None else sftp).remove(path)
+        elif sftp is None:
+            shutil.rmtree(path)
+        else:
+            _remove_dirs_on_sftp(sftp, path)
+
+    def _set_file_attributes(sftp, path, entry):
+        file_system = os if sftp is None else sftp
+        file_system.chmod(path, entry.mode)
+        file_system.utime(path, (entry.mtime, entry.mtime))
+
+    def _copy_file(sftp, rel_path, entry):
+        source_path = os.path.join(local_dir, rel_path)
+        dest_path = os.path.join(remote_dir, rel_path)
+        temp_path = os.path.join(
+            os.path.dirname(dest_path),
+            _get_temp_file_name(os.path.basename(dest_path))
+        )
+        if sftp is None:
+            shutil.copyfile(source_path, temp_path)
+        else:
+            with open(source_path, 'rb') as source_file:
+                # Size is not confirmed by separate request after writes.
+                sftp.putfo(source_file, temp_path, confirm=False)
+        _set_file_attributes(sftp, temp_path, entry)
+        if sftp is None:
+            os.replace(temp_path, dest_path)
+        else:
+            sftp.posix_rename(temp_path, dest_path)
+
+    def _get_same_files(rel_paths):
+        # Returns relative paths of files which have same sha256 locally
+        # and on remote host.
+        same_files = set()
+        for batch_paths in _get_remote_path_batches(rel_paths):
+            try:
+                remote_files_sha256 = _get_files_sha256(
+                    [os.path.join(remote_dir, rel_path)
+                        for rel_path in batch_paths],
+                    remote_host, remote_ssh_port, remote_ssh_user,
+                    remote_ssh_pass
+                )
+            except Exception as e:
+                logger.info('Remote files sha256 are not found, %s', e)
+                continue
+            for rel_path, remote_sha256 in zip(
+                batch_paths, remote_files_sha256
+            ):
+                if _get_file_sha256(os.path.join(local_dir, rel_path)) == \
+                    remote_sha256:
+                    same_files.add(rel_path)
+        return same_files
+
+    def _sync_tree(sftp):
+        local_entries = _list_sync_tree(local_dir)
+        remote_entries = _list_sync_tree(remote_dir, sftp)
+        actions = {}
+
+        # Remote entries of other type are removed, and entries which are not
+        # in local tree if delete. Parent directories are listed before their
+        # entries.
+        for rel_path in sorted(remote_entries):
+            remote_entry = remote_entries.get(rel_path)
+            local_entry = local_entries.get(rel_path)
+            if remote_entry is None or \
+                (local_entry is None and not delete) or \
+                (local_entry is not None and \
+                local_entry.kind == remote_entry.kind):
+                continue
+            _remove_entry(sftp, os.path.join(remote_dir, rel_path),
+                remote_entry)
+            for removed_path in list(remote_entries):
+                if removed_path == rel_path or \
+                    removed_path.startswith(rel_path + '/'):
+                    del remote_entries[removed_path]
+                    if removed_path not in local_entries:
+                        actions[removed_path] = 'deleted'
+
+        file_system = os if sftp is None else sftp
+        changed_dirs = []
+        checksum_files = []
+        for rel_path in sorted(local_entries):
+            local_entry = local_entries[rel_path]
+            remote_entry = remote_entries.get(rel_path)
+            dest_path = os.path.join(remote_dir, rel_path)
+            actions[rel_path] = 'unchanged'
+            if local_entry.kind == 'dir':
+                # Directory modes are set after their files are copied, so
+                # read only directories are written.
+                if remote_entry is None:
+                    file_system.mkdir(dest_path, local_entry.mode | 0o700)
+                    actions[rel_path] = 'created'
+                    changed_dirs.append(rel_path)
+                elif remote_entry.mode != local_entry.mode:
+                    actions[rel_path] = 'updated'
+                    changed_dirs.append(rel_path)
+            elif local_entry.kind == 'link':
+                if remote_entry is None or \
+                    remote_entry.target != local_entry.target:
+                    if remote_entry is not None:
+                        file_system.remove(dest_path)
+                    file_system.symlink(local_entry.target, dest_path)
+                    actions[rel_path] = 'linked'
+            elif remote_entry is None or \
+                remote_entry.size != local_entry.size or \
+                (remote_entry.mtime != local_entry.mtime and not checksum):
+                _copy_file(sftp, rel_path, local_entry)
+                actions[rel_path] = 'copied'
+            elif remote_entry.mtime != local_entry.mtime:
+                checksum_files.append(rel_path)
+            elif remote_entry.mode != local_entry.mode:
+                file_system.chmod(dest_path, local_entry.mode)
+                actions[rel_path] = 'updated'
+
+        same_files = _get_same_files(checksum_files)
+        for rel_path in checksum_files:
+            if rel_path in same_files:
+                _set_file_attributes(
+                    sftp, os.path.join(remote_dir, rel_path),
+                    local_entries[rel_path]
+                )
+                actions[rel_path] = 'updated'
+            else:
+                _copy_file(sftp, rel_path, local_entries[rel_path])
+                actions[rel_path] = 'copied'
+
+        for rel_path in reversed(changed_dirs):
+            file_system.chmod(
+                os.path.join(remote_dir, rel_path),
+                local_entries[rel_path].mode
+            )
+        return actions
+
+    try:
+        if not os.path.isdir(local_dir):
+            raise NotADirectoryError(local_dir)
+        if not mkdir_paths(
+            [remote_dir],
+            remote_host=remote_host,
+            remote_ssh_port=remote_ssh_port,
+            remote_ssh_user=remote_ssh_user,
+            remote_ssh_pass=remote_ssh_pass,
+            verbose=verbose
+        )[remote_dir]:
+            raise Exception('Creating directory {} failed'.format(remote_dir))
+
+        if is_localhost:
+            actions = _sync_tree(None)
+        else:
+            try:
+                with sftp_session(
+                    remote_host, remote_ssh_port, remote_ssh_user,
+                    remote_ssh_pass
+                ) as sftp:
+                    actions = _sync_tree(sftp)
+            finally:
+                invalidate_remote_stats(
+                    [remote_dir], remote_host, remote_ssh_port,
+                    remote_ssh_user
+                )
+    except Exception as e:
+        if failsafe:
+            logger.error('Synchronizing dir %s to %s on host %s failed %s',
+                local_dir, remote_dir, remote_host, e)
+            return None
+        else:
+            raise Exception(
+                'Synchronizing dir {} to {} on host {} failed {}'.format(
+                local_dir, remote_dir, remote_host, e)
+            )
+
+    if verbose > 0:
+        print('[SYNC] {} to {}:{} {} copied, {} deleted'.format(
+            local_dir, remote_host, remote_dir,
+            list(actions.values()).count('copied'),
+            list(actions.values()).count('deleted')
+        ))
+    return actions
+
+_SyncEntry = collections.namedtuple(
+    '_SyncEntry', ['kind', 'size', 'mtime', 'mode', 'target']
+)
+
+def _list_sync_tree(root_dir, sftp=None):
+    # Returns relative path to _SyncEntry of directories, regular files and
+    # symbolic links under root_dir, on remote host if sftp is given.
+    entries = {}
+    rel_dirs = ['']
+    while rel_dirs:
+        rel_dir = rel_dirs.pop()
+        dir_path = os.path.join(root_dir, rel_dir)
+        if sftp is None:
+            with os.scandir(dir_path) as dir_entries:
+                entry_stats = [
+                    (dir_entry.name, dir_entry.stat(follow_symlinks=False))
+                    for dir_entry in dir_entries
+                ]
+        else:
+            entry_stats = [
+                (attributes.filename, attributes)
+                for attributes in sftp.listdir_attr(dir_path)
+            ]
+
+        for entry_name, entry_stat in entry_stats:
+            rel_path = os.path.join(rel_dir, entry_name)
+            entry_mode = entry_stat.st_mode or 0
+            if stat.S_ISLNK(entry_mode):
+                entry_path = os.path.join(dir_path, entry_name)
+                entries[rel_path] = _SyncEntry('link', 0, 0, 0, (
+                    os.readlink(entry_path) if sftp is None
+                    else sftp.readlink(entry_path)
+                ))
+            elif stat.S_ISDIR(entry_mode):
+                entries[rel_path] = _SyncEntry(
+                    'dir', 0, 0, stat.S_IMODE(entry_mode), None
+                )
+                rel_dirs.append(rel_path)
+            elif stat.S_ISREG(entry_mode):
+                entries[rel_path] = _SyncEntry(
+                    'file', entry_stat.st_size, int(entry_stat.st_mtime),
+                    stat.S_IMODE(entry_mode), None
+                )
+            else:
+                logger.info('Skipping special file %s', rel_path)
+    return entries
+
+def _read_json_file(file_path):
+    try:
+        with open(file_path, 'r') as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return {}
+
+def _write_json_file(file_path, data):
+    # Writing to temporary file and renaming it, so readers never see partial
+    # file.
+    if not os.path.exists(os.path.dirname(file_path)):
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    temp_file_path = os.path.join(
+        os.path.dirname(file_path),
+        _get_temp_file_name(os.path.basename(file_path))
+    )
+    with open(temp_file_path, 'w') as json_file:
+        json.dump(data, json_file, indent=4, sort_keys=True)
+    os.replace(temp_file_path, file_path)
+
+def _read_sftp_json_file(sftp, file_path):
+    try:
+        with sftp.open(file_path, 'r') as json_file:
+            return json.loads(json_file.read().decode('utf-8'))
+    except (OSError, ValueError):
+        return {}
+
+def _write_sftp_json_file(sftp, file_path, data):
+    temp_file_path = os.path.join(
+        os.path.dirname(file_path),
+        _get_temp_file_name(os.path.basename(file_path))
+    )
+    with sftp.open(temp_file_path, 'w') as json_file:
+        json_file.write(json.dumps(data, indent=4, sort_keys=True))
+    sftp.posix_rename(temp_file_path, file_path)
+
+def _get_temp_file_name(file_name):
+    # Unique per process and thread, so concurrent writers do not collide.
+    return '.{}.{}.{}.tmp'.format(
+        file_name, os.getpid(), threading.get_ident()
+    )
+
+def _get_sha256_index_path(cache_dir):
+    return os.path.join(cache_dir, SHA256_CACHE_DIR_NAME, SHA256_INDEX_FILE_NAME)
+
+def _get_sha256_object_path(cache_dir, sha256):
+    return os.path.join(cache_dir, SHA256_CACHE_DIR_NAME, sha256)
+
+def _get_sha256_link_target(sha256):
+    # Relative link target, so cache directory can be moved.
+    return os.path.join(SHA256_CACHE_DIR_NAME, sha256)
+
+def _link_sha256_object_on_localhost(file_name, cache_dir, sha256):
+    to_file = os.path.join(cache_dir, file_name)
+    link_target = _get_sha256_link_target(sha256)
+    if os.path.islink(to_file) and os.readlink(to_file) == link_target:
+        return
+
+    temp_link = os.path.join(cache_dir, _get_temp_file_name(file_name))
+    os.symlink(link_target, temp_link)
+    os.replace(temp_link, to_file)
+
+def _link_sha256_object_on_remotehost(sftp, file_name, cache_dir, sha256):
+    to_file = os.path.join(cache_dir, file_name)
+    link_target = _get_sha256_link_target(sha256)
+    try:
+        if sftp.readlink(to_file) == link_target:
+            return
+    except OSError:
+        pass
+
+    temp_link = os.path.join(cache_dir, _get_temp_file_name(file_name))
+    sftp.symlink(link_target, temp_link)
+    sftp.posix_rename(temp_link, to_file)
+
 from timeit import default_timer
 
 class Timer:
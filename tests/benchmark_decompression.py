@@ -0,0 +1,104 @@
+#!/usr/bin/python
+
+"""Compares extraction throughput of tar archive formats.
+
+Every format is extracted with single threaded tar command, with tar command
+using parallel decompressor of host and with native extraction engine.
+Throughput is uncompressed megabytes extracted per second.
+
+Usage: python benchmark_decompression.py [uncompressed size in MB]
+"""
+
+import os
+import sys
+import shutil
+import subprocess
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/..'))
+
+from pkginstaller.internal.setup_utils import *
+
+FORMATS = {
+    'tar.gz': ['tar', 'czf'],
+    'tar.bz2': ['tar', 'cjf'],
+    'tar.xz': ['tar', 'cJf'],
+    'tar.zst': ['tar', '--zstd', '-cf']
+}
+
+SINGLE_THREAD_COMMANDS = {
+    'tar.gz': ['tar', 'xzf'],
+    'tar.bz2': ['tar', 'xjf'],
+    'tar.xz': ['tar', 'xJf'],
+    'tar.zst': ['tar', '--zstd', '-xf']
+}
+
+def create_source_tree(source_dir, size_mb):
+    # Half random and half text data, so archives are neither incompressible
+    # nor trivially compressible.
+    os.makedirs(source_dir)
+    file_size = 1024 * 1024
+    for index in range(size_mb):
+        file_path = os.path.join(source_dir, 'file{}'.format(index))
+        with open(file_path, 'wb') as data_file:
+            if index % 2 == 0:
+                data_file.write(os.urandom(file_size))
+            else:
+                line = 'line {} of benchmark data file\n'.format(index)
+                data_file.write(
+                    (line * (file_size // len(line) + 1))[:file_size].encode()
+                )
+
+def time_extraction(extract_function, extract_dir):
+    os.makedirs(extract_dir)
+    start_time = time.time()
+    extract_function()
+    elapsed_secs = time.time() - start_time
+    shutil.rmtree(extract_dir)
+    return elapsed_secs
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    work_dir = tempfile.mkdtemp(prefix='benchmark_decompression_')
+    try:
+        create_source_tree(os.path.join(work_dir, 'bench-1.0'), size_mb)
+        print('{:<10}{:<22}{:>12}{:>12}'.format(
+            'format', 'engine', 'seconds', 'MB/s'))
+
+        for extension, create_cmd in FORMATS.items():
+            file_name = 'bench-1.0.' + extension
+            create_status = subprocess.run(
+                create_cmd + [file_name, 'bench-1.0'], cwd=work_dir,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            if create_status.returncode != 0:
+                print('{:<10}{}'.format(extension, 'compressor not found'))
+                continue
+
+            file_path = os.path.join(work_dir, file_name)
+            extract_dir = os.path.join(work_dir, 'extract')
+            engines = [
+                ('tar single thread', lambda: subprocess.run(
+                    SINGLE_THREAD_COMMANDS[extension] + [file_path],
+                    cwd=extract_dir, check=True
+                )),
+                ('tar ' + (get_decompress_program(file_name) or 'builtin'),
+                    lambda: extract_file(
+                        file_name, work_dir, extract_dir, engine='command'
+                    )),
+                ('native', lambda: extract_file(
+                    file_name, work_dir, extract_dir, engine='native'
+                ))
+            ]
+            for engine_name, extract_function in engines:
+                elapsed_secs = time_extraction(extract_function, extract_dir)
+                print('{:<10}{:<22}{:>12.2f}{:>12.1f}'.format(
+                    extension, engine_name, elapsed_secs,
+                    size_mb / elapsed_secs
+                ))
+    finally:
+        shutil.rmtree(work_dir)
+
+if __name__ == "__main__":
+    main()
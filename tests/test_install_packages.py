@@ -208,5 +208,66 @@ class TestInstallPackage(unittest.TestCase):
             verbose=VERBOSE
         )
 
+    def test_install_packages_on_hosts(self):
+        test_package_cache_directory = os.path.join(
+            self.temp_remote_dir, 'hosts_src_repo')
+        test_package_extract_root_directory = \
+            os.path.join(self.temp_remote_dir, 'hosts_src')
+        test_package_build_root_directory = \
+            os.path.join(self.temp_remote_dir, 'hosts_build')
+        test_package_install_root_directory = \
+            os.path.join(self.temp_remote_dir, 'hosts_install')
+        test_controller_cache_directory = os.path.join(
+            self.temp_dir, 'controller_src_repo')
+
+        host_results = install_packages_on_hosts(
+            self.test_config['test-install-packages']['packages'],
+            [self.remote_host],
+            test_package_cache_directory,
+            test_package_extract_root_directory,
+            test_package_build_root_directory,
+            test_package_install_root_directory,
+            controller_cache_dir = test_controller_cache_directory,
+            remote_ssh_port = self.remote_ssh_port,
+            remote_ssh_user = self.remote_ssh_user,
+            remote_ssh_pass = self.remote_ssh_pass,
+            verbose=VERBOSE
+        )
+        self.assertEqual(
+            host_results[self.remote_host]['status'], 'INSTALLED'
+        )
+
+        # git repositories are cloned by hosts, not to controller cache.
+        test_packages = self.test_config['test-install-packages']['packages']
+        test_git_package = dict(
+            test_packages[0],
+            name="MySQL-for-Python-3",
+            file_name="MySQL-for-Python-3.git",
+            urls=["https://github.com/gagoel"]
+        )
+        setup_hosts = SetupHosts(
+            test_packages + [test_git_package],
+            [self.remote_host],
+            test_package_cache_directory,
+            test_package_extract_root_directory,
+            test_package_build_root_directory,
+            test_package_install_root_directory,
+            test_controller_cache_directory,
+            remote_ssh_port = self.remote_ssh_port,
+            remote_ssh_user = self.remote_ssh_user,
+            remote_ssh_pass = self.remote_ssh_pass,
+            verbose=VERBOSE
+        )
+        setup_hosts.download()
+        self.assertNotIn(
+            test_git_package['name'], setup_hosts.download_results
+        )
+        self.assertEqual(
+            os.path.exists(os.path.join(
+                test_controller_cache_directory,
+                test_git_package['file_name']
+            )), False
+        )
+
 if __name__ == "__main__":
     unittest.main()
@@ -67,6 +67,31 @@ class TestSetupPackages(unittest.TestCase):
             verbose=VERBOSE
         )
         setup_packages_obj.download()
+
+    def test_download_concurrently(self):
+        setup_pkg_config_list = \
+            self.test_config['test-setup-packages']['packages']
+        temp_dir = os.path.join(self.temp_dir, 'test-download-concurrently')
+        pkg_cache_dir = os.path.join(temp_dir, 'src_repo')
+        pkg_extract_root_dir = os.path.join(temp_dir, 'src')
+        pkg_build_root_dir = os.path.join(temp_dir, 'build')
+        pkg_install_root_dir = os.path.join(temp_dir, 'install')
+
+        setup_packages_obj = SetupPackages(
+            setup_pkg_config_list,
+            pkg_cache_dir,
+            pkg_extract_root_dir,
+            pkg_build_root_dir,
+            pkg_install_root_dir,
+            verbose=VERBOSE,
+            download_workers=4
+        )
+        self.assertEqual(setup_packages_obj.download(), True)
+        for pkg_config in setup_pkg_config_list:
+            self.assertEqual(
+                setup_packages_obj.download_results[pkg_config['name']],
+                'DOWNLOADED'
+            )
     
     def test_extract(self):
         setup_pkg_config_list = \
@@ -4,13 +4,84 @@ import os
 import unittest
 import logging.config
 import shutil
+import zipfile
+import tarfile
+import io
+import time
+import stat
+import re
+import threading
+import hashlib
+import http.server
 import paramiko
 
 sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/../pkginstaller'))
 
 from pkginstaller.internal.setup_utils import *
+from pkginstaller.internal.remote_agent import *
 
 from tests import VERBOSE
+from pkginstaller.internal.setup_utils import _download_url_segments, \
+    _download_url_to_part_file
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    # Serves files of server root_dir with Range and If-Range support and
+    # keep alive connections. Request method, Range header and response status
+    # are recorded in server requests, server etag is ETag of every file.
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle(self):
+        # Clients close connections of aborted downloads.
+        try:
+            super().handle()
+        except ConnectionError:
+            pass
+
+    def _send_file(self, send_body):
+        file_path = os.path.join(self.server.root_dir, self.path.lstrip('/'))
+        if not os.path.isfile(file_path):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        file_size = os.path.getsize(file_path)
+        start, end, status = 0, file_size - 1, 200
+        range_match = re.match(
+            r'bytes=(\d+)-(\d*)$', self.headers.get('Range') or ''
+        )
+        if_range = self.headers.get('If-Range')
+        if range_match and (if_range is None or if_range == self.server.etag):
+            start = int(range_match.group(1))
+            if range_match.group(2):
+                end = min(int(range_match.group(2)), file_size - 1)
+            status = 206
+        self.server.requests.append(
+            (self.command, self.headers.get('Range'), status)
+        )
+
+        self.send_response(status)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', self.server.etag)
+        self.send_header('Content-Length', str(end - start + 1))
+        if status == 206:
+            self.send_header(
+                'Content-Range',
+                'bytes {}-{}/{}'.format(start, end, file_size)
+            )
+        self.end_headers()
+        if send_body:
+            with open(file_path, 'rb') as f:
+                f.seek(start)
+                self.wfile.write(f.read(end - start + 1))
+
+    def do_GET(self):
+        self._send_file(True)
+
+    def do_HEAD(self):
+        self._send_file(False)
 
 class TestSetupUtils(unittest.TestCase):
 
@@ -71,11 +142,28 @@ class TestSetupUtils(unittest.TestCase):
             )
         
     def tearDown(self):
+        if hasattr(self, 'http_server'):
+            self.http_server.shutdown()
+            self.http_server.server_close()
         shutil.rmtree(self.temp_dir)
         remove_dir(self.temp_remote_dir, self.remote_host,
             self.remote_ssh_port, self.remote_ssh_user, self.remote_ssh_pass)
         logging.shutdown()
 
+    def serve_http(self, root_dir):
+        # Starts Range capable HTTP server of root_dir, returns its url.
+        self.http_server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), RangeRequestHandler
+        )
+        self.http_server.daemon_threads = True
+        self.http_server.root_dir = root_dir
+        self.http_server.etag = '"1"'
+        self.http_server.requests = []
+        threading.Thread(
+            target=self.http_server.serve_forever, daemon=True
+        ).start()
+        return 'http://127.0.0.1:{}'.format(self.http_server.server_port)
+
     def test_is_path_exists_localhost(self):
         temp_dir = os.path.join(self.temp_dir, 'test-is-path-exists')
 
@@ -115,6 +203,74 @@ class TestSetupUtils(unittest.TestCase):
         )
         self.assertEqual(path_status, True)
 
+    def test_stat_mkdir_paths_remotehost(self):
+        remote_kwargs = dict(
+            remote_host=self.remote_host,
+            remote_ssh_port=self.remote_ssh_port,
+            remote_ssh_user=self.remote_ssh_user,
+            remote_ssh_pass=self.remote_ssh_pass
+        )
+        dir_paths = [
+            os.path.join(self.temp_remote_dir, 'test-batch', str(i), 'sub dir')
+            for i in range(30)
+        ]
+        dir_statuses = mkdir_paths(dir_paths, **remote_kwargs)
+        self.assertEqual(list(dir_statuses.values()), [True] * 30)
+
+        missing_path = os.path.join(self.temp_remote_dir, 'missing')
+        path_stats = stat_paths(dir_paths + [missing_path], **remote_kwargs)
+        self.assertIsNone(path_stats[missing_path])
+        for dir_path in dir_paths:
+            self.assertTrue(stat.S_ISDIR(path_stats[dir_path].st_mode))
+
+    def test_remote_stat_cache_remotehost(self):
+        remote_kwargs = dict(
+            remote_host=self.remote_host,
+            remote_ssh_port=self.remote_ssh_port,
+            remote_ssh_user=self.remote_ssh_user,
+            remote_ssh_pass=self.remote_ssh_pass
+        )
+        temp_dir = os.path.join(self.temp_remote_dir, 'test-stat-cache')
+        temp_file = os.path.join(temp_dir, 'testfile')
+
+        # Cached missing paths are invalidated by changes of this module.
+        self.assertFalse(is_path_exists(temp_dir, **remote_kwargs))
+        self.assertFalse(is_path_exists(temp_file, **remote_kwargs))
+        mkdirs(temp_dir, **remote_kwargs)
+        self.assertTrue(is_path_exists(temp_dir, **remote_kwargs))
+        create_file(temp_file, 'data', **remote_kwargs)
+        self.assertEqual(stat_paths([temp_file], **remote_kwargs)[
+            temp_file].st_size, 4)
+        remove_file(temp_file, **remote_kwargs)
+        self.assertFalse(is_path_exists(temp_file, **remote_kwargs))
+
+        # Paths changed by commands are not found in cache.
+        run_command(['touch', temp_file], **remote_kwargs)
+        self.assertTrue(is_path_exists(temp_file, **remote_kwargs))
+        remove_dir(temp_dir, **remote_kwargs)
+        self.assertFalse(is_path_exists(temp_file, **remote_kwargs))
+        self.assertFalse(is_path_exists(temp_dir, **remote_kwargs))
+
+    def test_ssh_pool_remotehost(self):
+        remote_args = (
+            self.remote_host, self.remote_ssh_port, self.remote_ssh_user,
+            self.remote_ssh_pass
+        )
+        with ssh_transport(*remote_args) as first_transport:
+            pass
+        for i in range(5):
+            is_path_exists(self.temp_remote_dir, *remote_args)
+        with ssh_transport(*remote_args) as second_transport:
+            pass
+        self.assertIs(first_transport, second_transport)
+
+        # Closed transport is replaced by new one.
+        close_ssh_pool()
+        self.assertFalse(first_transport.is_active())
+        self.assertTrue(is_path_exists(self.temp_remote_dir, *remote_args))
+        with ssh_transport(*remote_args) as third_transport:
+            self.assertTrue(third_transport.is_active())
+
     def test_create_file_localhost(self):
         temp_dir = os.path.join(self.temp_dir, 'test-create-file-dir')
 
@@ -274,6 +430,65 @@ class TestSetupUtils(unittest.TestCase):
 
         self.assertEqual(remove_dir_status, True)
 
+    def test_remove_dir_background_remotehost(self):
+        remote_kwargs = dict(
+            remote_host=self.remote_host,
+            remote_ssh_port=self.remote_ssh_port,
+            remote_ssh_user=self.remote_ssh_user,
+            remote_ssh_pass=self.remote_ssh_pass
+        )
+        temp_dir = os.path.join(self.temp_remote_dir, 'test-remove-dir')
+        mkdir_paths(
+            [os.path.join(temp_dir, str(i)) for i in range(10)],
+            **remote_kwargs
+        )
+
+        remove_dir_status = remove_dir(
+            temp_dir, background=True, **remote_kwargs
+        )
+        self.assertEqual(remove_dir_status, True)
+        self.assertFalse(is_path_exists(temp_dir, **remote_kwargs))
+
+        # Missing directory is not removed.
+        remove_dir_status = remove_dir(
+            temp_dir, failsafe=True, **remote_kwargs
+        )
+        self.assertEqual(remove_dir_status, False)
+
+    def test_sync_dir_remotehost(self):
+        remote_kwargs = dict(
+            remote_host=self.remote_host,
+            remote_ssh_port=self.remote_ssh_port,
+            remote_ssh_user=self.remote_ssh_user,
+            remote_ssh_pass=self.remote_ssh_pass
+        )
+        local_dir = os.path.join(self.temp_dir, 'test-sync-dir')
+        remote_dir = os.path.join(self.temp_remote_dir, 'test-sync-dir')
+        mkdirs(os.path.join(local_dir, 'bin'))
+        create_file(os.path.join(local_dir, 'bin', 'tool'), 'echo tool')
+        os.chmod(os.path.join(local_dir, 'bin', 'tool'), 0o755)
+        create_file(os.path.join(local_dir, 'README'), 'readme')
+        os.symlink('bin/tool', os.path.join(local_dir, 'tool'))
+
+        actions = sync_dir(local_dir, remote_dir, **remote_kwargs)
+        self.assertEqual(actions, {
+            'bin': 'created', 'bin/tool': 'copied', 'README': 'copied',
+            'tool': 'linked'
+        })
+
+        # Only changed files are copied.
+        create_file(os.path.join(local_dir, 'README'), 'new readme')
+        actions = sync_dir(local_dir, remote_dir, **remote_kwargs)
+        self.assertEqual(actions['README'], 'copied')
+        self.assertEqual(actions['bin/tool'], 'unchanged')
+        path_stats = stat_paths(
+            [os.path.join(remote_dir, 'bin', 'tool')], **remote_kwargs
+        )
+        self.assertEqual(
+            stat.S_IMODE(path_stats[os.path.join(remote_dir, 'bin', 'tool')]
+                .st_mode), 0o755
+        )
+
     def test_is_file_downloaded_localhost(self):
         """
         tar, tar.gz, tar.bz2 or tar.xz download test.
@@ -507,6 +722,209 @@ class TestSetupUtils(unittest.TestCase):
         )
         self.assertEqual(path_exists, True)
  
+    def test_download_file_sha256_localhost(self):
+        test_file_name = "mod_wsgi-3.4.tar.gz"
+        test_download_urls = "https://modwsgi.googlecode.com/files"
+        test_src_repo = os.path.join(self.temp_dir, 'src_repo')
+        file_path = os.path.join(test_src_repo, test_file_name)
+
+        # Wrong sha256 fails download and nothing is cached.
+        download_status = download_file(
+            test_file_name, test_download_urls, test_src_repo,
+            verbose=VERBOSE, sha256='0' * 64
+        )
+        self.assertEqual(download_status, False)
+        self.assertEqual(os.path.exists(file_path), False)
+
+        # sha256 is learned on download and file is found in cache.
+        download_status = download_file(
+            test_file_name, test_download_urls, test_src_repo, verbose=VERBOSE
+        )
+        self.assertEqual(download_status, True)
+        self.assertEqual(is_file_cached(test_file_name, test_src_repo), True)
+
+        # Replaced file is not trusted.
+        os.remove(file_path)
+        create_file(file_path, 'This is test file data')
+        self.assertEqual(is_file_cached(test_file_name, test_src_repo), False)
+
+    def test_download_file_segments_localhost(self):
+        test_file_name = "test-1.0.tar.gz"
+        test_mirror_dir = os.path.join(self.temp_dir, 'mirror')
+        os.makedirs(test_mirror_dir)
+        test_file_data = os.urandom(3 * DOWNLOAD_SEGMENT_MIN_SIZE + 7)
+        with open(os.path.join(test_mirror_dir, test_file_name), 'wb') as f:
+            f.write(test_file_data)
+        test_download_urls = self.serve_http(test_mirror_dir)
+        segments_repo = os.path.join(self.temp_dir, 'segments_repo')
+
+        # File is downloaded in one Range request for each segment.
+        download_status = download_file(
+            test_file_name, test_download_urls, segments_repo,
+            verbose=VERBOSE, segments=4
+        )
+        self.assertEqual(download_status, True)
+        with open(os.path.join(segments_repo, test_file_name), 'rb') as f:
+            self.assertEqual(f.read(), test_file_data)
+        range_requests = [
+            request for request in self.http_server.requests
+            if request[0] == 'GET'
+        ]
+        self.assertEqual(len(range_requests), 3)
+        for method, range_header, status in range_requests:
+            self.assertTrue(range_header.startswith('bytes='))
+            self.assertEqual(status, 206)
+
+        # Segments of changed url are served in full and download is aborted.
+        with self.assertRaises(Exception):
+            _download_url_segments(
+                test_download_urls + '/' + test_file_name,
+                os.path.join(self.temp_dir, 'segments.part'),
+                len(test_file_data), 3, validator='"0"'
+            )
+
+    def test_download_url_to_part_file_resume_localhost(self):
+        test_file_name = "test-1.0.tar.gz"
+        test_mirror_dir = os.path.join(self.temp_dir, 'mirror')
+        os.makedirs(test_mirror_dir)
+        test_file_data = os.urandom(256 * 1024)
+        with open(os.path.join(test_mirror_dir, test_file_name), 'wb') as f:
+            f.write(test_file_data)
+        test_url = self.serve_http(test_mirror_dir) + '/' + test_file_name
+        test_file_sha256 = hashlib.sha256(test_file_data).hexdigest()
+        part_file = os.path.join(self.temp_dir, test_file_name + '.part')
+
+        def _write_part_file(part_data, size, etag):
+            with open(part_file, 'wb') as f:
+                f.write(part_data)
+            with open(part_file + '.json', 'w') as f:
+                json.dump({
+                    'url': test_url, 'size': size, 'etag': etag,
+                    'last_modified': None, 'offset': len(part_data)
+                }, f)
+
+        # Truncated part file is resumed with Range request.
+        _write_part_file(test_file_data[:100000], len(test_file_data), '"1"')
+        file_sha256, file_size, url_metadata = \
+            _download_url_to_part_file(test_url, part_file)
+        self.assertEqual(file_sha256, test_file_sha256)
+        self.assertEqual(file_size, len(test_file_data))
+        self.assertEqual(
+            self.http_server.requests, [('GET', 'bytes=100000-', 206)]
+        )
+        self.assertEqual(os.path.exists(part_file + '.json'), False)
+
+        # Changed url fails If-Range and sends whole file.
+        self.http_server.requests = []
+        _write_part_file(b'x' * 100000, len(test_file_data), '"0"')
+        file_sha256, file_size, url_metadata = \
+            _download_url_to_part_file(test_url, part_file)
+        self.assertEqual(file_sha256, test_file_sha256)
+        self.assertEqual(
+            self.http_server.requests, [('GET', 'bytes=100000-', 200)]
+        )
+
+        # Part file of file with other size is discarded.
+        self.http_server.requests = []
+        _write_part_file(b'x' * 100000, len(test_file_data) + 1, '"1"')
+        file_sha256, file_size, url_metadata = \
+            _download_url_to_part_file(test_url, part_file)
+        self.assertEqual(file_sha256, test_file_sha256)
+        self.assertEqual(
+            self.http_server.requests,
+            [('GET', 'bytes=100000-', 206), ('GET', None, 200)]
+        )
+        with open(part_file, 'rb') as f:
+            self.assertEqual(f.read(), test_file_data)
+
+    def test_get_url_metadata(self):
+        test_file_name = "mod_wsgi-3.4.tar.gz"
+        test_download_urls = "https://modwsgi.googlecode.com/files"
+        test_src_repo = os.path.join(self.temp_dir, 'src_repo')
+        file_path = os.path.join(test_src_repo, test_file_name)
+        test_url = os.path.join(test_download_urls, test_file_name)
+
+        download_status = download_file(
+            test_file_name, test_download_urls, test_src_repo, verbose=VERBOSE
+        )
+        self.assertEqual(download_status, True)
+
+        # Second request is conditional and uses recorded metadata.
+        for i in range(2):
+            url_metadata = get_url_metadata(test_url, test_src_repo)
+            self.assertEqual(url_metadata['size'], os.stat(file_path).st_size)
+
+    def test_download_file_stream_extract_localhost(self):
+        test_file_name = "mod_wsgi-3.4.tar.gz"
+        test_download_urls = "https://modwsgi.googlecode.com/files"
+        test_src_repo = os.path.join(self.temp_dir, 'src_repo')
+        test_extract_path = os.path.join(self.temp_dir, 'src')
+
+        download_status = download_file(
+            test_file_name, test_download_urls, test_src_repo,
+            verbose=VERBOSE, extract_path=test_extract_path
+        )
+        self.assertEqual(download_status, True)
+        self.assertEqual(
+            os.path.exists(os.path.join(test_extract_path, 'mod_wsgi-3.4')),
+            True
+        )
+
+    def test_open_url_keep_alive(self):
+        test_file_name = "test-1.0.tar.gz"
+        test_mirror_dir = os.path.join(self.temp_dir, 'mirror')
+        os.makedirs(test_mirror_dir)
+        with open(os.path.join(test_mirror_dir, test_file_name), 'w') as f:
+            f.write('This is test file data')
+        test_url = self.serve_http(test_mirror_dir) + '/' + test_file_name
+
+        # Connection is given back to pool when body is read, so second
+        # request reuses it before first response is closed.
+        responses = []
+        for i in range(2):
+            response = open_url(test_url, timeout=5, max_connections=1)
+            responses.append(response)
+            self.assertEqual(response.status, 200)
+            connection_sock = response._connection.sock
+            self.assertEqual(response.read(), b'This is test file data')
+            if i == 0:
+                first_sock = connection_sock
+        self.assertIs(connection_sock, first_sock)
+        for response in responses:
+            response.close()
+
+        # Unread response keeps its connection, next request fails fast.
+        response = open_url(test_url, timeout=1, max_connections=1)
+        with self.assertRaises(TimeoutError):
+            open_url(test_url, timeout=1, max_connections=1)
+        response.close()
+        response = open_url(test_url, 'HEAD', timeout=1, max_connections=1)
+        response.close()
+        self.assertEqual(response.status, 200)
+
+        with self.assertRaises(ValueError):
+            configure_http_pool(max_connections_per_host=0)
+
+    def test_race_download_urls(self):
+        test_file_name = "mod_wsgi-3.4.tar.gz"
+        test_download_urls = [
+            "file:///" + os.path.join(self.temp_dir, 'no-mirror'),
+            "https://modwsgi.googlecode.com/files"
+        ]
+        test_metadata_dir = os.path.join(self.temp_dir, 'metadata')
+
+        ordered_urls = race_download_urls(
+            test_file_name, test_download_urls, test_metadata_dir,
+            verbose=VERBOSE
+        )
+        self.assertEqual(ordered_urls, list(reversed(test_download_urls)))
+        self.assertEqual(
+            os.path.exists(
+                os.path.join(test_metadata_dir, MIRROR_LATENCY_FILE_NAME)
+            ),
+            True
+        )
+
     def test_extract_file_localhost(self):
         test_file_name = "mod_wsgi-3.4.tar.gz"
         test_download_urls = "https://modwsgi.googlecode.com/files"
@@ -523,6 +941,189 @@ class TestSetupUtils(unittest.TestCase):
 
         self.assertEqual(os.path.exists(test_extract_path), True)
 
+    def test_extract_file_native_localhost(self):
+        test_file_name = "mod_wsgi-3.4.tar.gz"
+        test_download_urls = "https://modwsgi.googlecode.com/files"
+        test_src_repo = os.path.join(self.temp_dir, 'src_repo')
+
+        download_status = download_file(
+            test_file_name, test_download_urls, test_src_repo, verbose=VERBOSE
+        )
+        self.assertEqual(download_status, True)
+
+        test_extract_path = os.path.join(self.temp_dir, 'src')
+        extracted_file = extract_file(
+            test_file_name, test_src_repo, test_extract_path,
+            verbose=VERBOSE, engine="native", exclude_patterns=['*/README']
+        )
+        self.assertEqual(os.path.exists(extracted_file), True)
+        self.assertEqual(
+            os.path.exists(os.path.join(extracted_file, 'README')), False
+        )
+
+        # Command engine does not support exclude patterns.
+        with self.assertRaises(ValueError):
+            extract_file(
+                test_file_name, test_src_repo, test_extract_path,
+                engine="command", exclude_patterns=['*/README']
+            )
+
+    def test_is_file_extracted_localhost(self):
+        test_file_name = "mod_wsgi-3.4.tar.gz"
+        test_download_urls = "https://modwsgi.googlecode.com/files"
+        test_src_repo = os.path.join(self.temp_dir, 'src_repo')
+        test_extract_path = os.path.join(self.temp_dir, 'src')
+
+        download_status = download_file(
+            test_file_name, test_download_urls, test_src_repo, verbose=VERBOSE
+        )
+        self.assertEqual(download_status, True)
+
+        # Partial tree of interrupted extraction is not trusted.
+        mkdirs(os.path.join(test_extract_path, 'mod_wsgi-3.4'))
+        self.assertEqual(
+            is_file_extracted(
+                test_file_name, test_src_repo, test_extract_path
+            ), False
+        )
+
+        extract_file(
+            test_file_name, test_src_repo, test_extract_path, verbose=VERBOSE
+        )
+        self.assertEqual(
+            is_file_extracted(
+                test_file_name, test_src_repo, test_extract_path
+            ), True
+        )
+        # Extraction of other archive file is not trusted.
+        self.assertEqual(
+            is_file_extracted(
+                test_file_name, test_src_repo, test_extract_path,
+                sha256='0' * 64
+            ), False
+        )
+
+    def test_extract_source_snapshot_localhost(self):
+        test_file_name = "mod_wsgi-3.4.tar.gz"
+        test_download_urls = "https://modwsgi.googlecode.com/files"
+        test_src_repo = os.path.join(self.temp_dir, 'src_repo')
+
+        download_status = download_file(
+            test_file_name, test_download_urls, test_src_repo, verbose=VERBOSE
+        )
+        self.assertEqual(download_status, True)
+
+        # First source tree creates snapshot, second one is copied from it.
+        for copy_mode in ('reflink', 'hardlink'):
+            test_extract_path = os.path.join(self.temp_dir, copy_mode)
+            extracted_path = extract_source_snapshot(
+                test_file_name, test_src_repo, test_extract_path,
+                copy_mode=copy_mode, verbose=VERBOSE
+            )
+            self.assertEqual(os.path.exists(extracted_path), True)
+            self.assertEqual(
+                is_file_extracted(
+                    test_file_name, test_src_repo, test_extract_path,
+                    patch_files=[]
+                ), True
+            )
+        self.assertEqual(
+            len(os.listdir(
+                os.path.join(test_src_repo, SNAPSHOT_CACHE_DIR_NAME)
+            )), 1
+        )
+
+    def test_is_file_extracted_patches_localhost(self):
+        test_src_repo = os.path.join(self.temp_dir, 'src_repo')
+        os.makedirs(test_src_repo)
+        test_file_name = 'test-1.0.tar.gz'
+        with tarfile.open(
+            os.path.join(test_src_repo, test_file_name), 'w:gz'
+        ) as f:
+            file_data = b'old\n'
+            file_info = tarfile.TarInfo('test-1.0/file')
+            file_info.size = len(file_data)
+            f.addfile(file_info, io.BytesIO(file_data))
+        test_patch_file = os.path.join(self.temp_dir, 'test.patch')
+        with open(test_patch_file, 'w') as f:
+            f.write('--- a/file\n+++ b/file\n@@ -1 +1 @@\n-old\n+new\n')
+
+        test_extract_path = os.path.join(self.temp_dir, 'src')
+        extract_source_snapshot(
+            test_file_name, test_src_repo, test_extract_path,
+            patch_files=[test_patch_file], verbose=VERBOSE
+        )
+        self.assertEqual(
+            is_file_extracted(
+                test_file_name, test_src_repo, test_extract_path,
+                patch_files=[test_patch_file]
+            ), True
+        )
+        # Patched source tree is not an unpatched extraction.
+        self.assertEqual(
+            is_file_extracted(
+                test_file_name, test_src_repo, test_extract_path,
+                patch_files=[]
+            ), False
+        )
+
+    def test_extract_archive_zip(self):
+        test_file_path = os.path.join(self.temp_dir, 'test-1.0.zip')
+        with zipfile.ZipFile(test_file_path, 'w', zipfile.ZIP_DEFLATED) as f:
+            for i in range(1000):
+                f.writestr('test-1.0/dir{}/file{}'.format(i % 10, i), str(i))
+            script_info = zipfile.ZipInfo('test-1.0/run.sh')
+            script_info.external_attr = 0o755 << 16
+            f.writestr(script_info, 'echo test')
+
+        test_extract_path = os.path.join(self.temp_dir, 'src')
+        summary = extract_archive(
+            test_file_path, test_extract_path, workers=4
+        )
+        self.assertEqual(summary['members'], 1001)
+        self.assertEqual(
+            open(os.path.join(test_extract_path, 'test-1.0/dir9/file999')
+            ).read(), '999'
+        )
+        self.assertEqual(
+            os.stat(os.path.join(test_extract_path, 'test-1.0/run.sh')
+            ).st_mode & 0o777, 0o755
+        )
+
+    def test_extract_archive_zip_outside_link(self):
+        test_file_path = os.path.join(self.temp_dir, 'test-1.0.zip')
+        with zipfile.ZipFile(test_file_path, 'w') as f:
+            f.writestr('escape/file', 'data')
+
+        # Member path is resolved through link in extract location.
+        test_extract_path = os.path.join(self.temp_dir, 'src')
+        test_outside_path = os.path.join(self.temp_dir, 'outside')
+        os.makedirs(test_extract_path)
+        os.makedirs(test_outside_path)
+        os.symlink(
+            test_outside_path, os.path.join(test_extract_path, 'escape')
+        )
+        with self.assertRaises(Exception):
+            extract_archive(test_file_path, test_extract_path)
+        self.assertEqual(os.listdir(test_outside_path), [])
+
+    def test_get_decompress_program(self):
+        self.assertEqual(get_decompress_program('mod_wsgi-3.4.zip'), None)
+        self.assertIn(
+            get_decompress_program('mod_wsgi-3.4.tar.gz'),
+            PARALLEL_DECOMPRESSORS['.tar.gz'] + [None]
+        )
+        self.assertIn(
+            get_decompress_program(
+                'mod_wsgi-3.4.tar.xz',
+                remote_host=self.remote_host,
+                remote_ssh_port=self.remote_ssh_port,
+                remote_ssh_user=self.remote_ssh_user,
+                remote_ssh_pass=self.remote_ssh_pass
+            ),
+            PARALLEL_DECOMPRESSORS['.tar.xz'] + [None]
+        )
+
     def test_extract_file_remotehost(self):
         test_file_name = "mod_wsgi-3.4.tar.gz"
         test_download_urls = "https://modwsgi.googlecode.com/files"
@@ -601,6 +1202,75 @@ class TestSetupUtils(unittest.TestCase):
         stdout, stderr = run_command(cmd, verbose=VERBOSE)
         self.assertEqual(stderr, "")
 
+    def test_run_command_output_localhost(self):
+        log_file = os.path.join(self.temp_dir, 'logs', 'test.log')
+        output = CommandOutput(log_file=log_file, tail_size=100)
+        # Writes of 1025 bytes do not align with RUN_COMMAND_READ_SIZE reads,
+        # so multi byte characters are split between reads.
+        cmd = [
+            sys.executable, '-c',
+            'import sys\n'
+            'for i in range(1000):\n'
+            '    sys.stdout.write("x" + "\\u00e9" * 512)\n'
+            '    sys.stdout.flush()\n'
+            'sys.exit(3)'
+        ]
+        stdout, stderr = run_command(
+            cmd, self.temp_dir, output=output, verbose=VERBOSE
+        )
+        self.assertEqual(len(stdout), 100)
+        self.assertEqual(stdout, output.stdout)
+        self.assertNotIn('�', stdout)
+        self.assertEqual(output.stdout_size, 1000 * 513)
+        self.assertEqual(output.exit_status, 3)
+        with open(log_file, encoding='utf-8') as log_file_handler:
+            log_text = log_file_handler.read()
+        self.assertEqual(log_text.count('é'), 1000 * 512)
+        self.assertIn('$ exit status 3', log_text)
+
+    def test_run_command_line_callback_localhost(self):
+        lines = []
+        cmd = ['/bin/sh', '-c', 'echo first; echo error >&2; printf last']
+        run_command(
+            cmd, self.temp_dir,
+            line_callback=lambda stream, line: lines.append((stream, line)),
+            verbose=VERBOSE
+        )
+        self.assertIn(('stderr', 'error'), lines)
+        self.assertEqual(
+            [line for line in lines if line[0] == 'stdout'],
+            [('stdout', 'first'), ('stdout', 'last')]
+        )
+
+    def test_run_command_fail_fast_localhost(self):
+        output = CommandOutput(
+            error_classifier=lambda stream, line: \
+                line if 'fatal error:' in line else None
+        )
+        cmd = [
+            '/bin/sh', '-c',
+            'echo "a.c:1: fatal error: a.h: not found" >&2; sleep 30'
+        ]
+        start_time = time.time()
+        run_command(
+            cmd, self.temp_dir, output=output, fail_fast=True,
+            verbose=VERBOSE
+        )
+        self.assertLess(time.time() - start_time, 10)
+        self.assertTrue(output.aborted)
+        self.assertNotEqual(output.exit_status, 0)
+        self.assertEqual(output.errors, ['a.c:1: fatal error: a.h: not found'])
+
+    def test_run_command_background_child_localhost(self):
+        # Background child keeps stdout and stderr pipes open after command
+        # exits.
+        cmd = ['/bin/sh', '-c', 'sleep 5 & echo started']
+        start_time = time.time()
+        stdout, stderr = run_command(cmd, self.temp_dir, verbose=VERBOSE)
+        self.assertLess(time.time() - start_time, 2)
+        self.assertEqual(stdout, 'started\n')
+        self.assertEqual(stderr, '')
+
     def test_run_command_remotehost(self):
         temp_dir = os.path.join(self.temp_remote_dir, 'test-run-command')
 
@@ -650,5 +1320,51 @@ class TestSetupUtils(unittest.TestCase):
         self.assertEqual('', stderr)
         self.assertEqual(temp_dir, stdout.strip())
 
+    def test_run_command_output_remotehost(self):
+        output = CommandOutput(tail_size=1000)
+        cmd = [
+            'head', '-c', '10000000', '/dev/zero', '|', 'tr', '"\\0"', 'a',
+            ';', 'sleep', '1', ';', 'exit', '5'
+        ]
+        start_time = time.process_time()
+        run_command(
+            cmd, self.temp_remote_dir,
+            remote_host=self.remote_host,
+            remote_ssh_port=self.remote_ssh_port,
+            remote_ssh_user=self.remote_ssh_user,
+            remote_ssh_pass=self.remote_ssh_pass,
+            output=output
+        )
+        # Waiting for remote command does not use processor.
+        self.assertLess(time.process_time() - start_time, 1)
+        self.assertEqual(output.exit_status, 5)
+        self.assertEqual(output.stdout_size, 10000000)
+        self.assertEqual(output.stdout, 'a' * 1000)
+
+    def test_run_agent_remotehost(self):
+        dirs = [
+            os.path.join(self.temp_remote_dir, 'agent-' + dir_name)
+            for dir_name in ('cache', 'src', 'build', 'install')
+        ]
+        events = []
+        step_events = run_agent(
+            {'packages': [], 'dirs': dirs},
+            self.temp_remote_dir,
+            self.remote_host,
+            remote_ssh_port=self.remote_ssh_port,
+            remote_ssh_user=self.remote_ssh_user,
+            remote_ssh_pass=self.remote_ssh_pass,
+            event_callback=events.append,
+            verbose=VERBOSE
+        )
+        self.assertEqual(events, step_events)
+        self.assertEqual(
+            [(event['step'], event['status']) for event in step_events],
+            [
+                (step, status) for step in AGENT_STEPS
+                for status in ('started', 'finished')
+            ]
+        )
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)